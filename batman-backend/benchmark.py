@@ -0,0 +1,290 @@
+"""Benchmark
+
+End-to-end load test for MapWebSocketServer on localhost.
+
+For every combination of vehicle and client counts a fresh server process is
+started. Synthetic broadcaster processes send vehicle records with the
+Broadcast protocol, and websocket clients measure what comes out the other
+side. Each run reports:
+
+* ingest throughput: records/s the server stored
+* fan-out throughput: frames/s and bytes/s received over all clients
+* end-to-end latency: p50/p99 from txBroadcast to websocket receipt
+* server CPU (% of one core) and peak RSS
+
+Results are printed as a table and, with ``--output``, appended as JSON
+lines so runs of different builds can be compared.
+
+With ``--replay`` the synthetic broadcasters are replaced by a capture
+recorded with ``main.py --capture``, so real field traffic can be played
+against a new build at its original pace or faster.
+
+Example::
+
+    python benchmark.py --vehicles 100,500 --clients 1,10,50 --duration 10 --output results.jsonl
+    python benchmark.py --replay rush_hour.vbcap --replay-speed 4 --clients 10 --duration 30
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+import websockets
+
+from broadcast import Broadcast
+from capture import Replayer, describe
+from wire import VehicleRecord
+
+CENTER = (13.134104638498696, 77.56917072648946)
+
+
+def free_port(kind: int = socket.SOCK_STREAM) -> int:
+    with socket.socket(socket.AF_INET, kind) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def run_server(ws_port: int, udp_port: int):
+    """Server process entry point"""
+    sys.stdout = open(os.devnull, "w")
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    server = main.MapWebSocketServer(host="127.0.0.1", port=ws_port, broadcast_port=udp_port, use_ssl=False,
+                                     metrics_port=None)
+    asyncio.run(server.start_server())
+
+
+def run_broadcaster(udp_port: int, vehicle_ids: List[int], rate: float, duration: float, seed: int):
+    """Broadcaster process: sends every owned vehicle ``rate`` times per second"""
+    rng = random.Random(seed)
+    bdct = Broadcast(port=udp_port, broadcastAddress="127.0.0.1", receive=False)
+    lat = [CENTER[0] + rng.uniform(-0.01, 0.01) for _ in vehicle_ids]
+    lon = [CENTER[1] + rng.uniform(-0.01, 0.01) for _ in vehicle_ids]
+    seq = 0
+    interval = 1 / rate
+    deadline = time.monotonic() + duration
+    next_tick = time.monotonic()
+    while time.monotonic() < deadline:
+        seq += 1
+        now = time.time()
+        records = []
+        for i, vehicle_id in enumerate(vehicle_ids):
+            lat[i] += rng.uniform(-5e-5, 5e-5)
+            lon[i] += rng.uniform(-5e-5, 5e-5)
+            records.append(VehicleRecord(vehicle_id, lat[i], lon[i], now, seq, rng.uniform(0, 360), 10.0))
+        bdct.txRecords(records)
+        next_tick += interval
+        time.sleep(max(0.0, next_tick - time.monotonic()))
+
+
+def run_replayer(udp_port: int, path: str, speed: float):
+    """Replayer process: plays a capture to the server's mesh port"""
+    Replayer(path, speed).run_udp("127.0.0.1", udp_port)
+
+
+class ClientStats:
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        self.latencies: List[float] = []
+
+
+async def run_client(uri: str, stats: ClientStats, measure_from: float, stop_at: float):
+    async with websockets.connect(uri, max_size=None) as websocket:
+        while True:
+            remaining = stop_at - time.time()
+            if remaining <= 0:
+                return
+            try:
+                payload = await asyncio.wait_for(websocket.recv(), remaining)
+            except asyncio.TimeoutError:
+                return
+            received = time.time()
+            if received < measure_from:
+                continue
+            stats.frames += 1
+            stats.bytes += len(payload)
+            message = json.loads(payload)
+            if message.get("type") == "position_batch":
+                for entry in message["data"]:
+                    if entry.get("estimated"):
+                        continue
+                    sent = datetime.fromisoformat(entry["timestamp"]).timestamp()
+                    stats.latencies.append(received - sent)
+
+
+async def request_server_stats(uri: str) -> dict:
+    async with websockets.connect(uri, max_size=None) as websocket:
+        await websocket.send(json.dumps({"type": "request_server_stats"}))
+        while True:
+            message = json.loads(await websocket.recv())
+            if message.get("type") == "server_stats":
+                return message["data"]
+
+
+def read_process_usage(pid: int) -> Optional[Dict[str, float]]:
+    """CPU seconds and RSS of a process from /proc (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/stat") as file:
+            fields = file.read().rsplit(")", 1)[1].split()
+        ticks = os.sysconf("SC_CLK_TCK")
+        cpu_seconds = (int(fields[11]) + int(fields[12])) / ticks
+        with open(f"/proc/{pid}/status") as file:
+            rss_kb = next(int(line.split()[1]) for line in file if line.startswith("VmRSS:"))
+        return {"cpu_seconds": cpu_seconds, "rss_mb": rss_kb / 1024}
+    except (OSError, StopIteration, IndexError, ValueError):
+        return None
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def measure(uri: str, server_pid: int, clients: int, duration: float, warmup: float) -> dict:
+    start = time.time()
+    measure_from = start + warmup
+    stop_at = measure_from + duration
+    stats = [ClientStats() for _ in range(clients)]
+    client_tasks = [asyncio.create_task(run_client(uri, s, measure_from, stop_at)) for s in stats]
+
+    await asyncio.sleep(warmup)
+    usage_before = read_process_usage(server_pid)
+    server_before = await request_server_stats(uri)
+    peak_rss = usage_before["rss_mb"] if usage_before else None
+    while time.time() < stop_at:
+        await asyncio.sleep(min(0.5, max(0.0, stop_at - time.time())))
+        usage = read_process_usage(server_pid)
+        if usage and peak_rss is not None:
+            peak_rss = max(peak_rss, usage["rss_mb"])
+    usage_after = read_process_usage(server_pid)
+    server_after = await request_server_stats(uri)
+    await asyncio.gather(*client_tasks)
+
+    latencies = [latency for s in stats for latency in s.latencies]
+    result = {
+        "ingest_records_per_s": (server_after["records_ingested"] - server_before["records_ingested"]) / duration,
+        "datagrams_dropped": server_after["datagrams_dropped"] - server_before["datagrams_dropped"],
+        "fanout_frames_per_s": sum(s.frames for s in stats) / duration,
+        "fanout_bytes_per_s": sum(s.bytes for s in stats) / duration,
+        "latency_p50_ms": None,
+        "latency_p99_ms": None,
+        "server_cpu_percent": None,
+        "server_rss_peak_mb": peak_rss,
+    }
+    if latencies:
+        result["latency_p50_ms"] = percentile(latencies, 0.50) * 1000
+        result["latency_p99_ms"] = percentile(latencies, 0.99) * 1000
+    if usage_before and usage_after:
+        result["server_cpu_percent"] = (usage_after["cpu_seconds"] - usage_before["cpu_seconds"]) / duration * 100
+    return result
+
+
+def run_case(vehicles: int, clients: int, broadcasters: int, rate: float, duration: float, warmup: float,
+             seed: int, replay: Optional[str] = None, replay_speed: float = 1.0) -> dict:
+    ws_port = free_port()
+    udp_port = free_port(socket.SOCK_DGRAM)
+    uri = f"ws://127.0.0.1:{ws_port}"
+    context = multiprocessing.get_context("spawn")
+
+    server = context.Process(target=run_server, args=(ws_port, udp_port), daemon=True)
+    server.start()
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", ws_port), timeout=0.2).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                server.terminate()
+                raise RuntimeError("Server did not start")
+            time.sleep(0.1)
+
+    if replay:
+        senders = [context.Process(target=run_replayer, args=(udp_port, replay, replay_speed), daemon=True)]
+    else:
+        vehicle_ids = list(range(1, vehicles + 1))
+        senders = [context.Process(
+            target=run_broadcaster,
+            args=(udp_port, vehicle_ids[i::broadcasters], rate, warmup + duration + 1, seed + i),
+            daemon=True,
+        ) for i in range(min(broadcasters, vehicles))]
+    for sender in senders:
+        sender.start()
+
+    try:
+        result = asyncio.run(measure(uri, server.pid, clients, duration, warmup))
+    finally:
+        for process in senders + [server]:
+            process.terminate()
+            process.join()
+
+    return {"vehicles": vehicles, "clients": clients, "broadcasters": len(senders), "rate_hz": rate,
+            "duration_s": duration, **result}
+
+
+def git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def format_value(value) -> str:
+    if value is None:
+        return "-"
+    return f"{value:.1f}" if isinstance(value, float) else str(value)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load and latency benchmark for MapWebSocketServer")
+    parser.add_argument("--vehicles", default="100,500", help="comma separated vehicle counts to sweep")
+    parser.add_argument("--clients", default="1,10,50", help="comma separated websocket client counts to sweep")
+    parser.add_argument("--broadcasters", type=int, default=4, help="synthetic broadcaster processes")
+    parser.add_argument("--rate", type=float, default=1.0, help="updates per vehicle per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="measured seconds per case")
+    parser.add_argument("--warmup", type=float, default=2.0, help="seconds before measuring")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="append results to this JSON lines file")
+    parser.add_argument("--replay", help="replay this capture file instead of running synthetic broadcasters")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="1 for real time, N for N times faster, 0 for as fast as possible")
+    args = parser.parse_args()
+
+    columns = ["vehicles", "clients", "ingest_records_per_s", "fanout_frames_per_s", "fanout_bytes_per_s",
+               "latency_p50_ms", "latency_p99_ms", "server_cpu_percent", "server_rss_peak_mb"]
+    print(" ".join(f"{column:>20}" for column in columns))
+
+    run = {"revision": git_revision(), "host": platform.node(), "python": platform.python_version(),
+           "started": datetime.now().isoformat()}
+    vehicle_counts = [int(v) for v in args.vehicles.split(",")]
+    if args.replay:
+        capture = describe(args.replay)
+        run.update(capture=os.path.basename(args.replay), replay_speed=args.replay_speed)
+        vehicle_counts = [capture["vehicles"]]
+    for vehicles in vehicle_counts:
+        for clients in [int(c) for c in args.clients.split(",")]:
+            result = run_case(vehicles, clients, args.broadcasters, args.rate, args.duration, args.warmup, args.seed,
+                              args.replay, args.replay_speed)
+            print(" ".join(f"{format_value(result[column]):>20}" for column in columns), flush=True)
+            if args.output:
+                with open(args.output, "a") as file:
+                    file.write(json.dumps({**run, **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -10,6 +10,11 @@ of Washington, Bothell in affiliation with PACCAR Inc.
 """
 
 import socket
+import time
+from typing import List, Optional
+
+from dead_reckoning import TransmitPolicy
+from wire import MAX_DATAGRAM_SIZE, VehicleRecord, decode_datagram, encode_json, is_packable, pack_datagrams
 
 class Broadcast:
     """The class used to represent a Broadcast socket for sending or receiving.
@@ -22,6 +27,12 @@ class Broadcast:
         the port number to broadcast on
     version : int
         the version number to broadcast
+    binary : bool
+        whether txRecords uses the compact binary format or legacy JSON
+    receive : bool
+        whether to open the receiving socket
+    transmit_policy : TransmitPolicy
+        when set, txRecords only sends records receivers cannot extrapolate
 
     Methods
     -------
@@ -29,21 +40,34 @@ class Broadcast:
         handles receiving broadcasts
     txBroadcast()
         handles transmitting broadcasts
+    rxRecords()
+        handles receiving vehicle records in either wire format
+    rxPending()
+        drains every datagram already queued on a non-blocking socket
+    txRecords()
+        handles transmitting vehicle records, many per datagram
 
     """
     broadcastAddress = ''
     port = 0
 
-    def __init__(self, port = 1200, broadcastAddress = '<broadcast>'):
+    def __init__(self, port = 1200, broadcastAddress = '<broadcast>', binary = True, receive = True,
+                 transmit_policy: Optional[TransmitPolicy] = None):
         self.broadcastAddress = broadcastAddress
         self.port = port
+        self.binary = binary
+        self.transmit_policy = transmit_policy
 
         # Sets up transmission socket
         self.tx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.tx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.tx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
         
-        # Sets up receiving socket
+        # Sets up receiving socket, skipped for transmit-only nodes so they do
+        # not share the port with (and steal unicast datagrams from) a receiver
+        self.rx_sock = None
+        if not receive:
+            return
         self.rx_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         self.rx_sock.settimeout(0.2)
         self.rx_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -67,3 +91,62 @@ class Broadcast:
     def txBroadcast(self, data: str):
         """Handles transmitting broadcasts."""
         self.tx_sock.sendto(bytes(data, "utf-8"), (self.broadcastAddress, self.port))
+
+    def rxRecords(self):
+        """Handles receiving vehicle records.
+
+        Returns
+        -------
+        (records, (address, port)) : tuple
+            decoded records, empty when nothing valid was received
+        """
+        try:
+            data, addr = self.rx_sock.recvfrom(MAX_DATAGRAM_SIZE)
+        except OSError:
+            return ([], ("", ""))
+        try:
+            return (decode_datagram(data, time.time()), addr)
+        except ValueError:
+            return ([], addr)
+
+    def rxPending(self, limit = 256):
+        """Drains datagrams queued on the receive socket without blocking.
+
+        Meant to be called from an event loop reader once the socket has been
+        made non-blocking. ``limit`` bounds the work per call so a flood of
+        packets cannot starve the rest of the loop.
+
+        Returns
+        -------
+        [(data, (address, port))] : list
+            raw datagrams in arrival order
+        """
+        datagrams = []
+        while len(datagrams) < limit:
+            try:
+                datagrams.append(self.rx_sock.recvfrom(MAX_DATAGRAM_SIZE))
+            except (BlockingIOError, InterruptedError):
+                break
+        return datagrams
+
+    def txRecords(self, records: List[VehicleRecord]):
+        """Handles transmitting vehicle records.
+
+        Records are packed into as few MTU sized datagrams as possible. Records
+        that cannot be represented in the binary format, or every record when
+        binary is disabled, are sent one per datagram as JSON. With a
+        transmit policy, records the receivers can already dead reckon are
+        dropped first.
+        """
+        if self.transmit_policy is not None:
+            records = self.transmit_policy.select(records)
+        if self.binary:
+            packable = [record for record in records if is_packable(record)]
+            fallback = [record for record in records if not is_packable(record)]
+        else:
+            packable, fallback = [], records
+
+        for datagram in pack_datagrams(packable):
+            self.tx_sock.sendto(datagram, (self.broadcastAddress, self.port))
+        for record in fallback:
+            self.tx_sock.sendto(encode_json(record), (self.broadcastAddress, self.port))
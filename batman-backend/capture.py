@@ -0,0 +1,334 @@
+"""Capture
+
+Record and replay of raw mesh traffic.
+
+A capture is an append-only file of chunks. Each chunk holds the datagrams
+received in roughly one second, with their source address and receive time,
+and is zlib compressed and checksummed on its own. A capture cut short by a
+crash or power loss is still readable up to its last complete chunk, and
+reopening it cuts off any partial chunk and appends after the last complete
+one.
+
+File layout (little endian)::
+
+    header  magic "VBCAP" | version u8 | wall_start f64 | monotonic_start f64
+    chunk   magic "CK" | flags u8 | count u32 | base f64 | length u32 | crc32 u32 | payload
+    record  offset_us u32 | ip 4s | port u16 | length u16 | data
+    session magic "SS" | wall_start f64 | monotonic_start f64
+
+``base`` is the monotonic receive time of the first record in the chunk and
+``offset_us`` the microseconds after it. ``wall_start`` and
+``monotonic_start`` tie the monotonic clock to wall clock time. The header
+anchors the first recording session; every later one starts with a session
+marker, since the monotonic clock of another run (or boot) is unrelated.
+Readers map the receive times of every session onto the first one's clock.
+
+The replayer feeds a capture back at its original pace, N times faster, or
+as fast as possible, either into a server in the same process or over UDP.
+
+Example::
+
+    python capture.py info rush_hour.vbcap
+    python capture.py replay rush_hour.vbcap --port 1200 --speed 4
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import struct
+import time
+import zlib
+from typing import Callable, Iterator, List, NamedTuple, Optional, Tuple
+
+from wire import HEADER as DATAGRAM_HEADER, MAGIC as DATAGRAM_MAGIC, decode_datagram
+
+MAGIC = b"VBCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<5sBdd")
+CHUNK_HEADER = struct.Struct("<2sBIdII")
+CHUNK_MAGIC = b"CK"
+SESSION = struct.Struct("<2sdd")
+SESSION_MAGIC = b"SS"
+RECORD_HEADER = struct.Struct("<I4sHH")
+FLAG_ZLIB = 1
+# Offsets are u32 microseconds, so a chunk may span at most ~71 minutes
+MAX_CHUNK_SPAN = 3600.0
+
+
+class CapturedDatagram(NamedTuple):
+    """A datagram as it was received"""
+    received: float
+    data: bytes
+    addr: Tuple[str, int]
+
+
+def _pack_addr(addr: Tuple[str, int]) -> Tuple[bytes, int]:
+    try:
+        return socket.inet_aton(addr[0]), addr[1]
+    except (OSError, TypeError, IndexError):
+        return b"\0\0\0\0", 0
+
+
+class CaptureWriter:
+    """Appends received datagrams to a capture file.
+
+    Datagrams are buffered in memory and written as one chunk once
+    ``chunk_records`` are pending or ``flush`` is called, which the server
+    does every tick.
+    """
+
+    def __init__(self, path: str, chunk_records: int = 4096, compress: bool = True):
+        self.path = path
+        self.chunk_records = chunk_records
+        self.compress = compress
+        self.pending: List[bytes] = []
+        self.chunk_base: Optional[float] = None
+        self.records = 0
+        if os.path.exists(path) and os.path.getsize(path) >= FILE_HEADER.size:
+            # Refuses to append to something that is not a capture
+            reader = CaptureReader(path)
+            for _ in reader.chunks():
+                pass
+            self.file = open(path, "r+b")
+            # Drop a chunk left partial by a crash, it would hide everything written after it
+            self.file.truncate(reader.end)
+            self.file.seek(reader.end)
+            self.file.write(SESSION.pack(SESSION_MAGIC, time.time(), time.monotonic()))
+        else:
+            self.file = open(path, "wb")
+            self.file.write(FILE_HEADER.pack(MAGIC, VERSION, time.time(), time.monotonic()))
+        self.file.flush()
+
+    def write(self, data: bytes, addr: Tuple[str, int], received: Optional[float] = None):
+        received = time.monotonic() if received is None else received
+        if self.chunk_base is None:
+            self.chunk_base = received
+        elif received - self.chunk_base >= MAX_CHUNK_SPAN:
+            self.flush()
+            self.chunk_base = received
+        ip, port = _pack_addr(addr)
+        offset = max(0, int((received - self.chunk_base) * 1e6))
+        self.pending.append(RECORD_HEADER.pack(offset, ip, port, len(data)) + data)
+        if len(self.pending) >= self.chunk_records:
+            self.flush()
+
+    def flush(self):
+        """Write pending datagrams as one chunk"""
+        if not self.pending:
+            return
+        payload = b"".join(self.pending)
+        flags = 0
+        if self.compress:
+            payload = zlib.compress(payload, 1)
+            flags |= FLAG_ZLIB
+        self.file.write(CHUNK_HEADER.pack(CHUNK_MAGIC, flags, len(self.pending), self.chunk_base,
+                                          len(payload), zlib.crc32(payload)) + payload)
+        self.file.flush()
+        self.records += len(self.pending)
+        self.pending = []
+        self.chunk_base = None
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class CaptureReader:
+    """Iterates the datagrams of a capture file in receive order"""
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as file:
+            header = file.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size:
+            raise ValueError(f"{path} is not a capture file")
+        magic, version, self.wall_start, self.monotonic_start = FILE_HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a version {VERSION} capture file")
+        self.truncated = False
+        # Recording sessions read so far, and the file offset after the last complete chunk
+        self.sessions = 1
+        self.end = FILE_HEADER.size
+
+    def wall_time(self, received: float) -> float:
+        """Wall clock time at which a datagram was received"""
+        return self.wall_start + received - self.monotonic_start
+
+    def chunks(self) -> Iterator[Tuple[float, int, bytes]]:
+        """(base, count, payload) of every complete chunk, with ``base`` on the first session's clock"""
+        self.sessions = 1
+        self.end = FILE_HEADER.size
+        self.truncated = False
+        shift = 0.0
+        with open(self.path, "rb") as file:
+            file.seek(FILE_HEADER.size)
+            while True:
+                header = file.read(2)
+                if not header:
+                    return
+                if header == SESSION_MAGIC:
+                    header += file.read(SESSION.size - 2)
+                    if len(header) < SESSION.size:
+                        self.truncated = True
+                        return
+                    _, wall_start, monotonic_start = SESSION.unpack(header)
+                    shift = (wall_start - self.wall_start) - (monotonic_start - self.monotonic_start)
+                    self.sessions += 1
+                    self.end = file.tell()
+                    continue
+                header += file.read(CHUNK_HEADER.size - 2)
+                if len(header) < CHUNK_HEADER.size:
+                    self.truncated = True
+                    return
+                magic, flags, count, base, length, crc = CHUNK_HEADER.unpack(header)
+                payload = file.read(length)
+                if magic != CHUNK_MAGIC or len(payload) < length or zlib.crc32(payload) != crc:
+                    # Partially written chunk at the end of an interrupted capture
+                    self.truncated = True
+                    return
+                self.end = file.tell()
+                if flags & FLAG_ZLIB:
+                    payload = zlib.decompress(payload)
+                yield base + shift, count, payload
+
+    def __iter__(self) -> Iterator[CapturedDatagram]:
+        for base, count, payload in self.chunks():
+            position = 0
+            for _ in range(count):
+                offset, ip, port, length = RECORD_HEADER.unpack_from(payload, position)
+                position += RECORD_HEADER.size
+                yield CapturedDatagram(base + offset / 1e6, payload[position:position + length],
+                                       (socket.inet_ntoa(ip), port))
+                position += length
+
+
+def retime_datagram(data: bytes, shift: float) -> bytes:
+    """Move the timestamps of a binary datagram by ``shift`` seconds, leaving other datagrams alone"""
+    if len(data) < DATAGRAM_HEADER.size or data[:2] != DATAGRAM_MAGIC:
+        return data
+    magic, version, count, base_time = DATAGRAM_HEADER.unpack_from(data)
+    return DATAGRAM_HEADER.pack(magic, version, count, base_time + shift) + data[DATAGRAM_HEADER.size:]
+
+
+class Replayer:
+    """Plays a capture back with its original timing scaled by ``speed``.
+
+    ``speed`` 1 replays in real time, 4 four times faster and 0 as fast as
+    possible. The idle time between recording sessions is skipped. With
+    ``retime`` the record timestamps of binary datagrams are moved to the
+    replay time, so latency and staleness checks in the server behave as
+    they did live.
+    """
+
+    def __init__(self, path: str, speed: float = 1.0, retime: bool = True):
+        self.reader = CaptureReader(path)
+        self.speed = speed
+        self.retime = retime
+        self.sent = 0
+
+    def _schedule(self) -> Iterator[Tuple[float, bytes, Tuple[str, int]]]:
+        """(seconds after the replay start, data, addr) for every datagram"""
+        start = previous = None
+        session = self.reader.sessions
+        replay_wall = time.time()
+        for received, data, addr in self.reader:
+            if start is None:
+                start = received
+            elif self.reader.sessions != session:
+                # Continue right where the previous session stopped
+                session = self.reader.sessions
+                start += received - previous
+            previous = received
+            due = (received - start) / self.speed if self.speed > 0 else 0.0
+            if self.retime:
+                data = retime_datagram(data, replay_wall + due - self.reader.wall_time(received))
+            yield due, data, addr
+
+    def run(self, send: Callable[[bytes, Tuple[str, int]], None]):
+        """Replay on the calling thread, calling ``send(data, addr)`` for every datagram"""
+        started = time.monotonic()
+        for due, data, addr in self._schedule():
+            delay = started + due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            send(data, addr)
+            self.sent += 1
+
+    async def run_async(self, send: Callable[[bytes, Tuple[str, int]], None], yield_every: int = 256):
+        """Replay on the running event loop, calling ``send(data, addr)`` for every datagram"""
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for due, data, addr in self._schedule():
+            delay = started + due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif self.sent % yield_every == 0:
+                # Let the server's own tasks run during a fast replay
+                await asyncio.sleep(0)
+            send(data, addr)
+            self.sent += 1
+
+    def run_udp(self, host: str = "127.0.0.1", port: int = 1200):
+        """Replay by sending every datagram to a running server's mesh port"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            self.run(lambda data, addr: sock.sendto(data, (host, port)))
+
+
+def describe(path: str) -> dict:
+    """Summary of a capture for quick inspection and regression baselines"""
+    reader = CaptureReader(path)
+    datagrams = records = invalid = 0
+    vehicles = set()
+    first = last = None
+    for received, data, addr in reader:
+        datagrams += 1
+        first = received if first is None else first
+        last = received
+        try:
+            decoded = decode_datagram(data, received)
+        except ValueError:
+            invalid += 1
+            continue
+        records += len(decoded)
+        vehicles.update(record.vehicle_id or addr for record in decoded)
+    duration = (last - first) if datagrams else 0.0
+    return {
+        "datagrams": datagrams,
+        "records": records,
+        "invalid_datagrams": invalid,
+        "vehicles": len(vehicles),
+        "duration_s": round(duration, 3),
+        "records_per_s": round(records / duration, 1) if duration else None,
+        "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(reader.wall_start)),
+        "sessions": reader.sessions,
+        "truncated": reader.truncated,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay mesh captures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    info = commands.add_parser("info", help="summarize a capture")
+    info.add_argument("path")
+    replay = commands.add_parser("replay", help="send a capture to a server's mesh port")
+    replay.add_argument("path")
+    replay.add_argument("--host", default="127.0.0.1")
+    replay.add_argument("--port", type=int, default=1200)
+    replay.add_argument("--speed", type=float, default=1.0, help="1 for real time, N for N times faster, 0 for flat out")
+    replay.add_argument("--no-retime", action="store_true", help="keep the captured record timestamps")
+    args = parser.parse_args()
+
+    if args.command == "info":
+        for key, value in describe(args.path).items():
+            print(f"{key:>18}: {value}")
+    else:
+        replayer = Replayer(args.path, args.speed, retime=not args.no_retime)
+        started = time.monotonic()
+        replayer.run_udp(args.host, args.port)
+        print(f"Replayed {replayer.sent} datagrams in {time.monotonic() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Client queue
+
+Outbound queue and writer task for one websocket client.
+
+Broadcasts only enqueue, and each client's own writer task does the send, so
+a client on a slow or stalled mesh link never holds up the others. Position
+updates are coalesced to the latest value per vehicle while a client is
+behind, as long as no other message was queued after them, and a client
+that stays behind for too long is disconnected.
+"""
+
+import asyncio
+import json
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Optional
+
+import websockets
+
+logger = logging.getLogger(__name__)
+
+# Close code sent to evicted clients ("Try Again Later")
+SLOW_CONSUMER_CLOSE_CODE = 1013
+
+
+class ClientQueue:
+    """Bounded outbound queue for a single websocket client.
+
+    Attributes
+    ----------
+    websocket : websockets.WebSocketServerProtocol
+        the client connection
+    max_pending : int
+        frames plus vehicles that may be pending before the client is evicted
+    max_lag : float
+        seconds a client may stay behind before it is evicted
+
+    Methods
+    -------
+    put_frame(payload)
+        queues an already serialized message
+    put_batch(entries, payload, version)
+        queues a position batch, coalescing with any batch not yet sent
+    start()
+        starts the writer task
+    close()
+        stops the writer task
+    """
+
+    def __init__(self, websocket: websockets.WebSocketServerProtocol, max_pending: int = 10000,
+                 max_lag: float = 5.0):
+        self.websocket = websocket
+        self.max_pending = max_pending
+        self.max_lag = max_lag
+        self.frames: Deque[str] = deque()
+        self.positions: Dict[Hashable, dict] = {}
+        # Serialized form of ``positions`` when it holds exactly one shared batch
+        self.shared_batch: Optional[str] = None
+        # State version of the newest batch in ``positions``
+        self.batch_version: Optional[int] = None
+        self.behind_since: Optional[float] = None
+        self.evicted = False
+        self.wakeup = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    @property
+    def depth(self) -> int:
+        """Number of frames and coalesced vehicle updates waiting to be sent"""
+        return len(self.frames) + len(self.positions)
+
+    @property
+    def lag(self) -> float:
+        """Seconds the client has continuously had unsent data queued behind a send"""
+        return time.monotonic() - self.behind_since if self.behind_since is not None else 0.0
+
+    def put_frame(self, payload: str):
+        """Queue an already serialized message"""
+        if self.evicted:
+            return
+        self._mark_behind()
+        if self.positions:
+            # Positions queued earlier go out first, so a later vehicle_left or snapshot is never overtaken
+            self.frames.append(self._take_batch())
+        self.frames.append(payload)
+        self._check_backlog()
+        self.wakeup.set()
+
+    def put_batch(self, entries: List[dict], payload: str, version: Optional[int] = None):
+        """Queue a position batch.
+
+        When nothing is pending the shared ``payload`` is sent as is. If the
+        previous batch has not gone out yet the two are merged, keeping only
+        the latest entry per vehicle, and re-encoded for this client alone.
+        """
+        if self.evicted:
+            return
+        self._mark_behind()
+        if self.positions:
+            self.shared_batch = None
+        else:
+            self.shared_batch = payload
+        for entry in entries:
+            self.positions[entry["id"]] = entry
+        self.batch_version = version
+        self._check_backlog()
+        self.wakeup.set()
+
+    def _mark_behind(self):
+        if self.depth and self.behind_since is None:
+            self.behind_since = time.monotonic()
+
+    def _check_backlog(self):
+        if self.depth > self.max_pending or self.lag > self.max_lag:
+            self.evict()
+
+    def evict(self):
+        """Disconnect a client that cannot keep up"""
+        if self.evicted:
+            return
+        self.evicted = True
+        logger.warning(f"Disconnecting slow client {self.websocket.remote_address}: "
+                       f"{self.depth} updates queued, {self.lag:.1f}s behind")
+        self.frames.clear()
+        self.positions.clear()
+        self.shared_batch = None
+        if self.task:
+            self.task.cancel()
+        asyncio.create_task(self.websocket.close(code=SLOW_CONSUMER_CLOSE_CODE, reason="Client too slow"))
+
+    def start(self):
+        """Start the writer task"""
+        self.task = asyncio.create_task(self.run())
+
+    def close(self):
+        """Stop the writer task"""
+        if self.task:
+            self.task.cancel()
+
+    def _take_batch(self) -> str:
+        payload = self.shared_batch or json.dumps({
+            "type": "position_batch",
+            "version": self.batch_version,
+            "data": list(self.positions.values())
+        })
+        self.positions = {}
+        self.shared_batch = None
+        return payload
+
+    async def run(self):
+        """Send queued frames until the client goes away"""
+        try:
+            while True:
+                await self.wakeup.wait()
+                self.wakeup.clear()
+                while self.frames or self.positions:
+                    # Pending positions are always newer than every queued frame
+                    if self.frames:
+                        payload = self.frames.popleft()
+                    else:
+                        payload = self._take_batch()
+                    await self.websocket.send(payload)
+                self.behind_since = None
+        except websockets.exceptions.ConnectionClosed:
+            pass
+        except asyncio.CancelledError:
+            pass
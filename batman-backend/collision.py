@@ -0,0 +1,195 @@
+"""Collision
+
+Predictive time-to-collision detection.
+
+Every tick each vehicle is given a short predicted trajectory: a straight
+segment from its current position along its velocity for ``horizon``
+seconds. Velocity comes from the reported heading and speed, or from the
+last two reports when a sender does not report them; a vehicle that did not
+report since the last tick keeps the velocity of its last report.
+
+Candidate pairs are found by sweep and prune over the bounding boxes of the
+swept segments, and the time and distance of closest approach are then
+computed for all candidates at once with NumPy. Pairs that get closer than
+``radius_m`` within the horizon are reported, soonest first. Like proximity
+alerts, a pair is only reported when it becomes a risk, not again on every
+tick it stays one. Work per tick is bounded by ``max_pairs`` so a pile-up of
+vehicles cannot stall the loop.
+"""
+
+import logging
+from typing import Dict, FrozenSet, Hashable, List, Sequence, Set
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_M = 6371e3
+
+
+class CollisionPredictor:
+    """Finds vehicle pairs on course to come within ``radius_m`` of each other.
+
+    Attributes
+    ----------
+    horizon : float
+        seconds of predicted motion checked every tick
+    radius_m : float
+        closest approach distance that counts as a collision risk
+    max_events : int
+        most severe risks returned per tick
+    max_pairs : int
+        candidate pairs evaluated per tick at most
+
+    Methods
+    -------
+    update(vehicle_ids, lats, lons, timestamps, now, headings, speeds)
+        predicts trajectories and returns the new collision risks, soonest first
+    """
+
+    def __init__(self, horizon: float = 10.0, radius_m: float = 10.0, max_events: int = 50,
+                 max_pairs: int = 1_000_000):
+        self.horizon = horizon
+        self.radius_m = radius_m
+        self.max_events = max_events
+        self.max_pairs = max_pairs
+        # Last reported (lat, lon, timestamp) of every vehicle, for velocity from recent motion
+        self.previous: Dict[Hashable, tuple] = {}
+        # Velocity from motion at each vehicle's last report, kept until it reports again
+        self.motion: Dict[Hashable, tuple] = {}
+        # Pairs at risk after the last update, so each risk is reported once
+        self.active: Set[FrozenSet[Hashable]] = set()
+
+    def _velocity_from_motion(self, vehicle_ids: Sequence[Hashable], lats: np.ndarray, lons: np.ndarray,
+                              timestamps: np.ndarray, missing: np.ndarray) -> np.ndarray:
+        """East/north velocity in m/s from each vehicle's previous report"""
+        velocity = np.zeros((len(vehicle_ids), 2))
+        for i in np.flatnonzero(missing):
+            vehicle_id = vehicle_ids[i]
+            previous = self.previous.get(vehicle_id)
+            if previous is None or timestamps[i] <= previous[2]:
+                # No new report since the last tick
+                velocity[i] = self.motion.get(vehicle_id, (0.0, 0.0))
+                continue
+            dt = timestamps[i] - previous[2]
+            velocity[i, 0] = np.radians(lons[i] - previous[1]) * np.cos(np.radians(lats[i])) * EARTH_RADIUS_M / dt
+            velocity[i, 1] = np.radians(lats[i] - previous[0]) * EARTH_RADIUS_M / dt
+            self.motion[vehicle_id] = (velocity[i, 0], velocity[i, 1])
+        return velocity
+
+    def update(self, vehicle_ids: Sequence[Hashable], lats, lons, timestamps, now: float,
+               headings=None, speeds=None) -> List[dict]:
+        """Predict every vehicle's trajectory and return the pairs that became a risk, soonest first.
+
+        ``headings`` (degrees from north) and ``speeds`` (m/s) may be None
+        or contain NaN for vehicles that do not report them.
+        """
+        vehicle_ids = list(vehicle_ids)
+        n = len(vehicle_ids)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        timestamps = np.broadcast_to(np.asarray(timestamps, dtype=np.float64), (n,))
+        headings = np.full(n, np.nan) if headings is None else np.asarray(headings, dtype=np.float64)
+        speeds = np.full(n, np.nan) if speeds is None else np.asarray(speeds, dtype=np.float64)
+
+        reported = ~(np.isnan(headings) | np.isnan(speeds))
+        velocity = self._velocity_from_motion(vehicle_ids, lats, lons, timestamps, ~reported)
+        bearing = np.radians(headings[reported])
+        velocity[reported, 0] = speeds[reported] * np.sin(bearing)
+        velocity[reported, 1] = speeds[reported] * np.cos(bearing)
+        previous = {}
+        for vehicle_id, lat, lon, t in zip(vehicle_ids, lats.tolist(), lons.tolist(), timestamps.tolist()):
+            last = self.previous.get(vehicle_id)
+            previous[vehicle_id] = (lat, lon, t) if last is None or t > last[2] else last
+        self.previous = previous
+        self.motion = {vehicle_id: v for vehicle_id, v in self.motion.items() if vehicle_id in previous}
+        if n < 2:
+            self.active = set()
+            return []
+
+        # Local metric plane around the fleet, plenty accurate over a city
+        lat0 = np.radians(lats.mean())
+        position = np.empty((n, 2))
+        position[:, 0] = np.radians(lons - lons.mean()) * np.cos(lat0) * EARTH_RADIUS_M
+        position[:, 1] = np.radians(lats - lats.mean()) * EARTH_RADIUS_M
+        # Bring every vehicle forward to the same instant
+        position += velocity * np.clip(now - timestamps, 0, self.horizon)[:, None]
+
+        end = position + velocity * self.horizon
+        half = self.radius_m / 2
+        low = np.minimum(position, end) - half
+        high = np.maximum(position, end) + half
+
+        first, second = self._sweep_and_prune(low, high)
+        if not len(first):
+            self.active = set()
+            return []
+
+        relative_position = position[second] - position[first]
+        relative_velocity = velocity[second] - velocity[first]
+        speed_squared = np.einsum("ij,ij->i", relative_velocity, relative_velocity)
+        closing = -np.einsum("ij,ij->i", relative_position, relative_velocity)
+        time_to_closest = np.divide(closing, speed_squared, out=np.zeros_like(closing), where=speed_squared > 0)
+        time_to_closest = np.clip(time_to_closest, 0, self.horizon)
+        closest = relative_position + relative_velocity * time_to_closest[:, None]
+        distance = np.hypot(closest[:, 0], closest[:, 1])
+
+        # Only pairs still approaching each other; vehicles parked side by side are proximity, not risk
+        at_risk = np.flatnonzero((distance < self.radius_m) & (closing > 0))
+        pairs = [frozenset((vehicle_ids[i], vehicle_ids[j]))
+                 for i, j in zip(first[at_risk].tolist(), second[at_risk].tolist())]
+        pair_of = dict(zip(at_risk.tolist(), pairs))
+        still = self.active.intersection(pairs)
+        at_risk = np.array([k for k, pair in pair_of.items() if pair not in self.active], dtype=np.int64)
+        if not len(at_risk):
+            self.active = still
+            return []
+        order = at_risk[np.lexsort((distance[at_risk], time_to_closest[at_risk]))][:self.max_events]
+        # Risks cut by max_events stay unreported, so they come out on a later tick
+        self.active = still | {pair_of[k] for k in order.tolist()}
+        return [{
+            "vehicles": [vehicle_ids[first[k]], vehicle_ids[second[k]]],
+            "time_to_closest": round(float(time_to_closest[k]), 2),
+            "distance": round(float(distance[k]), 1),
+        } for k in order]
+
+    def _sweep_and_prune(self, low: np.ndarray, high: np.ndarray):
+        """Index pairs whose boxes overlap.
+
+        Boxes are cut into horizontal strips about as tall as most boxes, and
+        sorted by (strip, x) so one sweep over x only pairs boxes sharing a
+        strip. A pair sharing several strips is kept only in the strip
+        holding the bottom of its overlap.
+        """
+        n = len(low)
+        y_min = low[:, 1].min()
+        strip_height = max(float(np.percentile(high[:, 1] - low[:, 1], 90)), self.radius_m)
+        strip_low = ((low[:, 1] - y_min) // strip_height).astype(np.int64)
+        span = ((high[:, 1] - y_min) // strip_height).astype(np.int64) - strip_low + 1
+        box = np.repeat(np.arange(n), span)
+        strip = np.repeat(strip_low, span) + np.arange(len(box)) - np.repeat(np.cumsum(span) - span, span)
+
+        # Offsetting x by strip keeps boxes of different strips from overlapping in the sweep
+        x_min = low[:, 0].min()
+        width = high[:, 0].max() - x_min + 1
+        key_low = strip * width + (low[box, 0] - x_min)
+        key_high = strip * width + (high[box, 0] - x_min)
+        order = np.argsort(key_low, kind="stable")
+        stop = np.searchsorted(key_low[order], key_high[order], side="right")
+        counts = np.maximum(stop - np.arange(len(order)) - 1, 0)
+        total = int(counts.sum())
+        if total > self.max_pairs:
+            logger.warning(f"{total} collision candidates, only checking the first {self.max_pairs}")
+            counts = np.where(np.cumsum(counts) <= self.max_pairs, counts, 0)
+            total = int(counts.sum())
+        if not total:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+
+        i = np.repeat(np.arange(len(order)), counts)
+        j = i + 1 + np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+        i, j = order[i], order[j]
+        first, second = box[i], box[j]
+        overlap_y = (low[first, 1] <= high[second, 1]) & (low[second, 1] <= high[first, 1])
+        reported_in = ((np.maximum(low[first, 1], low[second, 1]) - y_min) // strip_height).astype(np.int64)
+        keep = overlap_y & (strip[i] == reported_in) & (first != second)
+        return first[keep], second[keep]
@@ -0,0 +1,94 @@
+"""Freshness
+
+Ordering and expiry of mesh position updates.
+
+batman-adv may deliver a broadcast late, twice, or after a newer one from
+the same node. ``SequenceTracker`` keeps the highest sequence number accepted
+from every source and rejects anything that is not newer, so a stale packet
+can never move a vehicle backwards.
+
+``ExpiryQueue`` is a min-heap of last-heard times. Touching a vehicle pushes
+a new entry and leaves the old one behind to be skipped when it reaches the
+top, so both touching and expiring are O(log n). The heap is rebuilt from the
+live entries whenever the skipped ones outnumber them.
+"""
+
+import heapq
+from typing import Dict, Hashable, List, Optional, Tuple
+
+SEQ_MODULUS = 1 << 32
+SEQ_HALF = 1 << 31
+
+
+class SequenceTracker:
+    """Rejects duplicate and out-of-order records per source.
+
+    Sequence numbers are compared with serial number arithmetic, so the u32
+    counter of the wire format may wrap. A source that was silent for longer
+    than ``reset_after`` seconds is assumed to have restarted and its next
+    sequence number is accepted whatever it is.
+    """
+
+    def __init__(self, reset_after: float = 30.0):
+        self.reset_after = reset_after
+        self.last: Dict[Hashable, Tuple[int, float]] = {}
+        self.duplicates = 0
+        self.out_of_order = 0
+
+    def accept(self, source: Hashable, seq: Optional[int], now: float) -> bool:
+        """Whether a record is newer than everything accepted from its source"""
+        if seq is None:
+            # Legacy JSON senders and binary senders without a counter (seq 0 on the wire)
+            return True
+        last = self.last.get(source)
+        if last is not None and now - last[1] < self.reset_after:
+            delta = (seq - last[0]) % SEQ_MODULUS
+            if delta == 0:
+                self.duplicates += 1
+                return False
+            if delta >= SEQ_HALF:
+                self.out_of_order += 1
+                return False
+        self.last[source] = (seq, now)
+        return True
+
+    def forget(self, source: Hashable):
+        self.last.pop(source, None)
+
+
+class ExpiryQueue:
+    """Finds vehicles that have not been heard from within a time to live"""
+
+    def __init__(self, ttl: float = 30.0):
+        self.ttl = ttl
+        self.last_seen: Dict[Hashable, float] = {}
+        self.heap: List[Tuple[float, int, Hashable]] = []
+        # Tie breaker so vehicle ids never have to be comparable
+        self.counter = 0
+
+    def __len__(self) -> int:
+        return len(self.last_seen)
+
+    def touch(self, vehicle_id: Hashable, now: float):
+        self.last_seen[vehicle_id] = now
+        self.counter += 1
+        heapq.heappush(self.heap, (now, self.counter, vehicle_id))
+        if len(self.heap) > 2 * len(self.last_seen) + 64:
+            self._compact()
+
+    def expire(self, now: float) -> List[Hashable]:
+        """Remove and return every vehicle last heard more than ``ttl`` seconds ago"""
+        cutoff = now - self.ttl
+        expired = []
+        while self.heap and self.heap[0][0] < cutoff:
+            seen, _, vehicle_id = heapq.heappop(self.heap)
+            # Entries superseded by a later touch are skipped
+            if self.last_seen.get(vehicle_id) == seen:
+                del self.last_seen[vehicle_id]
+                expired.append(vehicle_id)
+        return expired
+
+    def _compact(self):
+        self.heap = [(seen, i, vehicle_id) for i, (vehicle_id, seen) in enumerate(self.last_seen.items())]
+        heapq.heapify(self.heap)
+        self.counter = len(self.heap)
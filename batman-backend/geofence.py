@@ -0,0 +1,225 @@
+"""Geofence
+
+Circle and polygon zones, such as school or hazard zones, and the vehicles
+inside them.
+
+Fences are indexed in a uniform grid like ``ProximityIndex``: each fence is
+listed in every cell its bounding box touches. Checking a batch of positions
+finds each vehicle's cell and tests every fence only against the vehicles in
+its cells, as one vectorized test per fence, so the cost grows with the
+number of vehicles near fences instead of vehicles times fences. The few
+fences spanning more than ``MAX_FENCE_CELLS`` cells are tested against every
+vehicle instead of being listed in all of them.
+
+The fences each vehicle is inside are remembered, so an enter or exit event
+is reported once per crossing rather than on every update.
+"""
+
+import math
+from typing import Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+from proximity import METERS_PER_DEGREE_LAT, haversine_many
+
+SHAPES = ("circle", "polygon")
+# Fences covering more cells than this are checked against every vehicle
+MAX_FENCE_CELLS = 4096
+# Row and column of a cell packed into one int64, so cell lookups vectorize
+CELL_KEY_SHIFT = 2 ** 32
+
+
+class Geofence:
+    """One circle or polygon zone.
+
+    Circles have a ``center`` [lat, lon] and a ``radius`` in meters, polygons
+    a ring of [lat, lon] ``points``. Polygon edges are straight in degrees,
+    which is exact enough for zones a few kilometres across.
+    """
+
+    def __init__(self, fence_id: Hashable, shape: str, name: Optional[str] = None,
+                 center: Optional[List[float]] = None, radius: Optional[float] = None,
+                 points: Optional[List[List[float]]] = None):
+        if shape not in SHAPES:
+            raise ValueError(f"Unknown geofence shape {shape}, expected one of {', '.join(SHAPES)}")
+        self.id = fence_id
+        self.shape = shape
+        self.name = name
+        if shape == "circle":
+            if center is None or radius is None or float(radius) <= 0:
+                raise ValueError("A circle geofence needs a center and a positive radius")
+            self.center = [float(center[0]), float(center[1])]
+            self.radius = float(radius)
+            dlat = self.radius / METERS_PER_DEGREE_LAT
+            dlon = dlat / max(math.cos(math.radians(abs(self.center[0]) + dlat)), 1e-6)
+            self.bounds = (self.center[0] - dlat, self.center[1] - dlon, self.center[0] + dlat, self.center[1] + dlon)
+        else:
+            if points is None or len(points) < 3:
+                raise ValueError("A polygon geofence needs at least three points")
+            self.points = np.array([[float(lat), float(lon)] for lat, lon, *_ in points], dtype=np.float64)
+            # Edges as columns, start and end of each, for testing many points at once
+            self.edge_start = self.points[:, :, None]
+            self.edge_end = np.roll(self.points, -1, axis=0)[:, :, None]
+            south, west = self.points.min(axis=0)
+            north, east = self.points.max(axis=0)
+            self.bounds = (float(south), float(west), float(north), float(east))
+
+    @classmethod
+    def from_message(cls, fence_id: Hashable, data: dict) -> "Geofence":
+        """Fence from an ``add_geofence`` client message"""
+        return cls(fence_id, data.get("shape", "circle"), data.get("name"), data.get("center"),
+                   data.get("radius"), data.get("points"))
+
+    def contains(self, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+        """Whether each point is inside the fence"""
+        if self.shape == "circle":
+            return haversine_many(self.center[0], self.center[1], lats, lons) <= self.radius
+        # Even-odd rule: count the edges a ray running east from each point crosses
+        lat1, lon1 = self.edge_start[:, 0], self.edge_start[:, 1]
+        lat2, lon2 = self.edge_end[:, 0], self.edge_end[:, 1]
+        spans = (lat1 > lats) != (lat2 > lats)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            crossing_lon = lon1 + (lats - lat1) * (lon2 - lon1) / (lat2 - lat1)
+        return np.count_nonzero(spans & (lons < crossing_lon), axis=0) % 2 == 1
+
+    def to_dict(self) -> dict:
+        fence = {"id": self.id, "shape": self.shape, "name": self.name}
+        if self.shape == "circle":
+            fence.update(center=self.center, radius=self.radius)
+        else:
+            fence["points"] = self.points.tolist()
+        return fence
+
+
+class GeofenceIndex:
+    """Grid index of geofences that reports vehicles entering and leaving them.
+
+    Attributes
+    ----------
+    cell_m : float
+        side of a grid cell in meters of latitude
+    fences : dict
+        every fence by id
+    inside : dict
+        ids of the fences each vehicle is currently inside
+
+    Methods
+    -------
+    add(fence)
+        indexes a fence, replacing one with the same id
+    remove(fence_id)
+        drops a fence
+    update_many(vehicle_ids, lats, lons)
+        checks new positions and returns the fences entered and exited
+    remove_vehicle(vehicle_id)
+        forgets a vehicle
+    """
+
+    def __init__(self, cell_m: float = 250.0):
+        self.cell_m = cell_m
+        self.cell_deg = cell_m / METERS_PER_DEGREE_LAT
+        self.fences: Dict[Hashable, Geofence] = {}
+        self.cells: Dict[int, Set[Hashable]] = {}
+        self.fence_cells: Dict[Hashable, List[int]] = {}
+        self.large: Set[Hashable] = set()
+        self.inside: Dict[Hashable, Set[Hashable]] = {}
+        self.members: Dict[Hashable, Set[Hashable]] = {}
+        # Sorted keys of the occupied cells, rebuilt after fences change
+        self._cell_keys: Optional[np.ndarray] = None
+
+    def _cell_range(self, fence: Geofence) -> Tuple[range, range]:
+        south, west, north, east = fence.bounds
+        return (range(math.floor(south / self.cell_deg), math.floor(north / self.cell_deg) + 1),
+                range(math.floor(west / self.cell_deg), math.floor(east / self.cell_deg) + 1))
+
+    def add(self, fence: Geofence):
+        """Index a fence; vehicles already inside it are reported on their next update"""
+        self.remove(fence.id)
+        self.fences[fence.id] = fence
+        self.members[fence.id] = set()
+        rows, cols = self._cell_range(fence)
+        if len(rows) * len(cols) > MAX_FENCE_CELLS:
+            self.large.add(fence.id)
+            return
+        keys = [row * CELL_KEY_SHIFT + col for row in rows for col in cols]
+        for key in keys:
+            self.cells.setdefault(key, set()).add(fence.id)
+        self.fence_cells[fence.id] = keys
+        self._cell_keys = None
+
+    def remove(self, fence_id: Hashable) -> bool:
+        """Drop a fence; vehicles inside it are forgotten without exit events"""
+        if self.fences.pop(fence_id, None) is None:
+            return False
+        self.large.discard(fence_id)
+        for key in self.fence_cells.pop(fence_id, []):
+            members = self.cells[key]
+            members.discard(fence_id)
+            if not members:
+                del self.cells[key]
+        for vehicle_id in self.members.pop(fence_id, set()):
+            fences = self.inside[vehicle_id]
+            fences.discard(fence_id)
+            if not fences:
+                del self.inside[vehicle_id]
+        self._cell_keys = None
+        return True
+
+    def remove_vehicle(self, vehicle_id: Hashable):
+        for fence_id in self.inside.pop(vehicle_id, set()):
+            self.members[fence_id].discard(vehicle_id)
+
+    def update_many(self, vehicle_ids: Iterable[Hashable], lats, lons) -> Tuple[List[tuple], List[tuple]]:
+        """Check one new position per vehicle; ids must be unique.
+
+        Returns the (vehicle_id, fence_id) pairs that entered and the ones
+        that exited.
+        """
+        vehicle_ids = list(vehicle_ids)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+
+        # Vehicles grouped by the fences listed in their cell; unknown positions are in no fence
+        located = np.flatnonzero(~np.isnan(lats) & ~np.isnan(lons))
+        candidates: Dict[Hashable, List[int]] = {}
+        if self.cells and len(located):
+            if self._cell_keys is None:
+                self._cell_keys = np.array(sorted(self.cells), dtype=np.int64)
+            rows = located
+            keys = (np.floor(lats[rows] / self.cell_deg).astype(np.int64) * CELL_KEY_SHIFT
+                    + np.floor(lons[rows] / self.cell_deg).astype(np.int64))
+            hits = np.isin(keys, self._cell_keys)
+            for i, key in zip(rows[hits].tolist(), keys[hits].tolist()):
+                for fence_id in self.cells[key]:
+                    candidates.setdefault(fence_id, []).append(i)
+        for fence_id in self.large:
+            candidates[fence_id] = located
+
+        now: Dict[int, Set[Hashable]] = {}
+        for fence_id, rows in candidates.items():
+            rows = np.asarray(rows, dtype=np.int64)
+            for i in rows[self.fences[fence_id].contains(lats[rows], lons[rows])].tolist():
+                now.setdefault(i, set()).add(fence_id)
+
+        # Only vehicles inside a fence before or now can have crossed one
+        touched = set(now)
+        if self.inside:
+            index = {vehicle_id: i for i, vehicle_id in enumerate(vehicle_ids)}
+            touched.update(index[vehicle_id] for vehicle_id in self.inside if vehicle_id in index)
+
+        entered, exited = [], []
+        for i in touched:
+            vehicle_id = vehicle_ids[i]
+            fences = now.get(i, set())
+            previous = self.inside.get(vehicle_id, set())
+            for fence_id in fences - previous:
+                self.members[fence_id].add(vehicle_id)
+                entered.append((vehicle_id, fence_id))
+            for fence_id in previous - fences:
+                self.members[fence_id].discard(vehicle_id)
+                exited.append((vehicle_id, fence_id))
+            if fences:
+                self.inside[vehicle_id] = fences
+            else:
+                self.inside.pop(vehicle_id, None)
+        return entered, exited
@@ -0,0 +1,262 @@
+"""Heatmap
+
+Vehicle density overlay tiles.
+
+Recent positions are binned into a density grid at every zoom level from
+``min_zoom`` to ``max_zoom``. Each tile of a grid is ``cells`` by ``cells``
+counts, one count per position sample whose Web Mercator pixel falls into
+the cell. Grids are kept sparse, as a sorted array of occupied cell ids per
+zoom level, numbered tile by tile so the cells of one tile are contiguous.
+
+Updates are incremental: each one is given only the samples received since
+the previous update, adds their cells to the counts and subtracts the cells
+of the samples that fell out of the window, which the heatmap keeps for
+that purpose. Only tiles whose counts moved are regrouped and lose their
+rendered image. Images are rendered when first requested, by mapping log
+scaled counts through a colour ramp and encoding the result as PNG, so the
+work per update follows how many samples arrived and expired rather than
+how many are in the window.
+
+Tiles use the XYZ scheme of Leaflet and the ``bangalore_tiles`` directory
+and are served by ``tile_server.TileServer`` at ``/heatmap/{z}/{x}/{y}.png``.
+"""
+
+import struct
+import threading
+import uuid
+import zlib
+from collections import deque
+from typing import Deque, Dict, Optional, Tuple
+
+import numpy as np
+
+from viewport import MAX_LATITUDE, TILE_SIZE
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# (position on the ramp, RGBA): transparent for empty cells, then blue through red
+COLOR_STOPS = (
+    (0.0, (0, 0, 255, 0)),
+    (0.1, (0, 90, 255, 110)),
+    (0.4, (0, 200, 80, 150)),
+    (0.7, (255, 210, 0, 185)),
+    (1.0, (220, 0, 0, 215)),
+)
+
+TileKey = Tuple[int, int, int]
+
+
+def mercator_pixels(lats: np.ndarray, lons: np.ndarray, zoom: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Vectorized ``viewport.lat_lon_to_pixel``"""
+    lat_rad = np.radians(np.clip(lats, -MAX_LATITUDE, MAX_LATITUDE))
+    n = TILE_SIZE * 2.0 ** zoom
+    x = (lons + 180.0) / 360.0 * n
+    y = (1.0 - np.arcsinh(np.tan(lat_rad)) / np.pi) / 2.0 * n
+    return x, y
+
+
+def color_ramp(stops=COLOR_STOPS) -> np.ndarray:
+    """256 entry RGBA lookup table interpolated between colour stops"""
+    positions = [position for position, _ in stops]
+    colors = np.array([color for _, color in stops], dtype=np.float64)
+    levels = np.linspace(0.0, 1.0, 256)
+    return np.stack([np.interp(levels, positions, colors[:, channel]) for channel in range(4)],
+                    axis=1).round().astype(np.uint8)
+
+
+def encode_png(rgba: np.ndarray, level: int = 6) -> bytes:
+    """Encode an (height, width, 4) uint8 array as an RGBA PNG"""
+    height, width, _ = rgba.shape
+    # Every scanline starts with its filter type, 0 for none
+    raw = np.zeros((height, width * 4 + 1), dtype=np.uint8)
+    raw[:, 1:] = rgba.reshape(height, width * 4)
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    header = struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)
+    return (PNG_SIGNATURE + chunk(b"IHDR", header) + chunk(b"IDAT", zlib.compress(raw.tobytes(), level))
+            + chunk(b"IEND", b""))
+
+
+class DensityHeatmap:
+    """Per-zoom vehicle density grids rendered into cached overlay tiles.
+
+    Attributes
+    ----------
+    min_zoom, max_zoom : int
+        zoom levels a grid is kept for; clients scale ``max_zoom`` tiles up
+    cells : int
+        grid cells along each side of a tile, a divisor of 256
+    window : float
+        seconds of position history the density is built from
+    saturation : float
+        samples in one ``max_zoom`` cell drawn at full intensity
+
+    Methods
+    -------
+    update(timestamps, lats, lons, now)
+        adds new samples, expires old ones and invalidates the tiles whose counts changed
+    get_tile(z, x, y)
+        returns (etag, png) for a tile, rendering it if needed
+    """
+
+    def __init__(self, min_zoom: int = 10, max_zoom: int = 18, cells: int = 32, window: float = 60.0,
+                 saturation: float = 30.0):
+        if TILE_SIZE % cells:
+            raise ValueError(f"cells must divide the tile size {TILE_SIZE}")
+        self.min_zoom = min_zoom
+        self.max_zoom = max_zoom
+        self.cells = cells
+        self.cell_px = TILE_SIZE // cells
+        self.window = window
+        self.saturation = saturation
+        self.lut = color_ramp()
+        # Occupied cell ids, tile index * cells**2 + cell within the tile, and their counts per zoom
+        self.cell_ids = {zoom: np.zeros(0, dtype=np.int64) for zoom in range(min_zoom, max_zoom + 1)}
+        self.cell_counts = {zoom: np.zeros(0, dtype=np.int64) for zoom in range(min_zoom, max_zoom + 1)}
+        # Batches of counted samples (timestamps, lats, lons), each sorted by time, to subtract once expired
+        self.samples: Deque[Tuple[np.ndarray, np.ndarray, np.ndarray]] = deque()
+        # Occupied cells (flat index within the tile) and their counts for every occupied tile
+        self.grids: Dict[TileKey, Tuple[np.ndarray, np.ndarray]] = {}
+        # Bumped whenever a tile changes, so the ETag of an unchanged tile survives updates
+        self.generations: Dict[TileKey, int] = {}
+        self.generation = 0
+        # Keeps ETags of a restarted server from matching images browsers cached from the last run
+        self.epoch = uuid.uuid4().hex[:8]
+        self.rendered: Dict[TileKey, Tuple[str, bytes]] = {}
+        self.empty = ("empty", encode_png(np.zeros((TILE_SIZE, TILE_SIZE, 4), dtype=np.uint8)))
+        self.lock = threading.Lock()
+        self.invalidated = 0
+        self.renders = 0
+
+    def _cell_ids(self, lats: np.ndarray, lons: np.ndarray, zoom: int) -> np.ndarray:
+        """Tile ordered cell id of every sample at one zoom level"""
+        x, y = mercator_pixels(lats, lons, zoom)
+        world_cells = self.cells << zoom
+        cx = np.clip((x // self.cell_px).astype(np.int64), 0, world_cells - 1)
+        cy = np.clip((y // self.cell_px).astype(np.int64), 0, world_cells - 1)
+        tiles = (cy // self.cells) * (1 << zoom) + cx // self.cells
+        return tiles * self.cells ** 2 + (cy % self.cells) * self.cells + cx % self.cells
+
+    def _apply(self, zoom: int, added: np.ndarray, removed: np.ndarray) -> np.ndarray:
+        """Count added cell ids, uncount removed ones and return the tile indices whose counts changed"""
+        delta_ids, inverse = np.unique(np.concatenate((added, removed)), return_inverse=True)
+        weights = np.concatenate((np.ones(len(added)), -np.ones(len(removed))))
+        delta = np.bincount(inverse, weights=weights, minlength=len(delta_ids)).astype(np.int64)
+        moved = delta != 0
+        delta_ids, delta = delta_ids[moved], delta[moved]
+        if not len(delta_ids):
+            return delta_ids
+
+        ids, counts = self.cell_ids[zoom], self.cell_counts[zoom]
+        at = np.searchsorted(ids, delta_ids)
+        found = at < len(ids)
+        found[found] = ids[at[found]] == delta_ids[found]
+        counts[at[found]] += delta[found]
+        ids = np.insert(ids, at[~found], delta_ids[~found])
+        counts = np.insert(counts, at[~found], delta[~found])
+        occupied = counts > 0
+        self.cell_ids[zoom], self.cell_counts[zoom] = ids[occupied], counts[occupied]
+        return np.unique(delta_ids // self.cells ** 2)
+
+    def _expire(self, cutoff: float) -> Tuple[np.ndarray, np.ndarray]:
+        """Take the counted samples older than ``cutoff``"""
+        lats, lons, kept = [], [], deque()
+        for timestamps, batch_lats, batch_lons in self.samples:
+            split = int(np.searchsorted(timestamps, cutoff))
+            if split:
+                lats.append(batch_lats[:split])
+                lons.append(batch_lons[:split])
+            if split < len(timestamps):
+                kept.append((timestamps[split:], batch_lats[split:], batch_lons[split:]))
+        self.samples = kept
+        if not lats:
+            return np.zeros(0), np.zeros(0)
+        return np.concatenate(lats), np.concatenate(lons)
+
+    @property
+    def sample_count(self) -> int:
+        """Samples currently counted in the grids"""
+        return sum(len(timestamps) for timestamps, _, _ in self.samples)
+
+    def update(self, timestamps, lats, lons, now: float) -> int:
+        """Count samples received since the last update, drop expired ones, and return the number
+        of tiles that changed.
+
+        Samples already older than the window are ignored. Safe to call from a worker thread while
+        tiles are being served, but not from two threads at once.
+        """
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        cutoff = now - self.window
+        valid = np.isfinite(lats) & np.isfinite(lons) & (timestamps >= cutoff)
+        order = np.argsort(timestamps[valid], kind="stable")
+        timestamps, lats, lons = timestamps[valid][order], lats[valid][order], lons[valid][order]
+        expired_lats, expired_lons = self._expire(cutoff)
+        if len(timestamps):
+            self.samples.append((timestamps, lats, lons))
+
+        grids: Dict[TileKey, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+        if len(lats) or len(expired_lats):
+            cells_per_tile = self.cells ** 2
+            for zoom in range(self.min_zoom, self.max_zoom + 1):
+                changed = self._apply(zoom, self._cell_ids(lats, lons, zoom),
+                                      self._cell_ids(expired_lats, expired_lons, zoom))
+                if not len(changed):
+                    continue
+                ids, counts = self.cell_ids[zoom], self.cell_counts[zoom]
+                starts = np.searchsorted(ids, changed * cells_per_tile)
+                ends = np.searchsorted(ids, (changed + 1) * cells_per_tile)
+                for tile, start, end in zip(changed.tolist(), starts.tolist(), ends.tolist()):
+                    ty, tx = divmod(tile, 1 << zoom)
+                    grids[(zoom, tx, ty)] = ((ids[start:end] - tile * cells_per_tile).astype(np.uint16),
+                                             counts[start:end].astype(np.uint32)) if end > start else None
+
+        with self.lock:
+            for key, grid in grids.items():
+                self.rendered.pop(key, None)
+                if grid is None:
+                    self.grids.pop(key, None)
+                    self.generations.pop(key, None)
+                else:
+                    self.grids[key] = grid
+                    self.generation += 1
+                    self.generations[key] = self.generation
+        self.invalidated += len(grids)
+        return len(grids)
+
+    def render(self, key: TileKey, local: np.ndarray, counts: np.ndarray) -> bytes:
+        zoom = key[0]
+        density = np.zeros(self.cells * self.cells, dtype=np.float32)
+        density[local] = counts
+        density = density.reshape(self.cells, self.cells)
+        # A cell at a lower zoom covers 4x the area per level; scaling saturation by 2x per level
+        # keeps single busy streets visible zoomed out while whole busy districts still stand out
+        saturation = self.saturation * 2.0 ** (self.max_zoom - zoom)
+        intensity = np.log1p(density) / np.log1p(saturation)
+        levels = np.where(density > 0, np.clip(intensity * 255, 1, 255), 0).astype(np.uint8)
+        pixels = self.lut[levels].repeat(self.cell_px, axis=0).repeat(self.cell_px, axis=1)
+        return encode_png(pixels)
+
+    def get_tile(self, z: int, x: int, y: int) -> Optional[Tuple[str, bytes]]:
+        """Return (etag, png) for a tile; tiles without vehicles are transparent"""
+        if not self.min_zoom <= z <= self.max_zoom:
+            return None
+        key = (z, x, y)
+        with self.lock:
+            entry = self.rendered.get(key)
+            grid = self.grids.get(key)
+            generation = self.generations.get(key)
+        if entry is not None:
+            return entry
+        if grid is None:
+            return self.empty
+        entry = (f"{self.epoch}-{generation}", self.render(key, *grid))
+        self.renders += 1
+        with self.lock:
+            # Only keep it if no update replaced the grid while rendering
+            if self.generations.get(key) == generation:
+                self.rendered[key] = entry
+        return entry
@@ -0,0 +1,138 @@
+"""History
+
+Fixed-memory trajectory store. Every vehicle owns one row of preallocated
+NumPy arrays used as a ring buffer of its last ``capacity`` samples, so the
+memory used per vehicle is constant and known up front:
+``capacity * 28`` bytes (timestamp, lat, lon as float64 and speed as float32).
+"""
+
+from typing import Dict, Hashable, Iterable, List, Optional
+
+import numpy as np
+
+
+class TrajectoryHistory:
+    """Per-vehicle ring buffers of (timestamp, lat, lon, speed) samples.
+
+    Attributes
+    ----------
+    capacity : int
+        samples kept per vehicle; older samples are overwritten
+    slots : dict
+        row index of every vehicle in the arrays
+
+    Methods
+    -------
+    append(vehicle_id, timestamp, lat, lon, speed)
+        records one sample
+    append_many(vehicle_ids, timestamps, lats, lons, speeds)
+        records one sample for each of many vehicles
+    query(vehicle_ids, start, end)
+        returns the samples of each vehicle inside a time window
+    """
+
+    def __init__(self, capacity: int = 600, initial_vehicles: int = 64):
+        self.capacity = capacity
+        self.slots: Dict[Hashable, int] = {}
+        self.slot_ids: List[Hashable] = []
+        self._allocate(initial_vehicles)
+
+    def _allocate(self, rows: int):
+        def grow(old: Optional[np.ndarray], dtype, fill) -> np.ndarray:
+            new = np.full((rows, self.capacity), fill, dtype=dtype)
+            if old is not None:
+                new[:len(old)] = old
+            return new
+
+        self.timestamps = grow(getattr(self, "timestamps", None), np.float64, np.nan)
+        self.lats = grow(getattr(self, "lats", None), np.float64, np.nan)
+        self.lons = grow(getattr(self, "lons", None), np.float64, np.nan)
+        self.speeds = grow(getattr(self, "speeds", None), np.float32, np.nan)
+        head = np.zeros(rows, dtype=np.int64)
+        count = np.zeros(rows, dtype=np.int64)
+        if hasattr(self, "head"):
+            head[:len(self.head)] = self.head
+            count[:len(self.count)] = self.count
+        self.head, self.count = head, count
+
+    def _slot(self, vehicle_id: Hashable) -> int:
+        slot = self.slots.get(vehicle_id)
+        if slot is None:
+            slot = len(self.slots)
+            if slot == len(self.head):
+                self._allocate(2 * len(self.head))
+            self.slots[vehicle_id] = slot
+            self.slot_ids.append(vehicle_id)
+        return slot
+
+    @property
+    def nbytes(self) -> int:
+        return sum(array.nbytes for array in (self.timestamps, self.lats, self.lons, self.speeds, self.head, self.count))
+
+    def append(self, vehicle_id: Hashable, timestamp: float, lat: float, lon: float,
+               speed: Optional[float] = None):
+        slot = self._slot(vehicle_id)
+        i = self.head[slot]
+        self.timestamps[slot, i] = timestamp
+        self.lats[slot, i] = lat
+        self.lons[slot, i] = lon
+        self.speeds[slot, i] = np.nan if speed is None else speed
+        self.head[slot] = (i + 1) % self.capacity
+        self.count[slot] = min(self.count[slot] + 1, self.capacity)
+
+    def append_many(self, vehicle_ids: Iterable[Hashable], timestamps, lats, lons, speeds=None):
+        """Vectorized append of one sample per vehicle; ids must be unique"""
+        slots = np.array([self._slot(vehicle_id) for vehicle_id in vehicle_ids], dtype=np.int64)
+        if not len(slots):
+            return
+        columns = self.head[slots]
+        self.timestamps[slots, columns] = timestamps
+        self.lats[slots, columns] = lats
+        self.lons[slots, columns] = lons
+        self.speeds[slots, columns] = np.nan if speeds is None else speeds
+        self.head[slots] = (columns + 1) % self.capacity
+        self.count[slots] = np.minimum(self.count[slots] + 1, self.capacity)
+
+    def remove(self, vehicle_id: Hashable):
+        """Forget a vehicle's samples; its row is reused by the next new vehicle"""
+        slot = self.slots.pop(vehicle_id, None)
+        if slot is None:
+            return
+        last = len(self.slots)
+        moved = self.slot_ids.pop()
+        if slot != last:
+            # Move the last row into the freed one so rows stay contiguous
+            for array in (self.timestamps, self.lats, self.lons, self.speeds, self.head, self.count):
+                array[slot] = array[last]
+            self.slots[moved] = slot
+            self.slot_ids[slot] = moved
+        # Clear the vacated row, so a vehicle given it next starts without the old samples
+        for array in (self.timestamps, self.lats, self.lons, self.speeds):
+            array[last] = np.nan
+        self.count[last] = 0
+        self.head[last] = 0
+
+    def query(self, vehicle_ids: Optional[Iterable[Hashable]] = None, start: float = float("-inf"),
+              end: float = float("inf")) -> List[dict]:
+        """Samples between ``start`` and ``end`` for each vehicle, oldest first, in columnar form"""
+        if vehicle_ids is None:
+            vehicle_ids = list(self.slots)
+        result = []
+        for vehicle_id in vehicle_ids:
+            slot = self.slots.get(vehicle_id)
+            if slot is None:
+                continue
+            count = self.count[slot]
+            order = (self.head[slot] - count + np.arange(count)) % self.capacity
+            timestamps = self.timestamps[slot, order]
+            window = order[(timestamps >= start) & (timestamps <= end)]
+            speeds = self.speeds[slot, window]
+            result.append({
+                "id": vehicle_id,
+                "timestamps": self.timestamps[slot, window].tolist(),
+                "lat": self.lats[slot, window].tolist(),
+                "lon": self.lons[slot, window].tolist(),
+                # Unknown speeds are NaN in the buffer, which JSON cannot carry
+                "speed": [None if np.isnan(s) else round(float(s), 2) for s in speeds],
+            })
+        return result
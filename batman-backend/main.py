@@ -1,12 +1,33 @@
+import argparse
 import asyncio
 import json
+import numpy as np
 import websockets
 import logging
+import multiprocessing
+import socket
 import ssl
 import threading
+import time
 from broadcast import Broadcast
+from capture import CaptureWriter, Replayer
+from client_queue import ClientQueue
+from collision import CollisionPredictor
+from dead_reckoning import extrapolate
+from freshness import ExpiryQueue, SequenceTracker
+from geofence import Geofence, GeofenceIndex
+from heatmap import DensityHeatmap
+from history import TrajectoryHistory
+from metrics import DEPTH_BUCKETS, MetricsRegistry, MetricsServer, SamplingProfiler, monitor_event_loop
+from proximity import ProximityIndex
+from shared_state import FrameRing, PositionTable
+from state import SNAPSHOT_GRACE, VersionedState
+from tile_server import TileServer
+from vehicle_table import VehicleTable
+from viewport import ViewportIndex
+from wire import VehicleRecord, decode_datagram, encode_json
 from datetime import datetime
-from typing import Set, Dict
+from typing import Dict, List, Optional
 
 # Set up logging
 logging.basicConfig(
@@ -15,84 +36,615 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-vehicle_positions = {}
+# Worker mode: client commands a worker hands to the ingest process arrive on the mesh port with this prefix
+COMMAND_MAGIC = b"VC"
+FORWARDED_COMMANDS = ("add_geofence", "remove_geofence", "request_geofences")
 
-async def recv_broadcasts_bg():
-    bdct = Broadcast()
-
-    while True:
-        data, addr = bdct.rxBroadcast(); 
-        if data != -1:
-            parsed_data = json.loads(data)
-            v_id = parsed_data.get("id")
-            if v_id or addr:
-                lat = parsed_data.get("lat")
-                long = parsed_data.get("long")
-                vehicle_positions[v_id or addr] = (lat, long) 
 
 class MapWebSocketServer:
-    def __init__(self, host: str = "localhost", port: int = 8765):
+    def __init__(self, host: str = "localhost", port: int = 8765, proximity_radius: float = 50.0,
+                 batch_updates: bool = True, broadcast_port: int = 1200, use_ssl: bool = True,
+                 history_capacity: int = 600, gap_fill_after: float = 1.5, max_extrapolation: float = 20.0,
+                 vehicle_ttl: float = 30.0, metrics_port: Optional[int] = None,
+                 capture_path: Optional[str] = None, heatmap_port: Optional[int] = None,
+                 heatmap_interval: float = 5.0, shared_table: Optional[PositionTable] = None,
+                 shared_events: Optional[FrameRing] = None, worker: bool = False):
         self.host = host
         self.port = port
-        self.connected_clients: Set[websockets.WebSocketServerProtocol] = set()
+        self.use_ssl = use_ssl
+        self.stats = {"datagrams_received": 0, "datagrams_dropped": 0, "records_ingested": 0, "vehicles_expired": 0}
+        self.broadcast_port = broadcast_port
+        self.bdct = None
+        self.connected_clients: Dict[websockets.WebSocketServerProtocol, ClientQueue] = {}
+        self.proximity = ProximityIndex(radius_m=proximity_radius)
+        self.viewports = ViewportIndex()
+        # In worker mode the ingest process publishes into shared_table and shared_events and
+        # does not serve clients; workers serve clients from them and do not touch the mesh
+        self.shared_table = shared_table
+        self.shared_events = shared_events
+        self.worker = worker
+        self.publishing = shared_table is not None and not worker
+        self.state = VersionedState(epoch=shared_table.epoch if shared_table else None)
+        # Clients owed a snapshot, with the time after which it is sent unasked
+        self.pending_snapshots: Dict[websockets.WebSocketServerProtocol, float] = {}
+        self.collisions = CollisionPredictor()
+        # Zones added by clients; vehicles that moved are checked against them every tick
+        self.geofences = GeofenceIndex()
+        self.next_geofence_id = 1
+        # Set when a fence was added, so vehicles that did not move are checked against it too
+        self.geofence_rescan = False
+        # Worker mode: latest geofences frame the ingest process published, for request_geofences
+        self.geofences_frame: Optional[str] = None
+        self.history = TrajectoryHistory(capacity=history_capacity)
+        self.sequences = SequenceTracker(reset_after=vehicle_ttl)
+        # Vehicles not heard from for vehicle_ttl seconds are dropped and clients told they left
+        self.expiry = ExpiryQueue(ttl=vehicle_ttl)
+        # When enabled, each tick sends one position_batch frame with only the vehicles that moved
+        self.batch_updates = batch_updates
+        # Latest position, motion and measurement time of every vehicle, and which moved since the last tick
+        self.vehicles = VehicleTable()
+        # Density overlay tiles, updated with the samples received every heatmap_interval seconds
+        self.heatmap_port = heatmap_port
+        self.heatmap = DensityHeatmap() if heatmap_port is not None else None
+        self.heatmap_interval = heatmap_interval
+        self.heatmap_due = 0.0
+        # (timestamp, lat, lon) of every position stored since the last heatmap update
+        self.heatmap_samples: List[tuple] = []
+        self.metrics_port = metrics_port
+        self.setup_metrics()
+        # Every received datagram is appended here for later replay
+        self.capture = CaptureWriter(capture_path) if capture_path else None
+        # Senders with a transmit policy skip packets receivers can dead reckon. Vehicles
+        # silent for longer than gap_fill_after are extrapolated, up to max_extrapolation.
+        self.gap_fill_after = gap_fill_after
+        self.max_extrapolation = max_extrapolation
         
+    def setup_metrics(self):
+        """Register the metrics exposed on the metrics endpoint"""
+        self.metrics = MetricsRegistry()
+        for name in self.stats:
+            self.metrics.counter(f"{name}_total", f"Mesh ingest: {name.replace('_', ' ')}",
+                                 lambda name=name: self.stats[name])
+        self.metrics.counter("duplicates_dropped_total", "Mesh records dropped as duplicates",
+                             lambda: self.sequences.duplicates)
+        self.metrics.counter("out_of_order_dropped_total", "Mesh records dropped as older than one already stored",
+                             lambda: self.sequences.out_of_order)
+        self.metrics.gauge("vehicles", "Vehicles currently tracked", lambda: len(self.vehicles))
+        self.metrics.gauge("clients", "Connected websocket clients", lambda: len(self.connected_clients))
+        self.ingest_to_send_seconds = self.metrics.histogram(
+            "ingest_to_send_seconds", "Time from receiving a position to queueing it for clients")
+        self.fanout_seconds = self.metrics.histogram(
+            "fanout_seconds", "Time to route, encode and queue one position batch for all clients")
+        self.encode_seconds = self.metrics.histogram("json_encode_seconds", "Time to JSON encode one frame")
+        self.queue_depth = self.metrics.histogram(
+            "client_queue_depth", "Pending updates per client, observed every tick", DEPTH_BUCKETS)
+        self.collision_seconds = self.metrics.histogram(
+            "collision_check_seconds", "Time to predict trajectories and find collision risks")
+        self.metrics.gauge("geofences", "Geofences defined by clients", lambda: len(self.geofences.fences))
+        self.geofence_seconds = self.metrics.histogram(
+            "geofence_check_seconds", "Time to check the vehicles that moved against the geofences")
+        self.loop_lag_seconds = self.metrics.histogram(
+            "event_loop_lag_seconds", "How late the event loop wakes up from a short sleep")
+        if self.heatmap:
+            self.heatmap_seconds = self.metrics.histogram(
+                "heatmap_update_seconds", "Time to add new and expire old samples in the density grids")
+            self.metrics.counter("heatmap_tiles_invalidated_total", "Heatmap tiles whose cells changed",
+                                 lambda: self.heatmap.invalidated)
+            self.metrics.counter("heatmap_tiles_rendered_total", "Heatmap tiles rendered to PNG",
+                                 lambda: self.heatmap.renders)
+
+    def encode(self, message: dict) -> str:
+        with self.encode_seconds.time():
+            return json.dumps(message)
+
     async def register(self, websocket: websockets.WebSocketServerProtocol):
         """Register a new client connection"""
-        self.connected_clients.add(websocket)
+        self.connected_clients[websocket] = ClientQueue(websocket)
+        self.connected_clients[websocket].start()
         logger.info(f"New client connected. Total clients: {len(self.connected_clients)}")
         
-        # Send current vehicle positions to new client
-        await websocket.send(json.dumps({
-                "type": "initial_state",
-                "data": [
-                    {"id": 1, "position": [13.134104638498696, 77.56917072648946], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 2, "position": [13.131337084484583, 77.56861137245265], "timestamp": "2021-09-01T12:00:00"}
-                ]
-            }))
+        # The snapshot goes out on a later tick unless the client first resumes from a version it already has
+        self.pending_snapshots[websocket] = time.monotonic() + SNAPSHOT_GRACE
     
     async def unregister(self, websocket: websockets.WebSocketServerProtocol):
         """Unregister a client connection"""
-        self.connected_clients.remove(websocket)
+        self.connected_clients.pop(websocket).close()
+        self.pending_snapshots.pop(websocket, None)
+        self.viewports.unsubscribe(websocket)
         logger.info(f"Client disconnected. Total clients: {len(self.connected_clients)}")
     
     async def broadcast_message(self, message: dict):
         """Broadcast a message to all connected clients"""
-        print("sending loop", message)
-        if self.connected_clients:
-            await asyncio.gather(
-                *[client.send(json.dumps(message)) for client in self.connected_clients]
-            )
+        await self.broadcast_encoded(self.encode(message), message["type"])
+
+    async def broadcast_encoded(self, payload: str, kind: str = ""):
+        """Queue an already serialized frame of message type ``kind`` for all connected clients"""
+        if self.publishing:
+            self.shared_events.put(payload, kind)
+            return
+        for client in self.connected_clients.values():
+            client.put_frame(payload)
+
+    async def broadcast_batch(self, entries: list, version: Optional[int] = None):
+        """Queue a position batch for all connected clients.
+
+        Clients without a viewport share one serialized frame, subscribed
+        clients only get the vehicles inside their view.
+        """
+        with self.fanout_seconds.time():
+            if version is None:
+                version = self.state.apply(entries)
+            if self.publishing:
+                measured = self.vehicles.measured[self.vehicles.rows(entry["id"] for entry in entries)]
+                self.shared_table.publish(entries, [], version, measured.tolist())
+                return
+            routed = self.viewports.route(entries)
+            payload = None
+            for websocket, client in self.connected_clients.items():
+                if websocket in routed:
+                    visible = routed[websocket]
+                    if visible:
+                        client.put_batch(visible, self.encode({
+                            "type": "position_batch",
+                            "version": version,
+                            "data": visible
+                        }), version)
+                    continue
+                if payload is None:
+                    payload = self.encode({
+                        "type": "position_batch",
+                        "version": version,
+                        "data": entries
+                    })
+                client.put_batch(entries, payload, version)
+
+    def send_pending_snapshots(self):
+        """Send the current snapshot to new clients that did not ask for state themselves"""
+        now = time.monotonic()
+        for websocket, due in list(self.pending_snapshots.items()):
+            if due <= now:
+                del self.pending_snapshots[websocket]
+                self.connected_clients[websocket].put_frame(self.state.snapshot())
+
+    def subscribe_viewport(self, websocket: websockets.WebSocketServerProtocol, request: dict):
+        """Restrict a client to the vehicles inside its map view and send the ones already there"""
+        south, west, north, east = map(float, request["bbox"])
+        visible = self.viewports.subscribe(websocket, south, west, north, east, int(request.get("zoom", 18)))
+        if visible:
+            self.connected_clients[websocket].put_batch(visible, json.dumps({
+                "type": "position_batch",
+                "version": self.state.version,
+                "data": visible
+            }), self.state.version)
+
+    def client_stats(self) -> list:
+        """Outbound queue state of every connected client"""
+        return [{
+            "client": f"{client.websocket.remote_address[0]}:{client.websocket.remote_address[1]}"
+                      if client.websocket.remote_address else None,
+            "queue_depth": client.depth,
+            "lag": round(client.lag, 3)
+        } for client in self.connected_clients.values()]
     
     async def update_vehicle_position(self, vehicle_id: str, latitude: float, longitude: float):
         """Update vehicle position and broadcast to clients"""
-        await self.broadcast_message({
+        entry = {
             "id": vehicle_id,
             "position": [latitude, longitude],
             "timestamp": datetime.now().isoformat()
+        }
+        await self.broadcast_message({**entry, "version": self.state.apply([entry])})
+    
+    async def send_position_batch(self):
+        """Send every vehicle that moved since the last tick as a single frame"""
+        vehicles = self.vehicles
+        count = len(vehicles)
+        if not count:
+            return
+        now = time.time()
+        received = time.monotonic()
+        age = now - vehicles.measured[:count]
+        # Parked vehicles (speed 0) would extrapolate to where they already are; NaN speeds compare False
+        moving = ~np.isnan(vehicles.heading[:count]) & (vehicles.speed[:count] > 0)
+        estimated = moving & (age > self.gap_fill_after) & (age < self.max_extrapolation)
+        # Extrapolated vehicles move every tick, and the first real report after a gap replaces the estimate
+        dirty = vehicles.dirty[:count].copy()
+        rows = np.flatnonzero(dirty | estimated | vehicles.estimated[:count])
+        vehicles.dirty[:count] = False
+        vehicles.estimated[:count] = estimated
+        if not len(rows):
+            return
+
+        changed = []
+        for row, lat, lon, measured, is_estimated in zip(
+                rows.tolist(), vehicles.lat[rows].tolist(), vehicles.lon[rows].tolist(),
+                vehicles.measured[rows].tolist(), estimated[rows].tolist()):
+            if is_estimated:
+                lat, lon = extrapolate(lat, lon, float(vehicles.heading[row]), float(vehicles.speed[row]), now - measured)
+            entry = {
+                "id": vehicles.slot_ids[row],
+                # Vehicles that sent no fix have NaN coordinates, which JSON cannot carry
+                "position": [None, None] if lat != lat else [lat, lon],
+                "timestamp": datetime.fromtimestamp(now if is_estimated else measured).isoformat()
+            }
+            if is_estimated:
+                entry["estimated"] = True
+            changed.append(entry)
+        # Only new reports; a row resent to replace an estimate may carry a measurement many ticks old
+        fresh = rows[dirty[rows] & ~estimated[rows] & ~np.isnan(vehicles.seen[rows])]
+        for latency in (received - vehicles.seen[fresh]).tolist():
+            self.ingest_to_send_seconds.observe(latency)
+
+        await self.broadcast_batch(changed)
+    
+    def store_position(self, vehicle_id, latitude: float, longitude: float,
+                       timestamp: Optional[float] = None, speed: Optional[float] = None,
+                       heading: Optional[float] = None) -> List[dict]:
+        """Store a received position and return alerts for vehicles that came too close"""
+        timestamp = timestamp or time.time()
+        received = time.monotonic()
+        self.stats["records_ingested"] += 1
+        self.expiry.touch(vehicle_id, received)
+        if latitude is None or longitude is None:
+            self.vehicles.update(vehicle_id, None, None, timestamp, seen=received)
+            # Its last position no longer exists, so nobody should be alerted against it
+            self.proximity.remove(vehicle_id)
+            return []
+        self.vehicles.update(vehicle_id, latitude, longitude, timestamp, speed, heading, received)
+
+        self.history.append(vehicle_id, timestamp, latitude, longitude, speed)
+        if self.heatmap:
+            self.heatmap_samples.append((timestamp, latitude, longitude))
+
+        return [{
+            "vehicles": [vehicle_id, other_id],
+            "distance": round(distance, 1),
+            "timestamp": datetime.now().isoformat()
+        } for other_id, distance in self.proximity.update(vehicle_id, latitude, longitude)]
+
+    async def ingest_position(self, vehicle_id, latitude: float, longitude: float):
+        """Store a received position and alert clients about vehicles that came too close"""
+        await self.send_alerts(self.store_position(vehicle_id, latitude, longitude))
+
+    async def check_collisions(self):
+        """Broadcast the vehicle pairs that newly came on course to collide, soonest first"""
+        vehicles = self.vehicles
+        rows = np.flatnonzero(~np.isnan(vehicles.lat[:len(vehicles)]))
+        with self.collision_seconds.time():
+            risks = self.collisions.update(
+                [vehicles.slot_ids[row] for row in rows.tolist()],
+                vehicles.lat[rows],
+                vehicles.lon[rows],
+                vehicles.measured[rows],
+                time.time(),
+                vehicles.heading[rows],
+                vehicles.speed[rows],
+            )
+        if risks:
+            timestamp = datetime.now().isoformat()
+            for risk in risks:
+                risk["timestamp"] = timestamp
+            await self.broadcast_message({
+                "type": "collision_risk",
+                "data": risks
+            })
+
+    async def check_geofences(self):
+        """Broadcast the geofences vehicles entered or left since the last check"""
+        if not self.geofences.fences:
+            return
+        vehicles = self.vehicles
+        count = len(vehicles)
+        # Only vehicles that moved can have crossed a fence, unless a fence was just added
+        rows = np.arange(count) if self.geofence_rescan else np.flatnonzero(vehicles.dirty[:count])
+        self.geofence_rescan = False
+        if not len(rows):
+            return
+        with self.geofence_seconds.time():
+            entered, exited = self.geofences.update_many([vehicles.slot_ids[row] for row in rows.tolist()],
+                                                         vehicles.lat[rows], vehicles.lon[rows])
+        timestamp = datetime.now().isoformat()
+        for message_type, crossings in (("geofence_enter", entered), ("geofence_exit", exited)):
+            if crossings:
+                await self.broadcast_message({
+                    "type": message_type,
+                    "data": [{
+                        "vehicle": vehicle_id,
+                        "fence": fence_id,
+                        "name": self.geofences.fences[fence_id].name,
+                        "timestamp": timestamp
+                    } for vehicle_id, fence_id in crossings]
+                })
+
+    def geofences_message(self) -> dict:
+        return {"type": "geofences", "data": [fence.to_dict() for fence in self.geofences.fences.values()]}
+
+    async def add_geofence(self, data: dict):
+        """Index a circle or polygon fence sent by a client and tell every client about it"""
+        fence_id = data.get("id")
+        if fence_id is None:
+            while self.next_geofence_id in self.geofences.fences:
+                self.next_geofence_id += 1
+            fence_id = self.next_geofence_id
+        self.geofences.add(Geofence.from_message(fence_id, data))
+        self.geofence_rescan = True
+        await self.broadcast_message(self.geofences_message())
+
+    async def remove_geofence(self, fence_id):
+        if self.geofences.remove(fence_id):
+            await self.broadcast_message(self.geofences_message())
+
+    async def apply_forwarded_command(self, command: dict):
+        """Ingest process: apply a geofence command a worker received from a client.
+
+        The resulting frames reach the clients of every worker through the frame ring.
+        """
+        message_type = command.get("type")
+        try:
+            if message_type == "add_geofence":
+                await self.add_geofence(command)
+            elif message_type == "remove_geofence":
+                await self.remove_geofence(command.get("id"))
+            elif message_type == "request_geofences":
+                # A worker that has not seen a geofences frame yet; every worker caches the answer
+                await self.broadcast_message(self.geofences_message())
+        except ValueError as e:
+            logger.warning(f"Ignoring forwarded {message_type}: {e}")
+
+    async def update_heatmap(self):
+        """Add the samples received since the last update to the density grids once every heatmap interval"""
+        now = time.time()
+        if now < self.heatmap_due:
+            return
+        self.heatmap_due = now + self.heatmap_interval
+        samples, self.heatmap_samples = self.heatmap_samples, []
+        timestamps, lats, lons = np.array(samples, dtype=np.float64).reshape(-1, 3).T
+        # Binning runs off the event loop; the sample arrays are copies it owns
+        with self.heatmap_seconds.time():
+            changed = await asyncio.to_thread(self.heatmap.update, timestamps, lats, lons, now)
+        logger.debug(f"Heatmap updated with {len(samples)} new samples, {changed} tiles changed")
+
+    async def send_alerts(self, alerts: List[dict]):
+        """Broadcast proximity alerts as a single frame"""
+        if alerts:
+            await self.broadcast_message({
+                "type": "proximity_alerts",
+                "data": alerts
+            })
+
+    def on_broadcast_readable(self):
+        """Ingest every datagram queued on the mesh socket.
+
+        Runs as an event loop reader, so vehicle state is only ever touched
+        from the loop thread.
+        """
+        alerts = []
+        now = time.monotonic()
+        for data, addr in self.bdct.rxPending():
+            # Commands change server state, not vehicles; they are never captured, so replays cannot re-run them
+            if data[:2] == COMMAND_MAGIC:
+                self.ingest_command(data, addr)
+                continue
+            if self.capture:
+                self.capture.write(data, addr, now)
+            alerts.extend(self.ingest_datagram(data, addr, now))
+
+        if alerts:
+            asyncio.create_task(self.send_alerts(alerts))
+
+    def ingest_datagram(self, data: bytes, addr, now: float) -> List[dict]:
+        """Decode and store one mesh datagram, returning any proximity alerts"""
+        self.stats["datagrams_received"] += 1
+        try:
+            records = decode_datagram(data)
+        except ValueError as e:
+            self.stats["datagrams_dropped"] += 1
+            logger.warning(f"Dropping datagram from {addr[0]}: {e}")
+            return []
+        alerts = []
+        for record in records:
+            vehicle_id = record.vehicle_id or addr
+            if not vehicle_id:
+                continue
+            if not self.sequences.accept(vehicle_id, record.seq, now):
+                continue
+            alerts.extend(self.store_position(vehicle_id, record.lat, record.lon,
+                                              record.timestamp, record.speed, record.heading))
+        return alerts
+
+    def ingest_command(self, data: bytes, addr):
+        """Worker mode: schedule a client command forwarded by a worker on this host"""
+        if not self.publishing:
+            logger.warning(f"Dropping command datagram from {addr[0]}, this process serves no workers")
+            return
+        if addr[0] != "127.0.0.1":
+            logger.warning(f"Dropping command datagram from {addr[0]}, only local workers may send them")
+            return
+        try:
+            command = json.loads(data[len(COMMAND_MAGIC):])
+        except ValueError as e:
+            logger.warning(f"Dropping malformed command datagram: {e}")
+            return
+        if isinstance(command, dict) and command.get("type") in FORWARDED_COMMANDS:
+            asyncio.create_task(self.apply_forwarded_command(command))
+
+    async def replay_capture(self, path: str, speed: float = 1.0):
+        """Feed a capture through the ingest path as if it was arriving from the mesh"""
+        def ingest(data: bytes, addr):
+            alerts = self.ingest_datagram(data, addr, time.monotonic())
+            if alerts:
+                asyncio.create_task(self.send_alerts(alerts))
+
+        replayer = Replayer(path, speed)
+        logger.info(f"Replaying {path} at {'full' if speed <= 0 else f'{speed}x'} speed")
+        await replayer.run_async(ingest)
+        logger.info(f"Replay finished after {replayer.sent} datagrams")
+
+    async def expire_vehicles(self):
+        """Drop vehicles that stopped reporting and tell clients they left"""
+        departed = self.expiry.expire(time.monotonic())
+        if not departed:
+            return
+        for vehicle_id in departed:
+            self.vehicles.remove(vehicle_id)
+            self.geofences.remove_vehicle(vehicle_id)
+            self.sequences.forget(vehicle_id)
+            self.proximity.remove(vehicle_id)
+            self.history.remove(vehicle_id)
+            self.viewports.remove(vehicle_id)
+        self.stats["vehicles_expired"] += len(departed)
+        logger.info(f"{len(departed)} vehicles left, {len(self.vehicles)} remaining")
+        version = self.state.apply([], departed)
+        if self.publishing:
+            # Workers tell their own clients
+            self.shared_table.publish([], departed, version)
+            return
+        await self.broadcast_message({
+            "type": "vehicle_left",
+            "version": version,
+            "data": departed
+        })
+
+    async def sync_shared_state(self):
+        """Worker mode: send clients what the ingest process published since the last poll"""
+        for kind, payload in self.shared_events.frames():
+            if kind == "geofences":
+                self.geofences_frame = payload
+            await self.broadcast_encoded(payload, kind)
+        entries, measured, departed, version = self.shared_table.poll()
+        if not entries and not departed:
+            return
+        self.state.apply(entries, departed, version)
+        if departed:
+            for vehicle_id in departed:
+                self.vehicles.remove(vehicle_id)
+                self.history.remove(vehicle_id)
+                self.viewports.remove(vehicle_id)
+            await self.broadcast_message({
+                "type": "vehicle_left",
+                "version": version,
+                "data": departed
+            })
+        if entries:
+            vehicle_ids = [entry["id"] for entry in entries]
+            lats = [entry["position"][0] for entry in entries]
+            lons = [entry["position"][1] for entry in entries]
+            self.vehicles.update_many(vehicle_ids, lats, lons, measured)
+            self.history.append_many(vehicle_ids, measured, lats, lons)
+            if self.heatmap:
+                self.heatmap_samples.extend(zip(measured, lats, lons))
+            await self.broadcast_batch(entries, version)
+
+    def forward_position(self, vehicle_id, latitude: float, longitude: float):
+        """Worker mode: hand a position sent by a client to the ingest process as a mesh datagram"""
+        record = VehicleRecord(vehicle_id, latitude, longitude, time.time())
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(encode_json(record), ("127.0.0.1", self.broadcast_port))
+
+    def forward_command(self, command: dict):
+        """Worker mode: hand a client command to the ingest process, which owns the state it changes"""
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+            sock.sendto(COMMAND_MAGIC + json.dumps(command).encode(), ("127.0.0.1", self.broadcast_port))
+
+    def start_broadcast_ingest(self):
+        """Receive mesh broadcasts on the running event loop"""
+        self.bdct = Broadcast(port=self.broadcast_port)
+        self.bdct.rx_sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.bdct.rx_sock.fileno(), self.on_broadcast_readable)
+        logger.info(f"Listening for mesh broadcasts on UDP port {self.broadcast_port}")
+    
+    async def send_history(self, websocket: websockets.WebSocketServerProtocol, request: dict):
+        """Reply with the recorded trajectory of one or many vehicles in a time window"""
+        vehicle_ids = request.get("vehicles")
+        if vehicle_ids is not None:
+            # Address based ids arrive as JSON lists
+            vehicle_ids = [tuple(v) if isinstance(v, list) else v for v in vehicle_ids]
+        trajectories = self.history.query(
+            vehicle_ids,
+            float(request.get("start", float("-inf"))),
+            float(request.get("end", float("inf")))
+        )
+        # Large replies are encoded off the event loop so live updates keep flowing
+        payload = await asyncio.to_thread(json.dumps, {
+            "type": "history",
+            "data": trajectories
         })
+        if websocket in self.connected_clients:
+            self.connected_clients[websocket].put_frame(payload)
     
     async def handle_client_message(self, websocket: websockets.WebSocketServerProtocol, message: str):
         """Handle incoming messages from clients"""
         try:
             data = json.loads(message)
             message_type = data.get("type")
-            print("Message type: ", message_type)
+            logger.debug(f"Message type: {message_type}")
             if message_type == "request_positions":
-                await websocket.send(json.dumps({
-                    "type": "position_update",
-                    "data": [
-                    {"id": 1, "position": [13.134104638498696, 77.56917072648946], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 2, "position": [13.131337084484583, 77.56861137245265], "timestamp": "2021-09-01T12:00:00"}
-                ]
-                }))
+                self.pending_snapshots.pop(websocket, None)
+                self.connected_clients[websocket].put_frame(self.state.snapshot())
+
+            elif message_type == "resume":
+                self.pending_snapshots.pop(websocket, None)
+                for payload in self.state.resume(data.get("epoch"), data.get("version")):
+                    self.connected_clients[websocket].put_frame(payload)
             
+            elif message_type == "request_client_stats":
+                self.connected_clients[websocket].put_frame(json.dumps({
+                    "type": "client_stats",
+                    "data": self.client_stats()
+                }))
+
+            elif message_type == "request_server_stats":
+                self.connected_clients[websocket].put_frame(json.dumps({
+                    "type": "server_stats",
+                    "data": {**self.stats, "duplicates_dropped": self.sequences.duplicates,
+                             "out_of_order_dropped": self.sequences.out_of_order,
+                             "vehicles": len(self.vehicles), "clients": len(self.connected_clients)}
+                }))
+
+            elif message_type == "subscribe_bbox":
+                self.subscribe_viewport(websocket, data)
+
+            elif message_type == "unsubscribe_bbox":
+                self.viewports.unsubscribe(websocket)
+
+            elif message_type == "request_history":
+                await self.send_history(websocket, data)
+
+            elif message_type == "request_geofences" and self.worker and self.geofences_frame is not None:
+                self.connected_clients[websocket].put_frame(self.geofences_frame)
+
+            elif message_type in FORWARDED_COMMANDS and self.worker:
+                # Fences are checked where positions are ingested; the updated list comes back through the ring
+                self.forward_command(data)
+
+            elif message_type == "add_geofence":
+                await self.add_geofence(data)
+
+            elif message_type == "remove_geofence":
+                await self.remove_geofence(data.get("id"))
+
+            elif message_type == "request_geofences":
+                self.connected_clients[websocket].put_frame(json.dumps(self.geofences_message()))
+
+            elif message_type == "update_position" and self.worker:
+                vehicle_data = data.get("data", {})
+                self.forward_position(vehicle_data.get("id"), vehicle_data.get("latitude"),
+                                      vehicle_data.get("longitude"))
+
             elif message_type == "update_position":
                 vehicle_data = data.get("data", {})
-                await self.update_vehicle_position(
+                await self.ingest_position(
                     vehicle_data.get("id"),
                     vehicle_data.get("latitude"),
                     vehicle_data.get("longitude")
                 )
+                if not self.batch_updates:
+                    # Batched servers send it with the other vehicles that moved on the next tick
+                    await self.update_vehicle_position(
+                        vehicle_data.get("id"),
+                        vehicle_data.get("latitude"),
+                        vehicle_data.get("longitude")
+                    )
             
             else:
                 logger.warning(f"Unknown message type: {message_type}")
@@ -117,37 +669,128 @@ class MapWebSocketServer:
         """Periodically fetch and update vehicle positions."""
         while True:
             try:
-                # Fetch new vehicle positions
-                for vehicle_id, (latitude, longitude) in vehicle_positions.items():
-                    # Update vehicle positions
-                    await self.update_vehicle_position(vehicle_id, latitude, longitude)
+                if self.capture:
+                    self.capture.flush()
+                # Whatever is still queued from the last tick is backlog
+                for client in self.connected_clients.values():
+                    self.queue_depth.observe(client.depth)
+                self.send_pending_snapshots()
+                await self.expire_vehicles()
+                # Before the batch is sent, while the vehicles that moved are still marked
+                await self.check_geofences()
+                if self.batch_updates:
+                    await self.send_position_batch()
+                else:
+                    for vehicle_id in list(self.vehicles.slot_ids):
+                        # Update vehicle positions
+                        await self.update_vehicle_position(vehicle_id, *self.vehicles.position(vehicle_id))
+                    self.vehicles.take_dirty()
+                await self.check_collisions()
+                if self.heatmap:
+                    await self.update_heatmap()
             except Exception as e:
                 logger.error(f"Error during periodic update: {str(e)}")
             # Wait for 1 second before the next update
             await asyncio.sleep(1)
+
+    async def periodic_sync(self, interval: float = 0.05):
+        """Worker mode: poll the shared state often, so workers add little latency to the ingest tick"""
+        while True:
+            try:
+                self.send_pending_snapshots()
+                await self.sync_shared_state()
+            except Exception as e:
+                logger.error(f"Error during shared state sync: {str(e)}")
+            await asyncio.sleep(interval)
     
     async def start_server(self):
-        ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
-        ssl_context.load_cert_chain('server.crt', 'server.key')
+        ssl_context = None
+        if self.use_ssl:
+            ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            ssl_context.load_cert_chain('server.crt', 'server.key')
 
         """Start the WebSocket server with periodic updates."""
-        asyncio.create_task(self.periodic_update())  # Schedule the periodic update
+        if self.worker:
+            asyncio.create_task(self.periodic_sync())
+        else:
+            self.start_broadcast_ingest()
+            asyncio.create_task(self.periodic_update())  # Schedule the periodic update
+        asyncio.create_task(monitor_event_loop(self.loop_lag_seconds))
+        if self.metrics_port is not None:
+            # The profiler samples this thread, which runs the event loop
+            MetricsServer(self.metrics, port=self.metrics_port,
+                          profiler=SamplingProfiler(threading.get_ident())).start()
+        if self.heatmap:
+            TileServer(None, port=self.heatmap_port, overlays={"heatmap": self.heatmap}).start()
 
-        async with websockets.serve(self.handler, self.host, self.port, ssl=ssl_context):
-            logger.info(f"WebSocket server started on wss://{self.host}:{self.port}")
+        if self.publishing:
+            logger.info("Ingest process started, clients are served by the workers")
             await asyncio.Future()
+        # Workers all listen on the same port and the kernel spreads connections across them
+        async with websockets.serve(self.handler, self.host, self.port, ssl=ssl_context, reuse_port=self.worker):
+            logger.info(f"WebSocket server started on {'wss' if self.use_ssl else 'ws'}://{self.host}:{self.port}")
+            await asyncio.Future()
+
+def run_worker(table_name: str, events_name: str, **kwargs):
+    """Entry point of a worker process serving websocket clients from the shared state"""
+    shared_table = PositionTable(table_name)
+    shared_events = FrameRing(events_name)
+    server = MapWebSocketServer(shared_table=shared_table, shared_events=shared_events, worker=True,
+                                metrics_port=None, **kwargs)
+    try:
+        asyncio.run(server.start_server())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shared_table.close()
+        shared_events.close()
+
 
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mesh vehicle tracking websocket server")
+    parser.add_argument("--capture", help="append every received mesh datagram to this capture file")
+    parser.add_argument("--replay", help="feed this capture file into the server after starting")
+    parser.add_argument("--replay-speed", type=float, default=1.0,
+                        help="1 for real time, N for N times faster, 0 for as fast as possible")
+    parser.add_argument("--heatmap-port", type=int, help="serve vehicle density tiles at /heatmap/ on this port")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="serve clients from this many processes sharing the port, with ingest in this one")
+    args = parser.parse_args()
+
+    shared_table = shared_events = None
+    workers = []
+    if args.workers:
+        shared_table = PositionTable()
+        shared_events = FrameRing()
+        context = multiprocessing.get_context("spawn")
+        workers = [context.Process(target=run_worker, args=(shared_table.name, shared_events.name),
+                                   name=f"worker-{i}", daemon=True) for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        logger.info(f"Started {len(workers)} websocket workers")
+
     # Create and start the server
-    server = MapWebSocketServer()
+    server = MapWebSocketServer(capture_path=args.capture, heatmap_port=args.heatmap_port,
+                                metrics_port=args.metrics_port, shared_table=shared_table, shared_events=shared_events)
 
-    # Start the broadcast receiver in a separate thread
-    broadcast_thread = threading.Thread(target=recv_broadcasts_bg)
-    broadcast_thread.start()
+    async def run():
+        if args.replay:
+            asyncio.create_task(server.replay_capture(args.replay, args.replay_speed))
+        await server.start_server()
 
     # Run the server
     try:
-        asyncio.run(server.start_server())
+        asyncio.run(run())
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
+    finally:
+        if server.capture:
+            server.capture.close()
+        for worker in workers:
+            worker.terminate()
+            worker.join()
+        if shared_table:
+            shared_table.close(unlink=True)
+            shared_events.close(unlink=True)
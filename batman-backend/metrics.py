@@ -0,0 +1,260 @@
+"""Metrics
+
+Counters, gauges and histograms for the backend, exposed over HTTP in the
+Prometheus text format at ``/metrics``.
+
+Metrics are updated on the event loop thread and rendered from the HTTP
+server thread. Updates are plain attribute writes under the GIL, so the hot
+path never takes a lock; a scrape may see a histogram mid-update, which is
+harmless for monitoring.
+
+The same server can switch a sampling profiler on and off at runtime:
+``/profile/start`` begins sampling the event loop thread and
+``/profile/stop`` returns the collected stacks in collapsed format, ready for
+``flamegraph.pl`` or speedscope.
+"""
+
+import asyncio
+import bisect
+import logging
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Seconds, from sub-millisecond encode times up to multi-second stalls
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+DEPTH_BUCKETS = (0, 1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000)
+
+
+class Counter:
+    """Monotonic count, either incremented or read from ``fn`` at scrape time"""
+
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, fn: Optional[Callable[[], float]] = None):
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name} {self.fn() if self.fn else self.value}"]
+
+
+class Gauge(Counter):
+    """Value that can go up and down, either set or read from ``fn`` at scrape time"""
+
+    kind = "gauge"
+
+    def set(self, value: float):
+        self.value = value
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of observed values"""
+
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self) -> "Timer":
+        """Context manager observing the seconds spent inside it"""
+        return Timer(self)
+
+    def samples(self) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{self.name}_bucket{{le="{bound}"}} {cumulative}')
+        lines.append(f'{self.name}_bucket{{le="+Inf"}} {cumulative + self.counts[-1]}')
+        lines.append(f"{self.name}_sum {self.sum}")
+        lines.append(f"{self.name}_count {self.count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """Named collection of metrics rendered together"""
+
+    def __init__(self, prefix: str = "batman_"):
+        self.prefix = prefix
+        self.metrics: Dict[str, object] = {}
+
+    def _add(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Counter:
+        return self._add(Counter(self.prefix + name, help, fn))
+
+    def gauge(self, name: str, help: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(self.prefix + name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(self.prefix + name, help, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+async def monitor_event_loop(histogram: Histogram, interval: float = 0.1):
+    """Observe how late the event loop wakes up from a sleep of ``interval``"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - start - interval))
+
+
+class SamplingProfiler:
+    """Samples the stack of one thread at a fixed interval from a background thread.
+
+    Stacks are counted in collapsed form (``outer;inner;leaf count``), so
+    the cost is a dictionary update per sample and profiling can be left
+    running on a busy node.
+    """
+
+    def __init__(self, thread_id: Optional[int] = None, interval: float = 0.005):
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.interval = interval
+        self.stacks: StackCounter = StackCounter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self.stacks.clear()
+        self.samples = 0
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        logger.info(f"Sampling profiler started, interval {self.interval * 1000:.1f}ms")
+
+    def stop(self) -> str:
+        """Stop sampling and return the collapsed stacks"""
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            logger.info(f"Sampling profiler stopped after {self.samples} samples")
+        return self.collapsed()
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+            self.samples += 1
+
+
+class MetricsServer:
+    """HTTP endpoint for metrics and the runtime profiler switch.
+
+    Attributes
+    ----------
+    registry : MetricsRegistry
+        metrics rendered at ``/metrics``
+    profiler : SamplingProfiler
+        sampler controlled by ``/profile/start`` and ``/profile/stop``
+    """
+
+    def __init__(self, registry: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100,
+                 profiler: Optional[SamplingProfiler] = None):
+        self.registry = registry
+        self.profiler = profiler
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def _make_handler(self):
+        server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                if path == "/metrics":
+                    self._respond(200, "text/plain; version=0.0.4", server.registry.render())
+                elif path == "/profile/start" and server.profiler:
+                    server.profiler.start()
+                    self._respond(200, "text/plain", "profiling\n")
+                elif path == "/profile/stop" and server.profiler:
+                    self._respond(200, "text/plain", server.profiler.stop())
+                else:
+                    self._respond(404, "text/plain", "Not found\n")
+
+            def _respond(self, status, content_type, body):
+                data = body.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return MetricsRequestHandler
+
+    def start(self) -> threading.Thread:
+        """Serve requests on a daemon thread"""
+        logger.info(f"Metrics available on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/metrics")
+        thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
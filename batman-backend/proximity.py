@@ -0,0 +1,123 @@
+"""Proximity
+
+Uniform grid index over vehicle positions. Each update only compares the
+vehicle against the vehicles in the surrounding grid cells, so the cost of a
+proximity check grows with local density instead of with the fleet size.
+"""
+
+import math
+from typing import Dict, Hashable, List, Set, Tuple
+
+import numpy as np
+
+EARTH_RADIUS_M = 6371e3
+METERS_PER_DEGREE_LAT = 111_320.0
+
+
+def haversine_many(lat: float, lon: float, lats: np.ndarray, lons: np.ndarray) -> np.ndarray:
+    """Distance in meters from one point to an array of points"""
+    phi1 = math.radians(lat)
+    phi2 = np.radians(lats)
+    d_phi = phi2 - phi1
+    d_lambda = np.radians(lons) - math.radians(lon)
+
+    a = np.sin(d_phi / 2) ** 2 + math.cos(phi1) * np.cos(phi2) * np.sin(d_lambda / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0.0, 1.0)))
+
+
+class ProximityIndex:
+    """Grid index that reports pairs of vehicles closer than a radius.
+
+    Cells are square in degrees with a side of ``radius_m`` worth of latitude.
+    A degree of longitude is shorter than a degree of latitude away from the
+    equator, so the longitude search span is widened by ``1 / cos(lat)``.
+
+    Attributes
+    ----------
+    radius_m : float
+        distance in meters below which two vehicles are reported
+    positions : dict
+        last known (lat, lon) for every indexed vehicle
+
+    Methods
+    -------
+    update(key, lat, lon)
+        moves a vehicle and returns the pairs that just came into proximity
+    remove(key)
+        drops a vehicle from the index
+    """
+
+    def __init__(self, radius_m: float = 50.0):
+        self.radius_m = radius_m
+        self.cell_deg = radius_m / METERS_PER_DEGREE_LAT
+        self.positions: Dict[Hashable, Tuple[float, float]] = {}
+        self.cells: Dict[Tuple[int, int], Set[Hashable]] = {}
+        self.vehicle_cells: Dict[Hashable, Tuple[int, int]] = {}
+        # Pairs currently within radius, so an alert is only raised on entry
+        self.close_pairs: Dict[Hashable, Set[Hashable]] = {}
+
+    def _cell(self, lat: float, lon: float) -> Tuple[int, int]:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def _candidates(self, key: Hashable, lat: float, lon: float) -> List[Hashable]:
+        row, col = self._cell(lat, lon)
+        cos_lat = max(math.cos(math.radians(abs(lat) + self.cell_deg)), 1e-6)
+        lon_span = math.ceil(1 / cos_lat)
+
+        candidates = []
+        for r in range(row - 1, row + 2):
+            for c in range(col - lon_span, col + lon_span + 1):
+                cell = self.cells.get((r, c))
+                if cell:
+                    candidates.extend(other for other in cell if other != key)
+        return candidates
+
+    def neighbours(self, key: Hashable, lat: float, lon: float) -> List[Tuple[Hashable, float]]:
+        """Return (other_key, distance) for every vehicle within the radius"""
+        candidates = self._candidates(key, lat, lon)
+        if not candidates:
+            return []
+
+        coords = np.array([self.positions[other] for other in candidates], dtype=np.float64)
+        distances = haversine_many(lat, lon, coords[:, 0], coords[:, 1])
+        close = np.nonzero(distances < self.radius_m)[0]
+        return [(candidates[i], float(distances[i])) for i in close]
+
+    def update(self, key: Hashable, lat: float, lon: float) -> List[Tuple[Hashable, float]]:
+        """Move a vehicle and return the neighbours it was not already close to"""
+        cell = self._cell(lat, lon)
+        old_cell = self.vehicle_cells.get(key)
+        if old_cell != cell:
+            if old_cell is not None:
+                self._discard_from_cell(key, old_cell)
+            self.cells.setdefault(cell, set()).add(key)
+            self.vehicle_cells[key] = cell
+        self.positions[key] = (lat, lon)
+
+        near = self.neighbours(key, lat, lon)
+        near_keys = {other for other, _ in near}
+        previous = self.close_pairs.get(key, set())
+
+        for other in previous - near_keys:
+            self.close_pairs.get(other, set()).discard(key)
+        for other in near_keys:
+            self.close_pairs.setdefault(other, set()).add(key)
+        self.close_pairs[key] = near_keys
+
+        return [(other, distance) for other, distance in near if other not in previous]
+
+    def remove(self, key: Hashable):
+        """Drop a vehicle from the index"""
+        cell = self.vehicle_cells.pop(key, None)
+        if cell is not None:
+            self._discard_from_cell(key, cell)
+        self.positions.pop(key, None)
+        for other in self.close_pairs.pop(key, set()):
+            self.close_pairs.get(other, set()).discard(key)
+
+    def _discard_from_cell(self, key: Hashable, cell: Tuple[int, int]):
+        members = self.cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self.cells[cell]
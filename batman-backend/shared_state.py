@@ -0,0 +1,249 @@
+"""Shared state
+
+Vehicle state shared between the ingest process and websocket workers.
+
+In worker mode one process owns the mesh socket and does everything per
+vehicle: decoding, ordering, expiry, gap filling, proximity and collision
+checks. It publishes the result into shared memory, and several worker
+processes serve the websocket clients from it, each on its own core, all
+accepting on the same port through SO_REUSEPORT.
+
+``PositionTable`` holds one fixed-size row per vehicle. Every row carries
+the version in which it last changed, so a worker picks up only what
+changed since its last poll, however many versions it slept through. The
+single writer brackets every publish with a sequence counter (a seqlock):
+odd while writing, even when done. Readers copy the table and retry if the
+counter moved, so neither side ever takes a lock.
+
+``FrameRing`` carries the messages that are events rather than state, such
+as proximity alerts and collision risks, as already encoded frames in a
+ring of fixed-size slots. Each slot records the frame's kind, its message
+``type``, so readers can pick out frames without decoding them, and is
+stamped with its message number after it is written; a reader that was
+lapped by the writer skips what it missed.
+"""
+
+import json
+import logging
+import struct
+import time
+import uuid
+from collections import deque
+from multiprocessing import shared_memory
+from typing import Dict, Hashable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+HEADER_DTYPE = np.dtype([("sequence", np.uint64), ("version", np.uint64), ("epoch", "S16"),
+                         ("capacity", np.uint64)])
+ROW_DTYPE = np.dtype([
+    ("id", "S64"),          # JSON encoded vehicle id, as clients see it
+    ("lat", np.float64),    # NaN for a vehicle without a fix, None in entries
+    ("lon", np.float64),
+    ("measured", np.float64),
+    ("timestamp", "S32"),   # ISO timestamp sent to clients
+    ("version", np.uint64),
+    ("active", np.uint8),
+    ("estimated", np.uint8),
+])
+
+# Frame number, length and kind
+SLOT_HEADER = struct.Struct("<QI24s")
+RING_HEADER = struct.Struct("<QII")
+
+
+def decode_id(key: bytes) -> Hashable:
+    """Vehicle id from its JSON form; address based ids come back as tuples"""
+    vehicle_id = json.loads(key)
+    return tuple(vehicle_id) if isinstance(vehicle_id, list) else vehicle_id
+
+
+class PositionTable:
+    """Fixed-capacity vehicle table in shared memory, written by one process.
+
+    Create it with ``capacity`` in the ingest process and attach to it by
+    ``name`` in the workers.
+
+    Methods
+    -------
+    publish(changed, removed, version, measured)
+        writes one batch of entries and departures (writer)
+    poll()
+        returns the entries and departures since the last poll (reader)
+    """
+
+    def __init__(self, name: Optional[str] = None, capacity: int = 16384, epoch: Optional[str] = None):
+        create = name is None
+        size = HEADER_DTYPE.itemsize + capacity * ROW_DTYPE.itemsize if create else 0
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self.shm.name
+        self.header = np.ndarray((), dtype=HEADER_DTYPE, buffer=self.shm.buf)
+        if create:
+            self.header["capacity"] = capacity
+            # Workers take their state epoch from here, so clients can resume on any of them
+            self.header["epoch"] = (epoch or uuid.uuid4().hex[:12]).encode()
+        self.capacity = int(self.header["capacity"])
+        self.epoch = self.header["epoch"][()].decode()
+        self.rows = np.ndarray((self.capacity,), dtype=ROW_DTYPE, buffer=self.shm.buf, offset=HEADER_DTYPE.itemsize)
+        # Writer side: row of every vehicle and rows free for reuse, oldest freed first
+        self.slots: Dict[Hashable, int] = {}
+        self.free = deque(range(self.capacity))
+        # Reader side: last version seen and the id each row held then
+        self.seen = 0
+        self.row_ids: Dict[int, bytes] = {}
+        self.retries = 0
+
+    def publish(self, changed: List[dict], removed: List[Hashable], version: int,
+                measured: Optional[List[float]] = None):
+        """Write a batch of entries and departed vehicles as ``version``.
+
+        ``measured`` holds the epoch time each entry's position was measured,
+        for the trajectory history the workers keep.
+        """
+        if measured is None:
+            measured = [time.time()] * len(changed)
+        rows, values = [], []
+        for entry, measured_at in zip(changed, measured):
+            key = json.dumps(entry["id"]).encode()
+            if len(key) > ROW_DTYPE["id"].itemsize:
+                logger.warning(f"Vehicle id {entry['id']} is too long for the shared table")
+                continue
+            row = self.slots.get(entry["id"])
+            if row is None:
+                if not self.free:
+                    logger.warning(f"Shared table full, {self.capacity} vehicles, dropping {entry['id']}")
+                    continue
+                row = self.slots[entry["id"]] = self.free.popleft()
+            lat, lon = entry["position"]
+            rows.append(row)
+            values.append((key, lat, lon, measured_at, entry["timestamp"].encode(),
+                           version, 1, entry.get("estimated", False)))
+        departed = [self.slots.pop(vehicle_id) for vehicle_id in removed if vehicle_id in self.slots]
+
+        self.header["sequence"] += 1
+        if rows:
+            self.rows[rows] = np.array(values, dtype=ROW_DTYPE)
+        if departed:
+            self.rows["active"][departed] = 0
+            self.rows["version"][departed] = version
+        self.header["version"] = version
+        self.header["sequence"] += 1
+        self.free.extend(departed)
+
+    def _read(self) -> Tuple[int, np.ndarray, np.ndarray]:
+        """Consistent copy of the version and the rows changed since the last poll"""
+        while True:
+            sequence = int(self.header["sequence"])
+            if sequence % 2 == 0:
+                version = int(self.header["version"])
+                changed = np.flatnonzero(self.rows["version"] > self.seen)
+                rows = self.rows[changed]
+                if int(self.header["sequence"]) == sequence:
+                    return version, changed, rows
+            self.retries += 1
+            time.sleep(0)
+
+    def poll(self) -> Tuple[List[dict], List[float], List, int]:
+        """Entries changed since the last poll with their measurement times, vehicle ids removed,
+        and the current version"""
+        if int(self.header["version"]) == self.seen:
+            return [], [], [], self.seen
+        version, changed, rows = self._read()
+        entries, measured, removed = [], [], []
+        for row, record in zip(changed.tolist(), rows):
+            key = bytes(record["id"])
+            previous = self.row_ids.get(row)
+            if previous is not None and previous != key:
+                # The row was freed and reused between polls
+                removed.append(decode_id(previous))
+            if not record["active"]:
+                if previous == key:
+                    removed.append(decode_id(key))
+                self.row_ids.pop(row, None)
+                continue
+            self.row_ids[row] = key
+            lat, lon = float(record["lat"]), float(record["lon"])
+            entry = {
+                "id": decode_id(key),
+                # JSON has no NaN, and clients expect [None, None] for a vehicle without a fix
+                "position": [None, None] if lat != lat else [lat, lon],
+                "timestamp": bytes(record["timestamp"]).decode(),
+            }
+            if record["estimated"]:
+                entry["estimated"] = True
+            entries.append(entry)
+            measured.append(float(record["measured"]))
+        self.seen = version
+        return entries, measured, removed, version
+
+    def close(self, unlink: bool = False):
+        del self.header, self.rows
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class FrameRing:
+    """Ring of encoded frames in shared memory, one writer and any number of readers.
+
+    Frames larger than a slot are dropped with a warning; they are events,
+    and the state they describe is always in the position table.
+    """
+
+    def __init__(self, name: Optional[str] = None, slots: int = 256, slot_size: int = 65536):
+        create = name is None
+        size = RING_HEADER.size + slots * slot_size if create else 0
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=size)
+        self.name = self.shm.name
+        if create:
+            RING_HEADER.pack_into(self.shm.buf, 0, 0, slots, slot_size)
+        _, self.slots, self.slot_size = RING_HEADER.unpack_from(self.shm.buf, 0)
+        # Readers start with the next frame written after they attached
+        self.next = self.head + 1
+        self.skipped = 0
+
+    @property
+    def head(self) -> int:
+        """Number of the last frame written"""
+        return RING_HEADER.unpack_from(self.shm.buf, 0)[0]
+
+    def _offset(self, number: int) -> int:
+        return RING_HEADER.size + (number % self.slots) * self.slot_size
+
+    def put(self, payload: str, kind: str = ""):
+        """Write a frame; ``kind`` is the message type readers can filter on"""
+        data = payload.encode()
+        if SLOT_HEADER.size + len(data) > self.slot_size:
+            logger.warning(f"Dropping {len(data)} byte frame, larger than a ring slot")
+            return
+        number = self.head + 1
+        offset = self._offset(number)
+        # Invalidate the slot first, so a reader copying it sees the change
+        SLOT_HEADER.pack_into(self.shm.buf, offset, 0, len(data), kind.encode())
+        self.shm.buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + len(data)] = data
+        SLOT_HEADER.pack_into(self.shm.buf, offset, number, len(data), kind.encode())
+        RING_HEADER.pack_into(self.shm.buf, 0, number, self.slots, self.slot_size)
+
+    def frames(self) -> Iterator[Tuple[str, str]]:
+        """(kind, frame) of every frame written since the last call, oldest first"""
+        head = self.head
+        if head - self.next + 1 > self.slots:
+            lapped = head - self.slots + 1
+            self.skipped += lapped - self.next
+            self.next = lapped
+        while self.next <= head:
+            offset = self._offset(self.next)
+            number, length, kind = SLOT_HEADER.unpack_from(self.shm.buf, offset)
+            data = bytes(self.shm.buf[offset + SLOT_HEADER.size:offset + SLOT_HEADER.size + length])
+            if number == self.next and SLOT_HEADER.unpack_from(self.shm.buf, offset)[0] == number:
+                yield kind.rstrip(b"\0").decode(), data.decode()
+            else:
+                self.skipped += 1
+            self.next += 1
+
+    def close(self, unlink: bool = False):
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
@@ -3,10 +3,27 @@ import json
 import websockets
 import logging
 from broadcast import Broadcast
+from dead_reckoning import TransmitPolicy
+from wire import VehicleRecord
+from client_queue import ClientQueue
+from collision import CollisionPredictor
+from geofence import Geofence, GeofenceIndex
+from heatmap import DensityHeatmap
+from history import TrajectoryHistory
+from metrics import DEPTH_BUCKETS, MetricsRegistry, MetricsServer, SamplingProfiler, monitor_event_loop
+from proximity import ProximityIndex
+from state import SNAPSHOT_GRACE, VersionedState
+from tile_server import TileServer
+from vehicle_table import VehicleTable
+from viewport import ViewportIndex
 from datetime import datetime
-from typing import Set, Dict
-import random
+from typing import Dict, List, Optional
+import argparse
+import time
 import ssl
+import threading
+
+import numpy as np
 
 # Set up logging
 logging.basicConfig(
@@ -17,7 +34,7 @@ logger = logging.getLogger(__name__)
 
 # In the MapWebSocketSim class, modify the periodic_update method:
 
-bdct_client = Broadcast()
+bdct_client = Broadcast(transmit_policy=TransmitPolicy())
 
 # Update the WaypointManager class:
 class WaypointManager:
@@ -44,123 +61,519 @@ class WaypointManager:
 #R to L towards Dbd rd up
         5:  [[13.134405252127834, 77.5703374633789],[13.134432963671776, 77.56952104490269],[13.134557599098008, 77.56946376046962]]
         }
-        
-        # Keep track of current position index for each vehicle
-        self.current_indices = {vehicle_id: 0 for vehicle_id in self.vehicle_paths.keys()}
-        self.current_positions = {}
-
-    def get_next_position(self, vehicle_id: int) -> list[float]:
-        """Get the next position for a vehicle and update its index"""
-        path = self.vehicle_paths[vehicle_id]
-        if not path:
-            return None
-
-        current_index = self.current_indices[vehicle_id]
-        position = path[current_index]
-        
-        # Update index for next time, wrapping around to 0 if we reach the end
-        self.current_indices[vehicle_id] = (current_index + 1) % len(path)
-        
-        return position
-    
-async def fetch_vehicle_positions() -> Dict[int, list[float]]:
-    """
-    Fetches the next set of vehicle positions, cycling through waypoints for each vehicle
-    Returns: Dictionary mapping vehicle IDs to their new positions
+
+
+EARTH_RADIUS_M = 6371e3
+
+
+class FleetSimulator:
+    """Continuous motion simulation for a whole fleet, stored as NumPy arrays.
+
+    All routes are concatenated into one vertex array and every vehicle is
+    described by its route, the distance travelled along it and its speed, so
+    a tick is a handful of array operations no matter how many vehicles there
+    are. Vehicles drive to the end of their route and back again.
+
+    Attributes
+    ----------
+    vehicle_ids : list
+        id of the vehicle in each array slot
+    lat, lon, heading : np.ndarray
+        current position (degrees) and direction of travel (degrees from north)
+    speed : np.ndarray
+        speed of each vehicle in m/s
+    sim_time : float
+        simulated seconds since start
     """
-    # Initialize WaypointManager if it doesn't exist
-    if not hasattr(fetch_vehicle_positions, 'waypoint_manager'):
-        fetch_vehicle_positions.waypoint_manager = WaypointManager()
-    
-    manager = fetch_vehicle_positions.waypoint_manager
-    
-    # Randomly select a vehicle to update
-    available_vehicles = list(manager.vehicle_paths.keys())
-    vehicle_id = random.choice(available_vehicles)
-    
-    # Get next position for selected vehicle
-    position = manager.get_next_position(vehicle_id)
-    if position:
-        manager.current_positions[vehicle_id] = position
-    
-    return manager.current_positions
+
+    def __init__(self, routes: List[List[List[float]]], vehicle_routes, speeds, offsets=None,
+                 vehicle_ids=None):
+        routes = [np.asarray(route, dtype=np.float64) for route in routes if len(route) >= 2]
+        if not routes:
+            raise ValueError("At least one route with two or more waypoints is required")
+
+        # Flatten all routes; segment i runs from vertex i to vertex i + 1
+        self.vertices = np.concatenate(routes)
+        lengths = np.array([len(route) for route in routes])
+        self.route_start = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        self.route_last_segment = self.route_start + lengths - 2
+
+        lat1, lon1 = np.radians(self.vertices[:-1, 0]), np.radians(self.vertices[:-1, 1])
+        lat2, lon2 = np.radians(self.vertices[1:, 0]), np.radians(self.vertices[1:, 1])
+        dx = (lon2 - lon1) * np.cos((lat1 + lat2) / 2) * EARTH_RADIUS_M
+        dy = (lat2 - lat1) * EARTH_RADIUS_M
+        segment_length = np.hypot(dx, dy)
+        self.segment_heading = np.degrees(np.arctan2(dx, dy)) % 360
+        # Segments that join the end of one route to the start of the next are never used
+        for start in self.route_start[1:]:
+            segment_length[start - 1] = 0.0
+
+        self.vertex_distance = np.concatenate(([0.0], np.cumsum(segment_length)))
+        self.route_length = self.vertex_distance[self.route_start + lengths - 1] - self.vertex_distance[self.route_start]
+
+        self.vehicle_route = np.asarray(vehicle_routes, dtype=np.int64)
+        self.speed = np.asarray(speeds, dtype=np.float64)
+        self.travelled = np.zeros(len(self.vehicle_route)) if offsets is None else np.asarray(offsets, dtype=np.float64)
+        self.vehicle_ids = list(vehicle_ids) if vehicle_ids is not None else list(range(1, len(self.vehicle_route) + 1))
+        self.index = {vehicle_id: i for i, vehicle_id in enumerate(self.vehicle_ids)}
+        self.sim_time = 0.0
+        self._interpolate()
+
+    @classmethod
+    def generate(cls, routes: List[List[List[float]]], vehicle_count: int, seed: Optional[int] = None,
+                 min_speed: float = 5.0, max_speed: float = 15.0) -> "FleetSimulator":
+        """Spread ``vehicle_count`` vehicles randomly over routes with random speeds and start points"""
+        rng = np.random.default_rng(seed)
+        vehicle_routes = rng.integers(0, len(routes), vehicle_count)
+        speeds = rng.uniform(min_speed, max_speed, vehicle_count)
+        simulator = cls(routes, vehicle_routes, speeds)
+        simulator.travelled = rng.uniform(0, 2, vehicle_count) * simulator.route_length[vehicle_routes]
+        simulator._interpolate()
+        return simulator
+
+    @staticmethod
+    def generate_routes(route_count: int, center: List[float], radius_m: float = 3000.0,
+                        waypoints: int = 8, step_m: float = 300.0, seed: Optional[int] = None) -> List[List[List[float]]]:
+        """Random-walk routes around ``center``, for sizing tests beyond the built-in paths"""
+        rng = np.random.default_rng(seed)
+        lat0, lon0 = center
+        m_per_deg_lat = np.pi * EARTH_RADIUS_M / 180
+        m_per_deg_lon = m_per_deg_lat * np.cos(np.radians(lat0))
+
+        # Start uniformly inside the radius, then take steps that mostly keep their direction
+        r = radius_m * np.sqrt(rng.uniform(0, 1, route_count))
+        theta = rng.uniform(0, 2 * np.pi, route_count)
+        turns = rng.normal(0, np.pi / 6, (route_count, waypoints - 1))
+        headings = rng.uniform(0, 2 * np.pi, (route_count, 1)) + np.cumsum(turns, axis=1)
+        east = np.concatenate(((r * np.sin(theta))[:, None], step_m * np.sin(headings)), axis=1).cumsum(axis=1)
+        north = np.concatenate(((r * np.cos(theta))[:, None], step_m * np.cos(headings)), axis=1).cumsum(axis=1)
+        return np.stack((lat0 + north / m_per_deg_lat, lon0 + east / m_per_deg_lon), axis=-1).tolist()
+
+    @classmethod
+    def from_file(cls, path: str, seed: Optional[int] = None,
+                  vehicle_count: Optional[int] = None) -> "FleetSimulator":
+        """Load routes and vehicles from JSON.
+
+        The file holds ``{"routes": [[[lat, lon], ...], ...], "vehicles": ...}``
+        where ``vehicles`` is either a count to generate or a list of
+        ``{"id", "route", "speed", "offset"}`` objects. ``vehicle_count``
+        overrides the file and generates that many vehicles on its routes.
+        """
+        with open(path) as file:
+            config = json.load(file)
+        routes = config["routes"]
+        vehicles = vehicle_count or config.get("vehicles", len(routes))
+        if isinstance(vehicles, int):
+            return cls.generate(routes, vehicles, seed)
+        return cls(
+            routes,
+            [vehicle["route"] for vehicle in vehicles],
+            [vehicle.get("speed", 10.0) for vehicle in vehicles],
+            [vehicle.get("offset", 0.0) for vehicle in vehicles],
+            [vehicle.get("id", i + 1) for i, vehicle in enumerate(vehicles)],
+        )
+
+    def routes(self) -> List[List[List[float]]]:
+        """Waypoints of every route as [lat, lon] lists"""
+        ends = np.append(self.route_start[1:], len(self.vertices))
+        return [self.vertices[start:end].tolist() for start, end in zip(self.route_start, ends)]
+
+    def step(self, dt: float):
+        """Advance every vehicle by ``dt`` simulated seconds"""
+        self.travelled += self.speed * dt
+        self.sim_time += dt
+        self._interpolate()
+
+    def _interpolate(self):
+        route_length = self.route_length[self.vehicle_route]
+        # Drive out and back: distances past the end of the route count down again
+        lap = np.mod(self.travelled, 2 * np.maximum(route_length, 1e-9))
+        returning = lap > route_length
+        along = np.where(returning, 2 * route_length - lap, lap)
+
+        start = self.route_start[self.vehicle_route]
+        target = self.vertex_distance[start] + along
+        segment = np.searchsorted(self.vertex_distance, target, side="right") - 1
+        segment = np.clip(segment, start, self.route_last_segment[self.vehicle_route])
+
+        seg_start = self.vertex_distance[segment]
+        seg_length = self.vertex_distance[segment + 1] - seg_start
+        t = np.clip(np.divide(target - seg_start, seg_length, out=np.zeros_like(target), where=seg_length > 0), 0, 1)
+
+        a, b = self.vertices[segment], self.vertices[segment + 1]
+        self.lat = a[:, 0] + (b[:, 0] - a[:, 0]) * t
+        self.lon = a[:, 1] + (b[:, 1] - a[:, 1]) * t
+        self.heading = np.where(returning, (self.segment_heading[segment] + 180) % 360, self.segment_heading[segment])
+
+    def positions(self) -> Dict[int, list[float]]:
+        """Current position of every vehicle"""
+        return {vehicle_id: [lat, lon] for vehicle_id, lat, lon
+                in zip(self.vehicle_ids, self.lat.tolist(), self.lon.tolist())}
+
 
 class MapWebSocketSim:
-    def __init__(self, host: str = "localhost", port: int = 8765):
+    def __init__(self, host: str = "localhost", port: int = 8765, proximity_radius: float = 50.0,
+                 batch_updates: bool = True, simulator: Optional[FleetSimulator] = None,
+                 tick_rate: float = 1.0, time_warp: float = 1.0, history_capacity: int = 600,
+                 metrics_port: Optional[int] = None, heatmap_port: Optional[int] = None,
+                 heatmap_interval: float = 5.0):
         self.host = host
         self.port = port
-        self.connected_clients: Set[websockets.WebSocketServerProtocol] = set()
+        if simulator is None:
+            # One vehicle per built-in waypoint route
+            routes = list(WaypointManager().vehicle_paths.values())
+            simulator = FleetSimulator.generate(routes, len(routes), seed=0)
+        self.simulator = simulator
+        self.tick_rate = tick_rate
+        # Simulated seconds per real second; above 1 runs faster than real time
+        self.time_warp = time_warp
+        # Simulated epoch time of the fleet, advanced by each tick's warped step. Measurement times,
+        # history, heatmap and collision checks use it so they match the simulated motion.
+        self.sim_time = time.time()
+        self.connected_clients: Dict[websockets.WebSocketServerProtocol, ClientQueue] = {}
         self.update_task = None
-        
+        self.proximity = ProximityIndex(radius_m=proximity_radius)
+        self.viewports = ViewportIndex()
+        self.state = VersionedState()
+        # Clients owed a snapshot, with the time after which it is sent unasked
+        self.pending_snapshots: Dict[websockets.WebSocketServerProtocol, float] = {}
+        self.collisions = CollisionPredictor()
+        # Zones added by clients; vehicles that moved are checked against them every tick
+        self.geofences = GeofenceIndex()
+        self.next_geofence_id = 1
+        # Set when a fence was added, so vehicles that did not move are checked against it too
+        self.geofence_rescan = False
+        self.history = TrajectoryHistory(capacity=history_capacity, initial_vehicles=len(simulator.vehicle_ids))
+        # When enabled, each tick sends one position_batch frame with only the vehicles that moved
+        self.batch_updates = batch_updates
+        # Latest state of every simulated vehicle, and which moved since the last tick
+        self.vehicles = VehicleTable(initial_capacity=len(simulator.vehicle_ids))
+        self.tx_sequence: Dict = {}
+        # Density overlay tiles, updated with the samples of the last heatmap_interval seconds
+        self.heatmap_port = heatmap_port
+        self.heatmap = DensityHeatmap() if heatmap_port is not None else None
+        self.heatmap_interval = heatmap_interval
+        self.heatmap_due = 0.0
+        # (timestamps, lats, lons) arrays of every tick since the last heatmap update
+        self.heatmap_samples: List[tuple] = []
+        self.metrics_port = metrics_port
+        self.setup_metrics()
+
+    def setup_metrics(self):
+        """Register the metrics exposed on the metrics endpoint"""
+        self.metrics = MetricsRegistry(prefix="batman_sim_")
+        self.metrics.gauge("vehicles", "Simulated vehicles", lambda: len(self.simulator.vehicle_ids))
+        self.metrics.gauge("clients", "Connected websocket clients", lambda: len(self.connected_clients))
+        self.metrics.counter("records_suppressed_total", "Mesh records skipped by the transmit policy",
+                             lambda: bdct_client.transmit_policy.suppressed if bdct_client.transmit_policy else 0)
+        self.tick_seconds = self.metrics.histogram("tick_seconds", "Time to step the fleet and send one tick")
+        self.fanout_seconds = self.metrics.histogram(
+            "fanout_seconds", "Time to route, encode and queue one position batch for all clients")
+        self.encode_seconds = self.metrics.histogram("json_encode_seconds", "Time to JSON encode one frame")
+        self.queue_depth = self.metrics.histogram(
+            "client_queue_depth", "Pending updates per client, observed every tick", DEPTH_BUCKETS)
+        self.collision_seconds = self.metrics.histogram(
+            "collision_check_seconds", "Time to predict trajectories and find collision risks")
+        self.metrics.gauge("geofences", "Geofences defined by clients", lambda: len(self.geofences.fences))
+        self.geofence_seconds = self.metrics.histogram(
+            "geofence_check_seconds", "Time to check the vehicles that moved against the geofences")
+        self.loop_lag_seconds = self.metrics.histogram(
+            "event_loop_lag_seconds", "How late the event loop wakes up from a short sleep")
+        if self.heatmap:
+            self.heatmap_seconds = self.metrics.histogram(
+                "heatmap_update_seconds", "Time to add new and expire old samples in the density grids")
+            self.metrics.counter("heatmap_tiles_invalidated_total", "Heatmap tiles whose cells changed",
+                                 lambda: self.heatmap.invalidated)
+            self.metrics.counter("heatmap_tiles_rendered_total", "Heatmap tiles rendered to PNG",
+                                 lambda: self.heatmap.renders)
+
+    def encode(self, message: dict) -> str:
+        with self.encode_seconds.time():
+            return json.dumps(message)
+
     async def register(self, websocket: websockets.WebSocketServerProtocol):
         """Register a new client connection and start periodic updates if first client"""
         is_first_client = len(self.connected_clients) == 0
-        self.connected_clients.add(websocket)
+        self.connected_clients[websocket] = ClientQueue(websocket)
+        self.connected_clients[websocket].start()
         logger.info(f"New client connected. Total clients: {len(self.connected_clients)}")
         
-        # Send current vehicle positions to new client
-        await websocket.send(json.dumps({
-                "type": "initial_state",
-                "data": [
-                    {"id": 1, "position": [13.134407425677608, 77.56936729614509], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 2, "position": [13.135633790624643, 77.56791730038407], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 3, "position": [13.134933169146414, 77.56856909994178], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 4, "position": [13.135669510376736, 77.56915069919188], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 5, "position": [13.134405252127834, 77.5703374633789], "timestamp": "2021-09-01T12:00:00"},
-                ]
-            }))
+        # The snapshot goes out on a later tick unless the client first resumes from a version it already has
+        self.pending_snapshots[websocket] = time.monotonic() + SNAPSHOT_GRACE
             
-        # Start periodic updates only for the first client
-        if is_first_client:
+        # Start periodic updates for the first client; the loop keeps running once started,
+        # and a second one would step the fleet twice per tick
+        if is_first_client and (self.update_task is None or self.update_task.done()):
             logger.info("First client connected. Starting periodic updates...")
             self.update_task = asyncio.create_task(self.periodic_update())
     
     async def unregister(self, websocket: websockets.WebSocketServerProtocol):
         """Unregister a client connection"""
-        self.connected_clients.remove(websocket)
+        self.connected_clients.pop(websocket).close()
+        self.pending_snapshots.pop(websocket, None)
+        self.viewports.unsubscribe(websocket)
         logger.info(f"Client disconnected. Total clients: {len(self.connected_clients)}")
     
     async def broadcast_message(self, message: dict):
         """Broadcast a message to all connected clients"""
-        print("sending loop", message)
-        if self.connected_clients:
-            await asyncio.gather(
-                *[client.send(json.dumps(message)) for client in self.connected_clients]
-            )
+        await self.broadcast_encoded(self.encode(message))
         
+        # Only position updates go out to the mesh network
+        if "position" not in message:
+            return
+
         # Broadcasting to mesh network
-        id = message["id"]
-        lat = message["position"][0]
-        long = message["position"][1]
+        bdct_client.txRecords([self.make_record(message["id"], *message["position"])])
+
+    def make_record(self, vehicle_id, latitude: float, longitude: float) -> VehicleRecord:
+        """Build the mesh record for a vehicle, advancing its sequence number"""
+        seq = self.tx_sequence.get(vehicle_id, 0) + 1
+        self.tx_sequence[vehicle_id] = seq
+        slot = self.simulator.index.get(vehicle_id)
+        if slot is None:
+            return VehicleRecord(vehicle_id, latitude, longitude, time.time(), seq)
+        return VehicleRecord(vehicle_id, latitude, longitude, time.time(), seq,
+                             float(self.simulator.heading[slot]), float(self.simulator.speed[slot]))
+
+    async def broadcast_encoded(self, payload: str):
+        """Queue an already serialized frame for all connected clients"""
+        for client in self.connected_clients.values():
+            client.put_frame(payload)
+
+    async def broadcast_batch(self, entries: list):
+        """Queue a position batch for all connected clients.
 
-        bdct_client.txBroadcast(json.dumps({"id": id, "lat": lat, "long": long}))
+        Clients without a viewport share one serialized frame, subscribed
+        clients only get the vehicles inside their view.
+        """
+        with self.fanout_seconds.time():
+            version = self.state.apply(entries)
+            routed = self.viewports.route(entries)
+            payload = None
+            for websocket, client in self.connected_clients.items():
+                if websocket in routed:
+                    visible = routed[websocket]
+                    if visible:
+                        client.put_batch(visible, self.encode({
+                            "type": "position_batch",
+                            "version": version,
+                            "data": visible
+                        }), version)
+                    continue
+                if payload is None:
+                    payload = self.encode({
+                        "type": "position_batch",
+                        "version": version,
+                        "data": entries
+                    })
+                client.put_batch(entries, payload, version)
+
+    def send_pending_snapshots(self):
+        """Send the current snapshot to new clients that did not ask for state themselves"""
+        now = time.monotonic()
+        for websocket, due in list(self.pending_snapshots.items()):
+            if due <= now:
+                del self.pending_snapshots[websocket]
+                self.connected_clients[websocket].put_frame(self.state.snapshot())
+
+    def subscribe_viewport(self, websocket: websockets.WebSocketServerProtocol, request: dict):
+        """Restrict a client to the vehicles inside its map view and send the ones already there"""
+        south, west, north, east = map(float, request["bbox"])
+        visible = self.viewports.subscribe(websocket, south, west, north, east, int(request.get("zoom", 18)))
+        if visible:
+            self.connected_clients[websocket].put_batch(visible, json.dumps({
+                "type": "position_batch",
+                "version": self.state.version,
+                "data": visible
+            }), self.state.version)
+
+    def client_stats(self) -> list:
+        """Outbound queue state of every connected client"""
+        return [{
+            "client": f"{client.websocket.remote_address[0]}:{client.websocket.remote_address[1]}"
+                      if client.websocket.remote_address else None,
+            "queue_depth": client.depth,
+            "lag": round(client.lag, 3)
+        } for client in self.connected_clients.values()]
     
     async def update_vehicle_position(self, vehicle_id: str, latitude: float, longitude: float):
         """Update vehicle position and broadcast to clients"""
-        await self.broadcast_message({
+        entry = {
             "id": vehicle_id,
             "position": [latitude, longitude],
             "timestamp": datetime.now().isoformat()
+        }
+        await self.broadcast_message({**entry, "version": self.state.apply([entry])})
+        await self.send_alerts(self.check_proximity(vehicle_id, latitude, longitude))
+
+    async def send_position_batch(self):
+        """Send every vehicle that moved since the last tick as a single frame"""
+        rows = self.vehicles.take_dirty()
+        timestamp = datetime.now().isoformat()
+        changed = [{
+            "id": self.vehicles.slot_ids[row],
+            "position": [latitude, longitude],
+            "timestamp": timestamp
+        } for row, latitude, longitude in zip(rows.tolist(), self.vehicles.lat[rows].tolist(),
+                                              self.vehicles.lon[rows].tolist())]
+
+        if changed:
+            # All moved vehicles share as few mesh datagrams as the MTU allows
+            bdct_client.txRecords([self.make_record(u["id"], *u["position"]) for u in changed])
+            await self.broadcast_batch(changed)
+
+        alerts = []
+        for update in changed:
+            alerts.extend(self.check_proximity(update["id"], *update["position"]))
+        await self.send_alerts(alerts)
+
+    def check_proximity(self, vehicle_id, latitude: float, longitude: float) -> List[dict]:
+        """Return alerts for vehicles that came too close to this one"""
+        return [{
+            "vehicles": [vehicle_id, other_id],
+            "distance": round(distance, 1),
+            "timestamp": datetime.now().isoformat()
+        } for other_id, distance in self.proximity.update(vehicle_id, latitude, longitude)]
+
+    async def check_collisions(self):
+        """Broadcast the vehicle pairs that newly came on course to collide, soonest first"""
+        vehicles = self.vehicles
+        count = len(vehicles)
+        with self.collision_seconds.time():
+            risks = self.collisions.update(vehicles.slot_ids, vehicles.lat[:count], vehicles.lon[:count],
+                                           vehicles.measured[:count], self.sim_time, vehicles.heading[:count],
+                                           vehicles.speed[:count])
+        if risks:
+            timestamp = datetime.now().isoformat()
+            for risk in risks:
+                risk["timestamp"] = timestamp
+            await self.broadcast_message({
+                "type": "collision_risk",
+                "data": risks
+            })
+
+    async def check_geofences(self):
+        """Broadcast the geofences vehicles entered or left since the last check"""
+        if not self.geofences.fences:
+            return
+        vehicles = self.vehicles
+        count = len(vehicles)
+        # Only vehicles that moved can have crossed a fence, unless a fence was just added
+        rows = np.arange(count) if self.geofence_rescan else np.flatnonzero(vehicles.dirty[:count])
+        self.geofence_rescan = False
+        if not len(rows):
+            return
+        with self.geofence_seconds.time():
+            entered, exited = self.geofences.update_many([vehicles.slot_ids[row] for row in rows.tolist()],
+                                                         vehicles.lat[rows], vehicles.lon[rows])
+        timestamp = datetime.now().isoformat()
+        for message_type, crossings in (("geofence_enter", entered), ("geofence_exit", exited)):
+            if crossings:
+                await self.broadcast_message({
+                    "type": message_type,
+                    "data": [{
+                        "vehicle": vehicle_id,
+                        "fence": fence_id,
+                        "name": self.geofences.fences[fence_id].name,
+                        "timestamp": timestamp
+                    } for vehicle_id, fence_id in crossings]
+                })
+
+    def geofences_message(self) -> dict:
+        return {"type": "geofences", "data": [fence.to_dict() for fence in self.geofences.fences.values()]}
+
+    async def add_geofence(self, data: dict):
+        """Index a circle or polygon fence sent by a client and tell every client about it"""
+        fence_id = data.get("id")
+        if fence_id is None:
+            while self.next_geofence_id in self.geofences.fences:
+                self.next_geofence_id += 1
+            fence_id = self.next_geofence_id
+        self.geofences.add(Geofence.from_message(fence_id, data))
+        self.geofence_rescan = True
+        await self.broadcast_message(self.geofences_message())
+
+    async def update_heatmap(self):
+        """Add the samples of the ticks since the last update to the density grids once every heatmap interval"""
+        now = time.time()
+        if now < self.heatmap_due:
+            return
+        self.heatmap_due = now + self.heatmap_interval
+        samples, self.heatmap_samples = self.heatmap_samples, []
+        timestamps, lats, lons = ((np.concatenate(column) for column in zip(*samples)) if samples
+                                  else (np.zeros(0), np.zeros(0), np.zeros(0)))
+        # Binning runs off the event loop; the sample arrays are copies it owns.
+        # Samples carry simulated times, so the window is in simulated seconds too.
+        with self.heatmap_seconds.time():
+            await asyncio.to_thread(self.heatmap.update, timestamps, lats, lons, self.sim_time)
+
+    async def send_alerts(self, alerts: List[dict]):
+        """Broadcast proximity alerts as a single frame"""
+        if alerts:
+            await self.broadcast_message({
+                "type": "proximity_alerts",
+                "data": alerts
+            })
+    
+    async def send_history(self, websocket: websockets.WebSocketServerProtocol, request: dict):
+        """Reply with the recorded trajectory of one or many vehicles in a time window"""
+        vehicle_ids = request.get("vehicles")
+        if vehicle_ids is not None:
+            # Address based ids arrive as JSON lists
+            vehicle_ids = [tuple(v) if isinstance(v, list) else v for v in vehicle_ids]
+        trajectories = self.history.query(
+            vehicle_ids,
+            float(request.get("start", float("-inf"))),
+            float(request.get("end", float("inf")))
+        )
+        # Large replies are encoded off the event loop so live updates keep flowing
+        payload = await asyncio.to_thread(json.dumps, {
+            "type": "history",
+            "data": trajectories
         })
+        if websocket in self.connected_clients:
+            self.connected_clients[websocket].put_frame(payload)
     
     async def handle_client_message(self, websocket: websockets.WebSocketServerProtocol, message: str):
         """Handle incoming messages from clients"""
         try:
             data = json.loads(message)
             message_type = data.get("type")
-            print("Message type: ", message_type)
+            logger.debug(f"Message type: {message_type}")
             if message_type == "request_positions":
-                await websocket.send(json.dumps({
-                    "type": "position_update",
-                    "data": [
-                    {"id": 1, "position": [13.134407425677608, 77.56936729614509], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 2, "position": [13.135633790624643, 77.56791730038407], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 3, "position": [13.134933169146414, 77.56856909994178], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 4, "position": [13.135669510376736, 77.56915069919188], "timestamp": "2021-09-01T12:00:00"},
-                    {"id": 5, "position": [13.134405252127834, 77.5703374633789], "timestamp": "2021-09-01T12:00:00"},
-                ]
-                }))
+                self.pending_snapshots.pop(websocket, None)
+                self.connected_clients[websocket].put_frame(self.state.snapshot())
+
+            elif message_type == "resume":
+                self.pending_snapshots.pop(websocket, None)
+                for payload in self.state.resume(data.get("epoch"), data.get("version")):
+                    self.connected_clients[websocket].put_frame(payload)
             
+            elif message_type == "request_client_stats":
+                self.connected_clients[websocket].put_frame(json.dumps({
+                    "type": "client_stats",
+                    "data": self.client_stats()
+                }))
+
+            elif message_type == "subscribe_bbox":
+                self.subscribe_viewport(websocket, data)
+
+            elif message_type == "unsubscribe_bbox":
+                self.viewports.unsubscribe(websocket)
+
+            elif message_type == "request_history":
+                await self.send_history(websocket, data)
+
+            elif message_type == "add_geofence":
+                await self.add_geofence(data)
+
+            elif message_type == "remove_geofence":
+                if self.geofences.remove(data.get("id")):
+                    await self.broadcast_message(self.geofences_message())
+
+            elif message_type == "request_geofences":
+                self.connected_clients[websocket].put_frame(json.dumps(self.geofences_message()))
+
             elif message_type == "update_position":
                 vehicle_data = data.get("data", {})
                 await self.update_vehicle_position(
@@ -189,22 +602,46 @@ class MapWebSocketSim:
             await self.unregister(websocket)
             
     async def periodic_update(self):
-        """Continuously update vehicle positions in a random order"""
+        """Advance the simulation and send the new vehicle positions every tick"""
+        interval = 1 / self.tick_rate
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
         while True:
             try:
-                # Fetch new vehicle positions
-                positions = await fetch_vehicle_positions()
-                for vehicle_id, position in positions.items():
-                    # Update vehicle positions
-                    await self.update_vehicle_position(vehicle_id, position[0], position[1])
-                    logger.info(f"Updated vehicle {vehicle_id} to position {position}")
-                
-                # Wait before next update
-                await asyncio.sleep(3)
-                    
+                # Whatever is still queued from the last tick is backlog
+                for client in self.connected_clients.values():
+                    self.queue_depth.observe(client.depth)
+                self.send_pending_snapshots()
+                with self.tick_seconds.time():
+                    simulator = self.simulator
+                    simulator.step(interval * self.time_warp)
+                    self.sim_time += interval * self.time_warp
+                    now = self.sim_time
+                    self.vehicles.update_many(simulator.vehicle_ids, simulator.lat, simulator.lon, now,
+                                              simulator.speed, simulator.heading)
+                    self.history.append_many(simulator.vehicle_ids, now, simulator.lat, simulator.lon,
+                                             simulator.speed)
+                    if self.heatmap:
+                        # Each step assigns new lat/lon arrays, so these stay as they are at this tick
+                        self.heatmap_samples.append((np.full(len(simulator.lat), now), simulator.lat, simulator.lon))
+                    # Before the batch is sent, while the vehicles that moved are still marked
+                    await self.check_geofences()
+                    if self.batch_updates:
+                        await self.send_position_batch()
+                    else:
+                        for vehicle_id in self.vehicles.slot_ids:
+                            # Update vehicle positions
+                            await self.update_vehicle_position(vehicle_id, *self.vehicles.position(vehicle_id))
+                        self.vehicles.take_dirty()
+                    await self.check_collisions()
+                if self.heatmap:
+                    await self.update_heatmap()
             except Exception as e:
                 logger.error(f"Error during periodic update: {str(e)}")
-                await asyncio.sleep(1)
+
+            # Fixed rate ticks: sleep until the next tick rather than a full interval
+            next_tick = max(next_tick + interval, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
     
     
     async def start_server(self):
@@ -212,14 +649,50 @@ class MapWebSocketSim:
         # ssl_context.load_cert_chain('server.crt', 'server.key')
 
         """Start the WebSocket server and wait for clients."""
+        asyncio.create_task(monitor_event_loop(self.loop_lag_seconds))
+        if self.metrics_port is not None:
+            # The profiler samples this thread, which runs the event loop
+            MetricsServer(self.metrics, port=self.metrics_port,
+                          profiler=SamplingProfiler(threading.get_ident())).start()
+        if self.heatmap:
+            TileServer(None, port=self.heatmap_port, overlays={"heatmap": self.heatmap}).start()
         async with websockets.serve(self.handler, self.host, self.port):
             logger.info(f"WebSocket server started on wss://{self.host}:{self.port}")
             await asyncio.Future()  # Keep the server running
 
 # Example usage
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulated vehicle fleet websocket server")
+    parser.add_argument("--routes", help="JSON file with routes and vehicles, see FleetSimulator.from_file")
+    parser.add_argument("--vehicles", type=int, help="number of vehicles to spread over the routes")
+    parser.add_argument("--random-routes", type=int,
+                        help="generate this many random routes around the built-in ones instead of using them")
+    parser.add_argument("--seed", type=int, default=0, help="random seed for vehicle placement and speeds")
+    parser.add_argument("--tick-rate", type=float, default=1.0, help="position updates per second")
+    parser.add_argument("--time-warp", type=float, default=1.0, help="simulated seconds per real second")
+    parser.add_argument("--metrics-port", type=int, help="serve Prometheus metrics on this local port")
+    parser.add_argument("--heatmap-port", type=int, help="serve vehicle density tiles at /heatmap/ on this port")
+    parser.add_argument("--export-routes", metavar="PATH",
+                        help="write the routes to a JSON file for extraction/corridor.py and exit")
+    args = parser.parse_args()
+
+    if args.routes:
+        simulator = FleetSimulator.from_file(args.routes, seed=args.seed, vehicle_count=args.vehicles)
+    else:
+        routes = list(WaypointManager().vehicle_paths.values())
+        if args.random_routes:
+            center = np.mean([point for route in routes for point in route], axis=0).tolist()
+            routes = FleetSimulator.generate_routes(args.random_routes, center, seed=args.seed)
+        simulator = FleetSimulator.generate(routes, args.vehicles or len(routes), seed=args.seed)
+
+    if args.export_routes:
+        with open(args.export_routes, "w") as file:
+            json.dump({"routes": simulator.routes()}, file)
+        logger.info(f"Wrote {len(simulator.routes())} routes to {args.export_routes}")
+        raise SystemExit
     # Create and start the server
-    server = MapWebSocketSim(port=8765)
+    server = MapWebSocketSim(port=8765, simulator=simulator, tick_rate=args.tick_rate, time_warp=args.time_warp,
+                             metrics_port=args.metrics_port, heatmap_port=args.heatmap_port)
     
     # Run the server
     try:
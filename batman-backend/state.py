@@ -0,0 +1,109 @@
+"""State
+
+Versioned vehicle state with a cached snapshot and a log of recent deltas.
+
+Every position batch or departure sent to clients bumps the version by one.
+The full state is serialized into a snapshot frame at most once per version,
+however many clients ask for it, so a fleet of dashboards reconnecting after
+a network blip costs one encode instead of one per client.
+
+A reconnecting client sends the epoch and the last version it saw. If that
+version is still covered by the delta log it only gets what changed since,
+merged into one batch, again encoded once per starting version. Otherwise,
+or when the server restarted in between (a new epoch), it gets the snapshot.
+"""
+
+import json
+import uuid
+from collections import deque
+from typing import Deque, Dict, Hashable, List, Optional, Set, Tuple
+
+# Seconds a new client has to resume or request state before the snapshot is pushed to it
+SNAPSHOT_GRACE = 0.5
+
+
+class VersionedState:
+    """Latest entry of every vehicle, versioned per change.
+
+    Attributes
+    ----------
+    epoch : str
+        identifies this server run, versions are only comparable within one
+    version : int
+        incremented by every ``apply``, or set by it when workers follow the
+        versions of a shared ingest process
+    max_deltas : int
+        versions a client can fall behind and still resume with deltas
+
+    Methods
+    -------
+    apply(changed, removed)
+        records one batch of changes and returns its version
+    snapshot()
+        the serialized full state
+    resume(epoch, version)
+        the serialized frames bringing a client at ``version`` up to date
+    """
+
+    def __init__(self, max_deltas: int = 300, epoch: Optional[str] = None):
+        self.epoch = epoch or uuid.uuid4().hex[:12]
+        self.version = 0
+        self.max_deltas = max_deltas
+        self.entries: Dict[Hashable, dict] = {}
+        self.deltas: Deque[Tuple[int, List[dict], List[Hashable]]] = deque()
+        self._snapshot: Optional[str] = None
+        self._resume_cache: Dict[int, List[str]] = {}
+
+    def apply(self, changed: List[dict], removed: List[Hashable] = (), version: Optional[int] = None) -> int:
+        """Record a batch of changed entries and removed vehicles as the next version, or as ``version``"""
+        self.version = self.version + 1 if version is None else version
+        for entry in changed:
+            self.entries[entry["id"]] = entry
+        for vehicle_id in removed:
+            self.entries.pop(vehicle_id, None)
+        self.deltas.append((self.version, changed, list(removed)))
+        while len(self.deltas) > self.max_deltas:
+            self.deltas.popleft()
+        self._snapshot = None
+        self._resume_cache.clear()
+        return self.version
+
+    def snapshot(self) -> str:
+        """Full state as an ``initial_state`` frame, encoded once per version"""
+        if self._snapshot is None:
+            self._snapshot = json.dumps({
+                "type": "initial_state",
+                "epoch": self.epoch,
+                "version": self.version,
+                "data": list(self.entries.values())
+            })
+        return self._snapshot
+
+    def resume(self, epoch: Optional[str], version: Optional[int]) -> List[str]:
+        """Frames that bring a client that last saw ``version`` up to date"""
+        oldest = self.deltas[0][0] if self.deltas else self.version + 1
+        if epoch != self.epoch or version is None or version > self.version or version < oldest - 1:
+            return [self.snapshot()]
+        frames = self._resume_cache.get(version)
+        if frames is None:
+            changed: Dict[Hashable, dict] = {}
+            removed: Set[Hashable] = set()
+            for delta_version, delta_changed, delta_removed in self.deltas:
+                if delta_version <= version:
+                    continue
+                for entry in delta_changed:
+                    changed[entry["id"]] = entry
+                    removed.discard(entry["id"])
+                for vehicle_id in delta_removed:
+                    changed.pop(vehicle_id, None)
+                    removed.add(vehicle_id)
+            frames = []
+            if removed:
+                frames.append(json.dumps({"type": "vehicle_left", "version": self.version, "data": list(removed)}))
+            if changed:
+                frames.append(json.dumps({"type": "position_batch", "version": self.version,
+                                          "data": list(changed.values())}))
+            # Tells the client which version it is at now, even if nothing it saw changed
+            frames.append(json.dumps({"type": "resumed", "epoch": self.epoch, "version": self.version}))
+            self._resume_cache[version] = frames
+        return frames
@@ -0,0 +1,80 @@
+import time
+
+import pytest
+
+import capture
+from capture import CaptureReader, CaptureWriter, Replayer
+from wire import VehicleRecord, decode_datagram, pack_datagrams
+
+
+def test_reopen_after_partial_chunk_appends_readable_data(tmp_path):
+    path = str(tmp_path / "mesh.vbcap")
+    writer = CaptureWriter(path)
+    writer.write(b"first", ("10.0.0.1", 1200), 100.0)
+    writer.close()
+    # Simulate a crash in the middle of writing the second chunk
+    with open(path, "ab") as file:
+        file.write(capture.CHUNK_HEADER.pack(capture.CHUNK_MAGIC, 0, 1, 101.0, 50, 0) + b"partial")
+    assert CaptureReader(path).truncated is False
+    reader = CaptureReader(path)
+    assert len(list(reader)) == 1 and reader.truncated
+
+    writer = CaptureWriter(path)
+    writer.write(b"second", ("10.0.0.2", 1200))
+    writer.close()
+
+    reader = CaptureReader(path)
+    assert [datagram.data for datagram in reader] == [b"first", b"second"]
+    assert not reader.truncated
+    assert reader.sessions == 2
+
+
+def test_later_sessions_get_their_own_clock(tmp_path, monkeypatch):
+    path = str(tmp_path / "mesh.vbcap")
+    monkeypatch.setattr(capture.time, "time", lambda: 1_000_000.0)
+    monkeypatch.setattr(capture.time, "monotonic", lambda: 50.0)
+    writer = CaptureWriter(path)
+    writer.write(b"first", ("10.0.0.1", 1200), 51.0)
+    writer.close()
+
+    # A later run, after a reboot: the monotonic clock started over
+    monkeypatch.setattr(capture.time, "time", lambda: 1_003_600.0)
+    monkeypatch.setattr(capture.time, "monotonic", lambda: 5.0)
+    writer = CaptureWriter(path)
+    writer.write(b"second", ("10.0.0.1", 1200), 7.0)
+    writer.close()
+
+    reader = CaptureReader(path)
+    first, second = list(reader)
+    assert reader.wall_time(first.received) == 1_000_001.0
+    assert reader.wall_time(second.received) == 1_003_602.0
+
+    # Replay skips the hour between the sessions
+    monkeypatch.undo()
+    schedule = list(Replayer(path, speed=1.0)._schedule())
+    assert [due for due, _, _ in schedule] == [0.0, 0.0]
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_datagrams_round_trip_across_chunks_and_replay_retimed(tmp_path, compress):
+    path = str(tmp_path / "mesh.vbcap")
+    # Received 0.2 s after it was measured
+    binary = pack_datagrams([VehicleRecord(1, 13.0, 77.5, time.time() - 0.2, 1)])[0]
+    received = time.monotonic()
+    sent = [(received + i * 0.001, binary if i % 2 else b'{"id": 2}', (f"10.0.0.{i}", 1200 + i)) for i in range(7)]
+    writer = CaptureWriter(path, chunk_records=3, compress=compress)
+    for at, data, addr in sent:
+        writer.write(data, addr, at)
+    writer.close()
+
+    assert [tuple(datagram) for datagram in CaptureReader(path)] == sent
+
+    time.sleep(0.3)
+    replayed = []
+    Replayer(path, speed=0).run(lambda data, addr: replayed.append((data, addr)))
+    assert [addr for _, addr in replayed] == [addr for _, _, addr in sent]
+    assert replayed[0][0] == b'{"id": 2}'
+    (record,) = decode_datagram(replayed[1][0])
+    # Binary records are moved to the replay time, keeping their age at reception
+    assert record.vehicle_id == 1
+    assert time.time() - record.timestamp == pytest.approx(0.2, abs=0.1)
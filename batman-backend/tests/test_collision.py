@@ -0,0 +1,80 @@
+import math
+
+import pytest
+
+from collision import EARTH_RADIUS_M, CollisionPredictor
+
+# Two vehicles 40 m apart driving head on at 5 m/s
+IDS = [1, 2]
+LATS = [13.0, 13.0]
+LONS = [77.5, 77.5 + 40 / 108_400]
+
+
+def test_risk_is_reported_once_while_it_lasts():
+    predictor = CollisionPredictor()
+    first = predictor.update(IDS, LATS, LONS, 100.0, 100.0, [90.0, 270.0], [5.0, 5.0])
+    assert [set(risk["vehicles"]) for risk in first] == [{1, 2}]
+
+    assert predictor.update(IDS, LATS, LONS, 101.0, 101.0, [90.0, 270.0], [5.0, 5.0]) == []
+
+    # Once they turn away the risk clears, and it is reported again if it comes back
+    assert predictor.update(IDS, LATS, LONS, 102.0, 102.0, [270.0, 90.0], [5.0, 5.0]) == []
+    again = predictor.update(IDS, LATS, LONS, 103.0, 103.0, [90.0, 270.0], [5.0, 5.0])
+    assert [set(risk["vehicles"]) for risk in again] == [{1, 2}]
+
+
+def test_risks_cut_by_max_events_come_out_later():
+    predictor = CollisionPredictor(max_events=1)
+    ids = [1, 2, 3, 4]
+    lats = [13.0, 13.0, 13.01, 13.01]
+    lons = LONS + LONS
+    headings = [90.0, 270.0, 90.0, 270.0]
+    first = predictor.update(ids, lats, lons, 100.0, 100.0, headings, [5.0] * 4)
+    second = predictor.update(ids, lats, lons, 100.0, 100.0, headings, [5.0] * 4)
+    assert len(first) == len(second) == 1
+    assert first[0]["vehicles"] != second[0]["vehicles"]
+    assert predictor.update(ids, lats, lons, 100.0, 100.0, headings, [5.0] * 4) == []
+
+
+def test_silent_vehicle_keeps_its_velocity_from_motion():
+    # Crossing paths without reported speed or heading: A drives north and B east at 5 m/s,
+    # both reaching the crossing at t=10. B sends nothing at t=2 and t=3.
+    predictor = CollisionPredictor()
+    meters_per_degree = math.radians(EARTH_RADIUS_M)
+    events = []
+    b_time = 0.0
+    for now in range(7):
+        if now not in (2, 3):
+            b_time = float(now)
+        lats = [13.0 + (-50 + 5 * now) / meters_per_degree, 13.0]
+        lons = [77.5, 77.5 + (-50 + 5 * b_time) / (meters_per_degree * math.cos(math.radians(13.0)))]
+        events += predictor.update(IDS, lats, lons, [float(now), b_time], float(now))
+    assert [set(risk["vehicles"]) for risk in events] == [{1, 2}]
+
+
+def test_only_approaching_pairs_are_risks_soonest_first():
+    predictor = CollisionPredictor(horizon=10.0, radius_m=10.0)
+    ids = [1, 2, 3, 4, 5, 6, 7, 8]
+    # 1, 2 head on from 40 m; 3, 4 head on from 80 m; 5, 6 parked 3 m apart; 7, 8 driving apart
+    lats = LATS + [13.01, 13.01, 13.02, 13.02, 13.03, 13.03]
+    lons = LONS + [77.5, 77.5 + 80 / 108_400, 77.5, 77.5 + 3 / 108_400, 77.5, 77.5 + 3 / 108_400]
+    headings = [90.0, 270.0] * 2 + [0.0, 0.0, 270.0, 90.0]
+    speeds = [5.0] * 4 + [0.0, 0.0, 5.0, 5.0]
+
+    risks = predictor.update(ids, lats, lons, 100.0, 100.0, headings, speeds)
+
+    assert [set(risk["vehicles"]) for risk in risks] == [{1, 2}, {3, 4}]
+    assert risks[0]["time_to_closest"] == pytest.approx(4.0, abs=0.05)
+    assert risks[1]["time_to_closest"] == pytest.approx(8.0, abs=0.05)
+    assert risks[0]["distance"] < 1.0
+
+
+def test_velocity_comes_from_motion_without_heading_and_speed():
+    predictor = CollisionPredictor()
+    step = 5 / 108_400
+    assert predictor.update(IDS, LATS, LONS, 99.0, 99.0) == []
+
+    # Each closed 5 m in the last second, so they meet in about 3 s
+    risks = predictor.update(IDS, LATS, [LONS[0] + step, LONS[1] - step], 100.0, 100.0)
+    assert [set(risk["vehicles"]) for risk in risks] == [{1, 2}]
+    assert risks[0]["time_to_closest"] == pytest.approx(3.0, abs=0.05)
@@ -0,0 +1,32 @@
+from freshness import ExpiryQueue, SequenceTracker
+
+
+def test_duplicates_and_reordered_records_are_rejected():
+    tracker = SequenceTracker(reset_after=30.0)
+    assert tracker.accept("a", 10, 0.0)
+    assert not tracker.accept("a", 10, 1.0)
+    assert not tracker.accept("a", 9, 1.0)
+    assert tracker.accept("a", 11, 2.0)
+    assert (tracker.duplicates, tracker.out_of_order) == (1, 1)
+    # Sources are tracked separately, and a source silent for reset_after is taken to have restarted
+    assert tracker.accept("b", 1, 2.0)
+    assert tracker.accept("a", 1, 40.0)
+
+
+def test_vehicles_expire_after_their_last_touch():
+    queue = ExpiryQueue(ttl=10.0)
+    queue.touch("a", 0.0)
+    queue.touch("b", 0.0)
+    queue.touch("a", 5.0)
+    assert queue.expire(12.0) == ["b"]
+    assert len(queue) == 1
+    assert queue.expire(14.0) == []
+    assert queue.expire(16.0) == ["a"]
+
+
+def test_heap_is_compacted_under_frequent_touches():
+    queue = ExpiryQueue(ttl=10.0)
+    for t in range(1000):
+        queue.touch("a", float(t))
+    assert len(queue.heap) <= 2 * len(queue) + 64
+    assert queue.expire(1008.0) == [] and queue.expire(1010.0) == ["a"]
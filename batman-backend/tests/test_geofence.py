@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+from geofence import Geofence, GeofenceIndex
+from proximity import METERS_PER_DEGREE_LAT
+
+SQUARE = [[13.0, 77.5], [13.0, 77.51], [13.01, 77.51], [13.01, 77.5]]
+
+
+def test_circle_and_polygon_contain_points():
+    circle = Geofence(1, "circle", center=[13.0, 77.5], radius=100)
+    offsets = np.array([90.0, 110.0]) / METERS_PER_DEGREE_LAT
+    assert circle.contains(13.0 + offsets, np.array([77.5, 77.5])).tolist() == [True, False]
+
+    polygon = Geofence(2, "polygon", points=SQUARE)
+    assert polygon.contains(np.array([13.005, 13.02, 13.005]), np.array([77.505, 77.505, 77.52])).tolist() == \
+        [True, False, False]
+
+    with pytest.raises(ValueError):
+        Geofence(3, "circle", center=[13.0, 77.5], radius=0)
+    with pytest.raises(ValueError):
+        Geofence(4, "polygon", points=SQUARE[:2])
+
+
+def test_each_crossing_is_reported_once():
+    index = GeofenceIndex()
+    index.add(Geofence("zone", "polygon", points=SQUARE))
+    assert index.update_many(["a", "b"], [13.005, 13.1], [77.505, 77.5]) == ([("a", "zone")], [])
+    assert index.update_many(["a"], [13.006], [77.506]) == ([], [])
+    assert index.update_many(["a"], [np.nan], [np.nan]) == ([], [("a", "zone")])
+
+    # A vehicle already inside a fence added later enters it on its next update
+    index.add(Geofence("big", "circle", center=[13.1, 77.5], radius=50_000))
+    assert "big" in index.large
+    assert index.update_many(["b"], [13.1], [77.5]) == ([("b", "big")], [])
+    index.remove_vehicle("b")
+    assert "b" not in index.members["big"]
+    assert index.remove("big") and not index.remove("big")
+
+
+def test_matches_brute_force():
+    rng = np.random.default_rng(3)
+    fences = [Geofence(i, "circle", center=[13.0 + rng.uniform(-0.05, 0.05), 77.5 + rng.uniform(-0.05, 0.05)],
+                       radius=rng.uniform(50, 2000)) for i in range(50)]
+    index = GeofenceIndex()
+    for fence in fences:
+        index.add(fence)
+    lats, lons = 13.0 + rng.uniform(-0.06, 0.06, 2000), 77.5 + rng.uniform(-0.06, 0.06, 2000)
+    entered, _ = index.update_many(range(2000), lats, lons)
+    expected = {(i, fence.id) for fence in fences for i in np.flatnonzero(fence.contains(lats, lons)).tolist()}
+    assert set(entered) == expected
@@ -0,0 +1,51 @@
+import numpy as np
+
+from heatmap import DensityHeatmap
+
+
+def rebinned(heatmap, timestamps, lats, lons, now):
+    """Grids a fresh heatmap builds from every sample still in the window at once"""
+    fresh = DensityHeatmap(heatmap.min_zoom, heatmap.max_zoom, heatmap.cells, heatmap.window)
+    fresh.update(timestamps, lats, lons, now)
+    return fresh.grids
+
+
+def assert_same_grids(actual, expected):
+    assert actual.keys() == expected.keys()
+    for key, (local, counts) in expected.items():
+        assert np.array_equal(actual[key][0], local) and np.array_equal(actual[key][1], counts)
+
+
+def test_incremental_updates_match_a_full_rebin():
+    rng = np.random.default_rng(1)
+    heatmap = DensityHeatmap(min_zoom=12, max_zoom=15, window=30.0)
+    timestamps, lats, lons = np.zeros(0), np.zeros(0), np.zeros(0)
+    for now in np.arange(100.0, 200.0, 5.0):
+        # Some samples arrive a little late, one is already too old to count
+        new_times = now - rng.uniform(0, 8, 200)
+        new_times[0] = now - 40
+        new_lats = 12.97 + rng.normal(0, 0.01, 200)
+        new_lons = 77.59 + rng.normal(0, 0.01, 200)
+        heatmap.update(new_times, new_lats, new_lons, now)
+        timestamps = np.concatenate((timestamps, new_times))
+        lats = np.concatenate((lats, new_lats))
+        lons = np.concatenate((lons, new_lons))
+        assert_same_grids(heatmap.grids, rebinned(heatmap, timestamps, lats, lons, now))
+
+
+def test_only_tiles_that_changed_are_invalidated():
+    heatmap = DensityHeatmap(min_zoom=14, max_zoom=14, window=10.0)
+    assert heatmap.update([100.0, 100.0], [12.97, 13.05], [77.59, 77.70], 100.0) == 2
+    first, second = sorted(heatmap.grids)
+    etag = heatmap.get_tile(*first)[0]
+    assert heatmap.update([], [], [], 105.0) == 0
+
+    # A sample in the second tile leaves the first one's cached image alone
+    assert heatmap.update([106.0, 106.0], [13.05, 13.05], [77.70, 77.70], 106.0) == 1
+    assert heatmap.get_tile(*first)[0] == etag and heatmap.renders == 1
+
+    # The original samples expire: the first tile empties, the second loses one count
+    assert heatmap.update([], [], [], 111.0) == 2
+    assert list(heatmap.grids) == [second] and heatmap.get_tile(*first)[0] == "empty"
+    assert heatmap.update([], [], [], 117.0) == 1
+    assert heatmap.grids == {} and heatmap.sample_count == 0
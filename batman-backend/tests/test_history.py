@@ -0,0 +1,16 @@
+import numpy as np
+
+from history import TrajectoryHistory
+
+
+def test_removed_vehicle_leaves_no_samples_behind():
+    history = TrajectoryHistory(capacity=10, initial_vehicles=4)
+    for t in range(5):
+        history.append("A", 100.0 + t, 13.0, 77.0)
+        history.append("B", 100.0 + t, 13.1, 77.1)
+    history.remove("A")
+    history.append("C", 105.0, 13.2, 77.2)
+
+    assert [entry["lat"] for entry in history.query(["B", "C"])] == [[13.1] * 5, [13.2]]
+    # Only the five samples of B and the one of C are left anywhere in the buffers
+    assert np.count_nonzero(~np.isnan(history.timestamps)) == 6
@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+import pytest
+
+from main import MapWebSocketServer
+
+
+@pytest.fixture
+def server():
+    return MapWebSocketServer(use_ssl=False, metrics_port=None)
+
+
+def test_losing_fix_drops_vehicle_from_proximity_alerts(server):
+    assert server.store_position("a", 13.0, 77.5) == []
+    server.store_position("a", None, None)
+    assert "a" not in server.proximity.positions
+    # A vehicle arriving where "a" last was is not alerted against it
+    assert server.store_position("b", 13.0, 77.5) == []
+
+
+def test_client_position_goes_out_once_with_the_next_batch(server):
+    sent = []
+
+    async def broadcast_message(message):
+        sent.append(("message", message["type"] if "type" in message else message["id"]))
+
+    async def broadcast_batch(entries, version=None):
+        sent.append(("batch", [entry["id"] for entry in entries]))
+
+    server.broadcast_message, server.broadcast_batch = broadcast_message, broadcast_batch
+    update = json.dumps({"type": "update_position", "data": {"id": "a", "latitude": 13.0, "longitude": 77.5}})
+
+    async def run():
+        await server.handle_client_message(None, update)
+        assert sent == []
+        await server.send_position_batch()
+
+    asyncio.run(run())
+    assert sent == [("batch", ["a"])]
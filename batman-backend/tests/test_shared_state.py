@@ -0,0 +1,93 @@
+import json
+
+import pytest
+
+from shared_state import FrameRing, PositionTable
+from viewport import ViewportIndex
+
+
+@pytest.fixture
+def tables():
+    writer = PositionTable(capacity=8)
+    reader = PositionTable(writer.name)
+    yield writer, reader
+    reader.close()
+    writer.close(unlink=True)
+
+
+def test_vehicle_without_fix_comes_back_as_none(tables):
+    writer, reader = tables
+    writer.publish([
+        {"id": "a", "position": [None, None], "timestamp": "2026-01-01T00:00:00"},
+        {"id": "b", "position": [13.0, 77.5], "timestamp": "2026-01-01T00:00:00"},
+    ], [], 1)
+    entries, _, removed, version = reader.poll()
+    assert version == 1 and removed == []
+    assert {entry["id"]: entry["position"] for entry in entries} == {"a": [None, None], "b": [13.0, 77.5]}
+    # Strict JSON, as the frontend's JSON.parse needs
+    json.dumps(entries, allow_nan=False)
+
+    viewports = ViewportIndex()
+    viewports.subscribe("client", 12.9, 77.4, 13.1, 77.6, 16)
+    routed = viewports.route(entries)
+    assert [entry["id"] for entry in routed["client"]] == ["b"]
+
+
+def test_frame_ring_carries_each_frame_kind():
+    writer = FrameRing(slots=4, slot_size=1024)
+    reader = FrameRing(writer.name)
+    try:
+        writer.put('{"type":"geofences","data":[]}', "geofences")
+        writer.put("{}")
+        assert list(reader.frames()) == [("geofences", '{"type":"geofences","data":[]}'), ("", "{}")]
+    finally:
+        reader.close()
+        writer.close(unlink=True)
+
+
+def entry(vehicle_id, lat, lon):
+    return {"id": vehicle_id, "position": [lat, lon], "timestamp": "2026-01-01T00:00:00"}
+
+
+def test_poll_returns_changes_and_departures_since_the_last_poll():
+    writer = PositionTable(capacity=2)
+    reader = PositionTable(writer.name)
+    try:
+        writer.publish([entry("a", 13.0, 77.5), entry(("10.0.0.2", 1200), 13.1, 77.6)], [], 1, [10.0, 11.0])
+        entries, measured, removed, version = reader.poll()
+        assert [e["id"] for e in entries] == ["a", ("10.0.0.2", 1200)] and measured == [10.0, 11.0]
+        assert (removed, version) == ([], 1)
+
+        # Only rows changed since the last poll, however many versions went by
+        writer.publish([entry("a", 13.2, 77.5)], [], 2)
+        writer.publish([entry("a", 13.3, 77.5)], [], 3)
+        entries, _, removed, version = reader.poll()
+        assert [e["position"] for e in entries] == [[13.3, 77.5]] and version == 3
+        assert reader.poll() == ([], [], [], 3)
+
+        # A departed vehicle's row is reused before the reader polls again
+        writer.publish([], [("10.0.0.2", 1200)], 4)
+        writer.publish([entry("c", 13.4, 77.7)], [], 5)
+        entries, _, removed, version = reader.poll()
+        assert [e["id"] for e in entries] == ["c"]
+        assert removed == [("10.0.0.2", 1200)] and version == 5
+
+        writer.publish([], ["c"], 6)
+        assert reader.poll() == ([], [], ["c"], 6)
+    finally:
+        reader.close()
+        writer.close(unlink=True)
+
+
+def test_lapped_frame_ring_reader_skips_what_it_missed():
+    writer = FrameRing(slots=4, slot_size=64)
+    reader = FrameRing(writer.name)
+    try:
+        for i in range(6):
+            writer.put(str(i))
+        writer.put("x" * 64)
+        assert [frame for _, frame in reader.frames()] == ["2", "3", "4", "5"]
+        assert reader.skipped == 2
+    finally:
+        reader.close()
+        writer.close(unlink=True)
@@ -0,0 +1,43 @@
+import asyncio
+
+import numpy as np
+
+import sim
+from sim import MapWebSocketSim
+
+
+class FakeWebSocket:
+    remote_address = ("127.0.0.1", 50000)
+
+    async def send(self, payload):
+        pass
+
+
+class FakeBroadcast:
+    def txRecords(self, records):
+        pass
+
+
+def test_reconnects_share_one_update_loop_on_the_simulated_clock(monkeypatch):
+    monkeypatch.setattr(sim, "bdct_client", FakeBroadcast())
+    server = MapWebSocketSim(tick_rate=50.0, time_warp=10.0)
+    start = server.sim_time
+    steps = []
+    step = server.simulator.step
+    monkeypatch.setattr(server.simulator, "step", lambda dt: (steps.append(dt), step(dt)))
+
+    async def run():
+        for _ in range(3):
+            websocket = FakeWebSocket()
+            await server.register(websocket)
+            await asyncio.sleep(0.05)
+            await server.unregister(websocket)
+        loops = [task for task in asyncio.all_tasks() if task.get_coro().__name__ == "periodic_update"]
+        server.update_task.cancel()
+        return loops
+
+    assert len(asyncio.run(run())) == 1
+    # Every step advanced the clock by the warped interval, and the state is stamped with it
+    assert steps and set(steps) == {0.2}
+    assert np.isclose(server.sim_time, start + 0.2 * len(steps))
+    assert np.allclose(server.vehicles.measured[:len(server.vehicles)], server.sim_time)
@@ -0,0 +1,110 @@
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+from main import MapWebSocketServer
+from vehicle_table import VehicleTable
+
+
+def test_remove_moves_last_row_into_the_gap():
+    table = VehicleTable(initial_capacity=2)
+    for i, vehicle_id in enumerate("abc"):
+        table.update(vehicle_id, 13.0 + i, 77.0 + i, 100.0, speed=float(i), heading=90.0)
+    table.remove("a")
+
+    assert table.slot_ids == ["c", "b"] and table.slots == {"c": 0, "b": 1}
+    assert table.position("c") == (15.0, 79.0) and table.speed[0] == 2.0
+    # The vacated row is reset, not left holding c's old values
+    assert np.isnan(table.lat[2]) and not table.dirty[2]
+    assert table.position("a") is None
+    table.remove("a")
+    assert len(table) == 2
+
+
+def test_dirty_only_when_position_changes():
+    table = VehicleTable()
+    table.update("a", 13.0, 77.0, 100.0)
+    assert table.take_dirty().tolist() == [0]
+    table.update("a", 13.0, 77.0, 101.0, speed=3.0)
+    assert table.take_dirty().tolist() == []
+
+    # Losing the fix is a change, staying without one is not
+    table.update("a", None, None, 102.0)
+    assert table.take_dirty().tolist() == [0] and table.position("a") == (None, None)
+    table.update("a", None, None, 103.0)
+    assert table.take_dirty().tolist() == []
+    table.update("a", 13.0, 77.0, 104.0)
+    assert table.take_dirty().tolist() == [0]
+
+
+def test_update_many_marks_new_and_moved_rows():
+    table = VehicleTable()
+    table.update_many(["a", "b", "c"], [13.0, np.nan, 13.2], [77.0, np.nan, 77.2], 100.0)
+    assert table.take_dirty().tolist() == [0, 1, 2]
+    table.update_many(["a", "b", "c"], [13.0, np.nan, 13.3], [77.0, np.nan, 77.2], 101.0)
+    assert table.take_dirty().tolist() == [2]
+    assert table.measured[:3].tolist() == [101.0] * 3
+
+
+@pytest.fixture
+def server():
+    server = MapWebSocketServer(use_ssl=False, metrics_port=None)
+    server.sent = []
+
+    async def broadcast_batch(entries, version=None):
+        server.sent.append({entry["id"]: entry for entry in entries})
+
+    server.broadcast_batch = broadcast_batch
+    return server
+
+
+def tick(server):
+    asyncio.run(server.send_position_batch())
+    return server.sent.pop() if server.sent else {}
+
+
+def test_tick_sends_moved_and_stale_moving_vehicles_only(server):
+    now = time.time()
+    server.vehicles.update("parked", 13.0, 77.0, now - 5, speed=0.0, heading=90.0)
+    server.vehicles.update("moving", 13.1, 77.1, now - 5, speed=10.0, heading=90.0)
+    server.vehicles.update("fresh", 13.2, 77.2, now, speed=10.0, heading=90.0)
+    server.vehicles.update("no_fix", None, None, now - 5)
+    assert set(tick(server)) == {"parked", "moving", "fresh", "no_fix"}
+
+    # Nothing was reported since: only the stale moving vehicle is extrapolated, every tick
+    for _ in range(2):
+        sent = tick(server)
+        assert list(sent) == ["moving"] and sent["moving"]["estimated"]
+        assert sent["moving"]["position"][1] > 77.1
+
+    # Its next real report replaces the estimate, and is not extrapolated further
+    server.vehicles.update("moving", 13.1, 77.1, time.time(), speed=10.0, heading=90.0)
+    sent = tick(server)
+    assert sent["moving"]["position"] == [13.1, 77.1] and "estimated" not in sent["moving"]
+    assert tick(server) == {}
+
+
+def test_estimate_is_corrected_when_vehicle_reports_it_stopped(server):
+    server.vehicles.update("a", 13.0, 77.0, time.time() - 5, speed=10.0, heading=0.0)
+    tick(server)
+    assert tick(server)["a"]["estimated"]
+    # Same position as before the gap, but the client was shown an estimate
+    server.vehicles.update("a", 13.0, 77.0, time.time(), speed=0.0, heading=0.0)
+    assert tick(server)["a"]["position"] == [13.0, 77.0]
+    assert tick(server) == {}
+
+
+def test_latency_is_only_observed_for_new_reports(server):
+    latency = server.ingest_to_send_seconds
+    server.vehicles.update("a", 13.0, 77.0, time.time(), speed=10.0, heading=0.0, seen=time.monotonic())
+    tick(server)
+    assert latency.count == 1
+    server.vehicles.measured[0] = time.time() - 5
+    assert tick(server)["a"]["estimated"]
+
+    # Too old to extrapolate: the last report is sent again, but it is not a new measurement
+    server.vehicles.measured[0] = time.time() - 30
+    assert "estimated" not in tick(server)["a"]
+    assert latency.count == 1
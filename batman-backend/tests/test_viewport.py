@@ -0,0 +1,80 @@
+import math
+
+from viewport import ViewportIndex
+
+
+def entry(vehicle_id, lat, lon):
+    return {"id": vehicle_id, "position": [lat, lon], "timestamp": "2024-01-01T00:00:00"}
+
+
+def test_route_skips_vehicles_without_fix():
+    index = ViewportIndex()
+    index.subscribe("client", 13.0, 77.5, 13.2, 77.7, 16)
+
+    routed = index.route([entry(7, None, None), entry(8, 13.1, 77.6), entry(9, math.nan, math.nan)])
+
+    assert [e["id"] for e in routed["client"]] == [8]
+    assert 7 not in index.entries and 9 not in index.entries
+
+
+def test_vehicle_losing_fix_is_unindexed_and_resent_on_return():
+    index = ViewportIndex()
+    index.subscribe("client", 13.0, 77.5, 13.2, 77.7, 16)
+    assert len(index.route([entry(8, 13.1, 77.6)])["client"]) == 1
+
+    # The client is told once that the vehicle lost its fix
+    assert [e["position"] for e in index.route([entry(8, None, None)])["client"]] == [[None, None]]
+    assert index.route([entry(8, None, None)])["client"] == []
+    assert 8 not in index.vehicle_tiles and not index.tile_vehicles
+
+    # Same position as before the gap is sent again, the client may have dropped it
+    assert len(index.route([entry(8, 13.1, 77.6)])["client"]) == 1
+
+
+def test_subscribe_ignores_vehicles_without_fix():
+    index = ViewportIndex()
+    index.route([entry(7, None, None), entry(8, 13.1, 77.6)])
+
+    visible = index.subscribe("client", 13.0, 77.5, 13.2, 77.7, 16)
+
+    assert [e["id"] for e in visible] == [8]
+
+
+def test_vehicle_crossing_into_unsubscribed_tile_gets_one_exit_update():
+    index = ViewportIndex(index_zoom=15)
+    # A view well inside one index tile, so the vehicle leaves it by changing tile
+    index.subscribe("client", 13.0, 77.5, 13.001, 77.501, 16)
+    assert len(index.route([entry(8, 13.0005, 77.5005)])["client"]) == 1
+
+    # Far away, in a tile nobody subscribed to: the final position is sent once
+    routed = index.route([entry(8, 13.1, 77.7)])["client"]
+    assert [e["position"] for e in routed] == [[13.1, 77.7]]
+    assert 8 not in index.viewports["client"].sent
+    assert index.route([entry(8, 13.2, 77.8)])["client"] == []
+
+    # Leaving the view without changing tile works the same way
+    assert len(index.route([entry(8, 13.0005, 77.5005)])["client"]) == 1
+    assert len(index.route([entry(8, 13.0012, 77.5005)])["client"]) == 1
+    assert index.route([entry(8, 13.0013, 77.5005)])["client"] == []
+
+
+def test_updates_go_only_to_clients_viewing_the_vehicle_and_are_thinned():
+    index = ViewportIndex(min_move_px=2.0)
+    index.route([entry(1, 13.1, 77.6), entry(2, 48.85, 2.35)])
+    assert [e["id"] for e in index.subscribe("bangalore", 13.0, 77.5, 13.2, 77.7, 16)] == [1]
+    assert [e["id"] for e in index.subscribe("paris", 48.8, 2.3, 48.9, 2.4, 16)] == [2]
+    # A world view is too large to list its tiles and sees everything
+    assert sorted(e["id"] for e in index.subscribe("world", -80.0, -179.0, 80.0, 179.0, 2)) == [1, 2]
+
+    routed = index.route([entry(1, 13.101, 77.6), entry(2, 48.851, 2.35)])
+    assert [e["id"] for e in routed["bangalore"]] == [1]
+    assert [e["id"] for e in routed["paris"]] == [2]
+    # At zoom 2 a hundred metres is well under a pixel
+    assert routed["world"] == []
+
+    # Under a pixel at zoom 16 is not resent
+    assert index.route([entry(1, 13.101, 77.60001)])["bangalore"] == []
+    assert len(index.route([entry(1, 13.101, 77.601)])["bangalore"]) == 1
+
+    index.unsubscribe("paris")
+    assert "paris" not in index.route([entry(2, 48.86, 2.35)])
@@ -0,0 +1,55 @@
+import pytest
+
+from freshness import SequenceTracker
+from wire import (MAX_DATAGRAM_SIZE, MAX_RECORDS_PER_DATAGRAM, VehicleRecord, decode_datagram, encode_json,
+                  is_packable, pack_datagrams)
+
+
+def roundtrip(record):
+    (datagram,) = pack_datagrams([record])
+    (decoded,) = decode_datagram(datagram)
+    return decoded
+
+
+def test_records_without_seq_are_not_duplicates():
+    tracker = SequenceTracker()
+    for i in range(3):
+        record = roundtrip(VehicleRecord(5, 13.0, 77.5 + i * 1e-4, 1000.0 + i))
+        assert record.seq is None
+        assert tracker.accept(5, record.seq, 1000.0 + i)
+    assert tracker.duplicates == 0
+
+
+def test_seq_wraps_past_zero():
+    assert roundtrip(VehicleRecord(5, 13.0, 77.5, 1000.0, seq=7)).seq == 7
+    assert roundtrip(VehicleRecord(5, 13.0, 77.5, 1000.0, seq=0xFFFFFFFF)).seq == 0xFFFFFFFF
+    wrapped = roundtrip(VehicleRecord(5, 13.0, 77.5, 1000.0, seq=0xFFFFFFFF + 1)).seq
+    assert wrapped == 1
+
+    tracker = SequenceTracker()
+    assert tracker.accept(5, 0xFFFFFFFF, 0.0)
+    assert tracker.accept(5, wrapped, 1.0)
+
+
+def test_many_records_pack_into_few_datagrams_and_round_trip():
+    records = [VehicleRecord(i, 13.0 + i * 1e-5, 77.5 - i * 1e-5, 1000.0 + i * 0.01, i + 1, 359.99, 12.34)
+               for i in range(MAX_RECORDS_PER_DATAGRAM + 10)]
+    datagrams = pack_datagrams(records)
+    assert len(datagrams) == 2 and all(len(datagram) <= MAX_DATAGRAM_SIZE for datagram in datagrams)
+
+    decoded = [record for datagram in datagrams for record in decode_datagram(datagram)]
+    assert [record.vehicle_id for record in decoded] == [record.vehicle_id for record in records]
+    for sent, received in zip(records, decoded):
+        assert received.lat == pytest.approx(sent.lat, abs=1e-7)
+        assert received.lon == pytest.approx(sent.lon, abs=1e-7)
+        assert received.timestamp == pytest.approx(sent.timestamp, abs=1e-3)
+        assert (received.seq, received.heading, received.speed) == (sent.seq, 359.99, 12.34)
+
+
+def test_legacy_json_and_garbage():
+    (record,) = decode_datagram(encode_json(VehicleRecord("car-1", 13.0, 77.5, 0.0)), received_at=5.0)
+    assert record == VehicleRecord("car-1", 13.0, 77.5, 5.0)
+    assert not is_packable(VehicleRecord("car-1", 13.0, 77.5, 0.0))
+    for garbage in (b"VB\x01", b"\xff\xfe", b"[1, 2]"):
+        with pytest.raises(ValueError):
+            decode_datagram(garbage)
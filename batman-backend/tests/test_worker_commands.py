@@ -0,0 +1,73 @@
+import asyncio
+import json
+
+import pytest
+
+from main import COMMAND_MAGIC, MapWebSocketServer
+from shared_state import FrameRing, PositionTable
+from wire import VehicleRecord, encode_json
+
+ADD = COMMAND_MAGIC + json.dumps({"type": "add_geofence", "id": "z", "center": [13.0, 77.5], "radius": 50}).encode()
+LOCAL = ("127.0.0.1", 40000)
+
+
+class FakeBroadcast:
+    def __init__(self):
+        self.pending = []
+
+    def rxPending(self):
+        pending, self.pending = self.pending, []
+        return pending
+
+
+class FakeCapture:
+    def __init__(self):
+        self.written = []
+
+    def write(self, data, addr, now):
+        self.written.append(data)
+
+
+def receive(server, *datagrams):
+    async def run():
+        server.bdct.pending.extend(datagrams)
+        server.on_broadcast_readable()
+        await asyncio.sleep(0)
+
+    asyncio.run(run())
+
+
+@pytest.fixture
+def ingest():
+    table, ring = PositionTable(capacity=8), FrameRing(slots=8, slot_size=4096)
+    reader = FrameRing(ring.name)
+    server = MapWebSocketServer(use_ssl=False, metrics_port=None, shared_table=table, shared_events=ring)
+    server.bdct, server.capture = FakeBroadcast(), FakeCapture()
+    yield server, reader
+    reader.close()
+    ring.close(unlink=True)
+    table.close(unlink=True)
+
+
+def test_forwarded_geofence_commands_are_published_through_the_ring(ingest):
+    server, reader = ingest
+    position = encode_json(VehicleRecord("v1", 13.0, 77.5, 0.0))
+    # Only workers on this host may send commands; malformed ones are dropped
+    receive(server, (ADD, ("10.0.0.7", 1200)))
+    assert not server.geofences.fences
+    receive(server, (ADD, LOCAL), (COMMAND_MAGIC + b"{not json", LOCAL), (position, ("10.0.0.7", 1200)))
+
+    assert list(server.geofences.fences) == ["z"]
+    kinds, frames = zip(*((kind, json.loads(frame)) for kind, frame in reader.frames()))
+    assert kinds == ("geofences",) and frames[0]["type"] == "geofences"
+    assert frames[0]["data"][0]["id"] == "z"
+    # Only the position is captured and counted as a mesh datagram
+    assert server.capture.written == [position]
+    assert server.stats["datagrams_received"] == 1
+
+
+def test_commands_are_ignored_without_workers():
+    server = MapWebSocketServer(use_ssl=False, metrics_port=None)
+    server.bdct, server.capture = FakeBroadcast(), FakeCapture()
+    receive(server, (ADD, LOCAL))
+    assert not server.geofences.fences and server.capture.written == []
@@ -0,0 +1,218 @@
+"""Tile server
+
+Serves map tiles out of an MBTiles archive over HTTP.
+
+Hot tiles are kept in an in-memory LRU cache so repeated map loads never
+touch the SD card. Every response carries an ETag (the tile's content hash)
+and a long Cache-Control lifetime, so browsers revalidate with a cheap 304
+instead of downloading the tile again.
+
+Tiles are addressed as ``/tiles/{z}/{x}/{y}.png`` in the XYZ scheme used by
+Leaflet and the ``bangalore_tiles`` directory.
+
+Live overlays such as the density heatmap are served alongside the archive
+as ``/{name}/{z}/{x}/{y}.png``. They change all the time, so browsers must
+revalidate them on every load, and keep their own cache of rendered tiles.
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import sys
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+TILE_PATH = re.compile(r"^/(\w+)/(\d+)/(\d+)/(\d+)\.png$")
+
+
+class TileCache:
+    """Thread-safe LRU cache of tiles bounded by total size in bytes"""
+
+    def __init__(self, max_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries: "OrderedDict[Tuple[int, int, int], Tuple[str, bytes]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Tuple[int, int, int]) -> Optional[Tuple[str, bytes]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: Tuple[int, int, int], entry: Tuple[str, bytes]):
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = entry
+            self.size += len(entry[1])
+            while self.size > self.max_bytes and self.entries:
+                _, (_, data) = self.entries.popitem(last=False)
+                self.size -= len(data)
+
+
+class MBTilesReader:
+    """Read-only access to an MBTiles archive with one connection per thread"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+        # Archives written by extraction/mbtiles.py have a map table with
+        # content hashes; plain archives only have a tiles table.
+        columns = {row[1] for row in self._connection().execute("PRAGMA table_info(map)")}
+        self.deduplicated = "tile_id" in columns
+
+    def _connection(self) -> sqlite3.Connection:
+        if not hasattr(self._local, "conn"):
+            self._local.conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        return self._local.conn
+
+    def get_tile(self, z: int, x: int, y: int) -> Optional[Tuple[str, bytes]]:
+        """Return (etag, data) for an XYZ tile, or None if it is not in the archive"""
+        row_index = (1 << z) - 1 - y
+        if self.deduplicated:
+            row = self._connection().execute(
+                "SELECT images.tile_id, images.tile_data FROM map JOIN images ON images.tile_id = map.tile_id "
+                "WHERE map.zoom_level = ? AND map.tile_column = ? AND map.tile_row = ?",
+                (z, x, row_index),
+            ).fetchone()
+            return (row[0], row[1]) if row else None
+
+        row = self._connection().execute(
+            "SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? AND tile_row = ?",
+            (z, x, row_index),
+        ).fetchone()
+        if not row:
+            return None
+        return (hashlib.md5(row[0]).hexdigest(), row[0])
+
+
+class TileServer:
+    """HTTP server for tiles from an MBTiles archive.
+
+    Attributes
+    ----------
+    reader : MBTilesReader
+        the archive tiles are served from, None to serve only overlays
+    cache : TileCache
+        in-memory cache of recently served tiles
+    overlays : dict
+        live tile layers by URL prefix, anything with a ``get_tile(z, x, y)``
+        returning (etag, data) or None
+
+    Methods
+    -------
+    serve_forever()
+        serves requests on the calling thread
+    start()
+        serves requests on a daemon thread
+    """
+
+    def __init__(self, mbtiles_path: Optional[str], host: str = "0.0.0.0", port: int = 8766,
+                 cache_bytes: int = 32 * 1024 * 1024, max_age: int = 86400, overlays: Optional[Dict] = None):
+        self.reader = MBTilesReader(mbtiles_path) if mbtiles_path else None
+        self.overlays = overlays or {}
+        self.cache = TileCache(cache_bytes)
+        self.max_age = max_age
+        self.httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self.httpd.daemon_threads = True
+
+    def lookup(self, z: int, x: int, y: int) -> Optional[Tuple[str, bytes]]:
+        """Return (etag, data) for a tile, going to the archive only on a cache miss"""
+        if self.reader is None:
+            return None
+        key = (z, x, y)
+        entry = self.cache.get(key)
+        if entry is None:
+            entry = self.reader.get_tile(z, x, y)
+            if entry is not None:
+                self.cache.put(key, entry)
+        return entry
+
+    def _make_handler(self):
+        server = self
+
+        class TileRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?", 1)[0]
+                match = TILE_PATH.match(path)
+                if not match:
+                    self._respond(404, "text/plain", b"Not found")
+                    return
+
+                layer = match.group(1)
+                z, x, y = map(int, match.groups()[1:])
+                if layer == "tiles":
+                    entry = server.lookup(z, x, y)
+                    cache_control = f"public, max-age={server.max_age}"
+                elif layer in server.overlays:
+                    entry = server.overlays[layer].get_tile(z, x, y)
+                    cache_control = "no-cache"
+                else:
+                    self._respond(404, "text/plain", b"Not found")
+                    return
+                if entry is None:
+                    self._respond(404, "text/plain", b"Tile not found")
+                    return
+
+                etag, data = entry
+                etag = f'"{etag}"'
+                headers = {"ETag": etag, "Cache-Control": cache_control}
+                if self.headers.get("If-None-Match") == etag:
+                    self._respond(304, None, b"", headers)
+                else:
+                    self._respond(200, "image/png", data, headers)
+
+            def _respond(self, status, content_type, body, headers=None):
+                self.send_response(status)
+                if content_type:
+                    self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.send_header("Access-Control-Allow-Origin", "*")
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                if body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logger.debug(format, *args)
+
+        return TileRequestHandler
+
+    def serve_forever(self):
+        logger.info(f"Tile server started on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}")
+        self.httpd.serve_forever()
+
+    def start(self) -> threading.Thread:
+        thread = threading.Thread(target=self.serve_forever, daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+# Example usage: python tile_server.py ../extraction/bangalore_tiles.mbtiles
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    server = TileServer(sys.argv[1] if len(sys.argv) > 1 else "bangalore_tiles.mbtiles")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logger.info("Tile server stopped by user")
@@ -0,0 +1,167 @@
+"""Vehicle table
+
+Latest state of every tracked vehicle in NumPy columns.
+
+Each vehicle owns one row, found through ``slots``. Rows are kept contiguous
+(removing a vehicle moves the last row into its place), so ``[:len(table)]``
+of any column covers exactly the live vehicles and per-tick work such as
+finding what changed, gap filling or collision prediction runs over whole
+arrays instead of one dict entry per vehicle.
+
+Times are epoch seconds (``measured``, when the sender took the position)
+and monotonic seconds (``seen``, when this process received it). Unknown
+values are NaN. ``dirty`` marks rows whose position changed since they were
+last sent to clients.
+"""
+
+from typing import Dict, Hashable, Iterable, List, Optional
+
+import numpy as np
+
+COLUMNS = {
+    "lat": (np.float64, np.nan),
+    "lon": (np.float64, np.nan),
+    "heading": (np.float64, np.nan),
+    "speed": (np.float64, np.nan),
+    "measured": (np.float64, np.nan),
+    "seen": (np.float64, np.nan),
+    "dirty": (np.bool_, False),
+    # Whether the position last sent was extrapolated rather than reported
+    "estimated": (np.bool_, False),
+}
+
+
+def _value(value: Optional[float]) -> float:
+    return np.nan if value is None else value
+
+
+class VehicleTable:
+    """Columnar store of the latest position and motion of every vehicle.
+
+    Attributes
+    ----------
+    slots : dict
+        row index of every vehicle
+    slot_ids : list
+        vehicle id of every row
+    lat, lon, heading, speed, measured, seen : np.ndarray
+        one value per row, NaN when unknown
+    dirty, estimated : np.ndarray
+        per row flags
+
+    Methods
+    -------
+    update(vehicle_id, lat, lon, measured, speed, heading, seen)
+        stores one vehicle's latest report
+    update_many(vehicle_ids, lats, lons, measured, speeds, headings)
+        stores the latest report of many vehicles at once
+    take_dirty()
+        returns the rows that changed since the last call and clears them
+    remove(vehicle_id)
+        forgets a vehicle
+    """
+
+    def __init__(self, initial_capacity: int = 64):
+        self.slots: Dict[Hashable, int] = {}
+        self.slot_ids: List[Hashable] = []
+        self._allocate(max(1, initial_capacity))
+
+    def _allocate(self, rows: int):
+        for name, (dtype, fill) in COLUMNS.items():
+            new = np.full(rows, fill, dtype=dtype)
+            old = getattr(self, name, None)
+            if old is not None:
+                new[:len(old)] = old
+            setattr(self, name, new)
+
+    def __len__(self) -> int:
+        return len(self.slot_ids)
+
+    def __contains__(self, vehicle_id: Hashable) -> bool:
+        return vehicle_id in self.slots
+
+    def _slot(self, vehicle_id: Hashable) -> int:
+        slot = self.slots.get(vehicle_id)
+        if slot is None:
+            slot = len(self.slot_ids)
+            if slot == len(self.lat):
+                self._allocate(2 * len(self.lat))
+            self.slots[vehicle_id] = slot
+            self.slot_ids.append(vehicle_id)
+            self.dirty[slot] = True
+        return slot
+
+    def rows(self, vehicle_ids: Iterable[Hashable]) -> np.ndarray:
+        """Row indices of known vehicles"""
+        return np.array([self.slots[vehicle_id] for vehicle_id in vehicle_ids], dtype=np.int64)
+
+    def update(self, vehicle_id: Hashable, lat: Optional[float], lon: Optional[float], measured: float,
+               speed: Optional[float] = None, heading: Optional[float] = None,
+               seen: Optional[float] = None) -> int:
+        """Store a vehicle's latest report, marking it dirty if its position changed"""
+        slot = self._slot(vehicle_id)
+        lat, lon = _value(lat), _value(lon)
+        # NaN never equals itself, so compare "both unknown" explicitly
+        if not ((self.lat[slot] == lat or (lat != lat and self.lat[slot] != self.lat[slot]))
+                and (self.lon[slot] == lon or (lon != lon and self.lon[slot] != self.lon[slot]))):
+            self.dirty[slot] = True
+        self.lat[slot] = lat
+        self.lon[slot] = lon
+        self.speed[slot] = _value(speed)
+        self.heading[slot] = _value(heading)
+        self.measured[slot] = measured
+        self.seen[slot] = _value(seen)
+        return slot
+
+    def update_many(self, vehicle_ids: Iterable[Hashable], lats, lons, measured, speeds=None, headings=None,
+                    seen=None) -> np.ndarray:
+        """Vectorized ``update`` of many vehicles; ids must be unique. Returns their rows."""
+        slots = np.array([self._slot(vehicle_id) for vehicle_id in vehicle_ids], dtype=np.int64)
+        if not len(slots):
+            return slots
+        lats = np.asarray(lats, dtype=np.float64)
+        lons = np.asarray(lons, dtype=np.float64)
+        moved = ~((self.lat[slots] == lats) | (np.isnan(self.lat[slots]) & np.isnan(lats))) \
+            | ~((self.lon[slots] == lons) | (np.isnan(self.lon[slots]) & np.isnan(lons)))
+        self.dirty[slots] |= moved
+        self.lat[slots] = lats
+        self.lon[slots] = lons
+        self.measured[slots] = measured
+        self.speed[slots] = np.nan if speeds is None else speeds
+        self.heading[slots] = np.nan if headings is None else headings
+        self.seen[slots] = np.nan if seen is None else seen
+        return slots
+
+    def take_dirty(self) -> np.ndarray:
+        """Rows whose position changed since the last call"""
+        rows = np.flatnonzero(self.dirty[:len(self)])
+        self.dirty[rows] = False
+        return rows
+
+    def position(self, vehicle_id: Hashable) -> Optional[tuple]:
+        """(lat, lon) of a vehicle, with None for coordinates it has not sent"""
+        slot = self.slots.get(vehicle_id)
+        if slot is None:
+            return None
+        lat, lon = float(self.lat[slot]), float(self.lon[slot])
+        return (None, None) if lat != lat else (lat, lon)
+
+    def remove(self, vehicle_id: Hashable):
+        """Forget a vehicle; the last row moves into its place"""
+        slot = self.slots.pop(vehicle_id, None)
+        if slot is None:
+            return
+        last = len(self.slot_ids) - 1
+        moved = self.slot_ids.pop()
+        if slot != last:
+            for name in COLUMNS:
+                column = getattr(self, name)
+                column[slot] = column[last]
+            self.slots[moved] = slot
+            self.slot_ids[slot] = moved
+        for name, (_, fill) in COLUMNS.items():
+            getattr(self, name)[last] = fill
+
+    @property
+    def nbytes(self) -> int:
+        return sum(getattr(self, name).nbytes for name in COLUMNS)
@@ -0,0 +1,214 @@
+"""Viewport
+
+Area-of-interest routing of position updates.
+
+Clients send the bounds and zoom of their map view with ``subscribe_bbox``.
+Vehicles and viewports are both indexed by slippy-map tile key at a fixed
+index zoom, so routing an update only touches the subscribers of the one tile
+the vehicle is in instead of every connected client. A vehicle that leaves a
+view, by moving out of it or losing its fix, is sent to that subscriber one
+last time so the client can move or hide its marker.
+
+Updates are thinned per subscriber by on-screen movement: a vehicle is only
+sent again once it moved at least ``min_move_px`` pixels at the subscriber's
+zoom. Zoomed in that is a metre or less, but a zoomed out overview only gets
+the updates it can actually draw.
+"""
+
+import math
+from typing import Dict, Hashable, List, Optional, Set, Tuple
+
+TILE_SIZE = 256
+MAX_LATITUDE = 85.05112878
+
+TileKey = Tuple[int, int]
+
+
+def lat_lon_to_pixel(lat: float, lon: float, zoom: int) -> Tuple[float, float]:
+    """Web Mercator world pixel coordinates of a point at a zoom level"""
+    lat_rad = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+    n = TILE_SIZE * 2.0 ** zoom
+    x = (lon + 180.0) / 360.0 * n
+    y = (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+    return x, y
+
+
+def has_fix(lat: Optional[float], lon: Optional[float]) -> bool:
+    """Whether a position has coordinates; vehicles without a fix send None or NaN"""
+    return lat is not None and lon is not None and lat == lat and lon == lon
+
+
+def lat_lon_to_tile(lat: float, lon: float, zoom: int) -> TileKey:
+    """Convert latitude/longitude to tile coordinates, as OSMTileDownloader.lat_lon_to_tile does"""
+    x, y = lat_lon_to_pixel(lat, lon, zoom)
+    return int(x // TILE_SIZE), int(y // TILE_SIZE)
+
+
+class Viewport:
+    """Map view of one subscribed client"""
+
+    def __init__(self, south: float, west: float, north: float, east: float, zoom: int,
+                 tiles: Optional[List[TileKey]]):
+        self.south, self.west, self.north, self.east = south, west, north, east
+        self.zoom = zoom
+        # Keys of the index tiles the view covers, None when it covers too many to list
+        self.tiles = tiles
+        # Pixel position of every vehicle as last sent to this client
+        self.sent: Dict[Hashable, Tuple[float, float]] = {}
+
+    def contains(self, lat: float, lon: float) -> bool:
+        return self.south <= lat <= self.north and self.west <= lon <= self.east
+
+
+class ViewportIndex:
+    """Routes position batches to the clients whose view contains each vehicle.
+
+    Attributes
+    ----------
+    index_zoom : int
+        zoom of the tile keys vehicles and viewports are indexed by
+    min_move_px : float
+        on-screen movement below which an update is not resent to a client
+    viewports : dict
+        the view of every subscribed client
+
+    Methods
+    -------
+    subscribe(client, south, west, north, east, zoom)
+        sets a client's view and returns the vehicles currently inside it
+    unsubscribe(client)
+        goes back to receiving every update
+    remove(vehicle_id)
+        forgets a vehicle
+    route(entries)
+        indexes a position batch and splits it per subscribed client
+    """
+
+    def __init__(self, index_zoom: int = 15, min_move_px: float = 2.0, max_viewport_tiles: int = 4096):
+        self.index_zoom = index_zoom
+        self.min_move_px = min_move_px
+        self.max_viewport_tiles = max_viewport_tiles
+        self.entries: Dict[Hashable, dict] = {}
+        self.vehicle_tiles: Dict[Hashable, TileKey] = {}
+        self.tile_vehicles: Dict[TileKey, Set[Hashable]] = {}
+        self.viewports: Dict[Hashable, Viewport] = {}
+        self.tile_subscribers: Dict[TileKey, Set[Hashable]] = {}
+        # Views too large to list their tiles are checked against every update
+        self.wide_subscribers: Set[Hashable] = set()
+
+    def __contains__(self, client: Hashable) -> bool:
+        return client in self.viewports
+
+    def subscribe(self, client: Hashable, south: float, west: float, north: float, east: float,
+                  zoom: int) -> List[dict]:
+        """Set a client's view and return the latest entry of every vehicle inside it"""
+        self.unsubscribe(client)
+        south, north = min(south, north), max(south, north)
+        west, east = min(west, east), max(west, east)
+        x_min, y_min = lat_lon_to_tile(north, west, self.index_zoom)
+        x_max, y_max = lat_lon_to_tile(south, east, self.index_zoom)
+
+        tiles = None
+        if (x_max - x_min + 1) * (y_max - y_min + 1) <= self.max_viewport_tiles:
+            tiles = [(x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1)]
+        viewport = Viewport(south, west, north, east, zoom, tiles)
+        self.viewports[client] = viewport
+
+        if tiles is None:
+            self.wide_subscribers.add(client)
+            candidates = list(self.entries)
+        else:
+            candidates = []
+            for tile in tiles:
+                self.tile_subscribers.setdefault(tile, set()).add(client)
+                candidates.extend(self.tile_vehicles.get(tile, ()))
+
+        visible = []
+        for vehicle_id in candidates:
+            entry = self.entries[vehicle_id]
+            if viewport.contains(*entry["position"]):
+                viewport.sent[vehicle_id] = lat_lon_to_pixel(*entry["position"], zoom)
+                visible.append(entry)
+        return visible
+
+    def unsubscribe(self, client: Hashable):
+        viewport = self.viewports.pop(client, None)
+        if viewport is None:
+            return
+        self.wide_subscribers.discard(client)
+        for tile in viewport.tiles or ():
+            subscribers = self.tile_subscribers[tile]
+            subscribers.discard(client)
+            if not subscribers:
+                del self.tile_subscribers[tile]
+
+    def remove(self, vehicle_id: Hashable):
+        """Forget a vehicle that left the network"""
+        self._unindex(vehicle_id)
+        for viewport in self.viewports.values():
+            viewport.sent.pop(vehicle_id, None)
+
+    def _unindex(self, vehicle_id: Hashable):
+        self.entries.pop(vehicle_id, None)
+        tile = self.vehicle_tiles.pop(vehicle_id, None)
+        if tile is not None:
+            vehicles = self.tile_vehicles[tile]
+            vehicles.discard(vehicle_id)
+            if not vehicles:
+                del self.tile_vehicles[tile]
+
+    def _index(self, entry: dict) -> TileKey:
+        vehicle_id = entry["id"]
+        tile = lat_lon_to_tile(*entry["position"], self.index_zoom)
+        previous = self.vehicle_tiles.get(vehicle_id)
+        if previous != tile:
+            if previous is not None:
+                vehicles = self.tile_vehicles[previous]
+                vehicles.discard(vehicle_id)
+                if not vehicles:
+                    del self.tile_vehicles[previous]
+            self.tile_vehicles.setdefault(tile, set()).add(vehicle_id)
+            self.vehicle_tiles[vehicle_id] = tile
+        self.entries[vehicle_id] = entry
+        return tile
+
+    def route(self, entries: List[dict]) -> Dict[Hashable, List[dict]]:
+        """Index a position batch and return the part of it each subscribed client should get.
+
+        A vehicle leaving a client's view, or losing its fix, is sent to that
+        client once more, so its marker does not stay frozen at the last
+        position inside the view.
+        """
+        routed: Dict[Hashable, List[dict]] = {client: [] for client in self.viewports}
+        for entry in entries:
+            vehicle_id = entry["id"]
+            lat, lon = entry["position"]
+            previous = self.vehicle_tiles.get(vehicle_id)
+            if not has_fix(lat, lon):
+                # Without coordinates a vehicle is in no view; clients without a viewport still get it
+                self._unindex(vehicle_id)
+                for client, viewport in self.viewports.items():
+                    if viewport.sent.pop(vehicle_id, None) is not None:
+                        routed[client].append(entry)
+                continue
+            tile = self._index(entry)
+            if not self.viewports:
+                continue
+            clients = self.tile_subscribers.get(tile, set()) | self.wide_subscribers
+            if previous is not None and previous != tile:
+                # Clients of the tile it left, which may have last seen it inside their view
+                clients = clients | self.tile_subscribers.get(previous, set())
+            for client in clients:
+                viewport = self.viewports[client]
+                if not viewport.contains(lat, lon):
+                    # One exit update, then nothing until it comes back into view
+                    if viewport.sent.pop(vehicle_id, None) is not None:
+                        routed[client].append(entry)
+                    continue
+                x, y = lat_lon_to_pixel(lat, lon, viewport.zoom)
+                last = viewport.sent.get(vehicle_id)
+                if last is not None and abs(x - last[0]) < self.min_move_px and abs(y - last[1]) < self.min_move_px:
+                    continue
+                viewport.sent[vehicle_id] = (x, y)
+                routed[client].append(entry)
+        return routed
@@ -0,0 +1,156 @@
+"""Wire
+
+Compact binary encoding for vehicle position updates sent over the mesh.
+
+A datagram is a small header followed by fixed size records, so one packet
+can carry many vehicles. The size of every datagram stays under the bat0 MTU
+set by ``scripts/start-batman-adv-laptop.sh``, so batman-adv never has to
+fragment it.
+
+Datagram layout (little endian)::
+
+    header  magic "VB" | version u8 | count u8 | base_time f64 (epoch seconds)
+    record  id u32 | seq u32 | dt_ms u16 | lat i32 | lon i32 | heading u16 | speed u16
+
+``lat``/``lon`` are fixed point degrees scaled by 1e7, ``heading`` is in
+hundredths of a degree, ``speed`` in cm/s and ``dt_ms`` is the record time in
+milliseconds after ``base_time``. ``seq`` 0 means the sender does not number
+its records; counters wrap from 2**32 - 1 to 1.
+
+The original JSON datagrams (``{"id", "lat", "long"}``) are still decoded, so
+nodes running older builds keep working.
+"""
+
+import json
+import struct
+import time
+from typing import Hashable, List, NamedTuple, Optional
+
+MAGIC = b"VB"
+VERSION = 1
+
+BAT0_MTU = 1468
+# IPv4 and UDP headers are carried inside the bat0 MTU
+MAX_DATAGRAM_SIZE = BAT0_MTU - 20 - 8
+
+HEADER = struct.Struct("<2sBBd")
+RECORD = struct.Struct("<IIHiiHH")
+MAX_RECORDS_PER_DATAGRAM = min(255, (MAX_DATAGRAM_SIZE - HEADER.size) // RECORD.size)
+
+COORD_SCALE = 1e7
+HEADING_SCALE = 100
+SPEED_SCALE = 100
+MAX_DT_MS = 0xFFFF
+
+
+class VehicleRecord(NamedTuple):
+    """A single position update for one vehicle.
+
+    ``seq``, ``heading`` and ``speed`` are None when the sender did not
+    provide them (JSON datagrams, and ``seq`` of binary senders without a
+    counter).
+    """
+    vehicle_id: Hashable
+    lat: float
+    lon: float
+    timestamp: float
+    seq: Optional[int] = None
+    heading: Optional[float] = None
+    speed: Optional[float] = None
+
+
+def is_packable(record: VehicleRecord) -> bool:
+    """Whether a record can be sent in the binary format"""
+    return (isinstance(record.vehicle_id, int) and not isinstance(record.vehicle_id, bool)
+            and 0 <= record.vehicle_id <= 0xFFFFFFFF
+            and record.lat is not None and record.lon is not None)
+
+
+def _pack_record(record: VehicleRecord, base_time: float) -> bytes:
+    heading = (record.heading or 0.0) % 360.0
+    speed = min(max(record.speed or 0.0, 0.0), 0xFFFF / SPEED_SCALE)
+    return RECORD.pack(
+        record.vehicle_id,
+        0 if record.seq is None else (record.seq - 1) % 0xFFFFFFFF + 1,
+        min(round((record.timestamp - base_time) * 1000), MAX_DT_MS),
+        round(record.lat * COORD_SCALE),
+        round(record.lon * COORD_SCALE),
+        round(heading * HEADING_SCALE) % (360 * HEADING_SCALE),
+        round(speed * SPEED_SCALE),
+    )
+
+
+def pack_datagrams(records: List[VehicleRecord]) -> List[bytes]:
+    """Pack records into as few datagrams as fit the MTU.
+
+    Every record must satisfy ``is_packable``.
+    """
+    datagrams = []
+    chunk: List[VehicleRecord] = []
+    base_time = 0.0
+
+    def flush():
+        header = HEADER.pack(MAGIC, VERSION, len(chunk), base_time)
+        datagrams.append(header + b"".join(_pack_record(r, base_time) for r in chunk))
+
+    for record in sorted(records, key=lambda r: r.timestamp):
+        if chunk and (len(chunk) == MAX_RECORDS_PER_DATAGRAM
+                      or (record.timestamp - base_time) * 1000 > MAX_DT_MS):
+            flush()
+            chunk = []
+        if not chunk:
+            base_time = record.timestamp
+        chunk.append(record)
+    if chunk:
+        flush()
+    return datagrams
+
+
+def encode_json(record: VehicleRecord) -> bytes:
+    """Encode a record in the legacy JSON format"""
+    return bytes(json.dumps({"id": record.vehicle_id, "lat": record.lat, "long": record.lon}), "utf-8")
+
+
+def decode_datagram(data: bytes, received_at: Optional[float] = None) -> List[VehicleRecord]:
+    """Decode a binary or JSON datagram into records.
+
+    Raises
+    ------
+    ValueError
+        if the datagram is neither a supported binary version nor valid JSON
+    """
+    if data[:2] == MAGIC:
+        if len(data) < HEADER.size:
+            raise ValueError("Truncated datagram header")
+        _, version, count, base_time = HEADER.unpack_from(data)
+        if version != VERSION:
+            raise ValueError(f"Unsupported wire version {version}")
+        if len(data) < HEADER.size + count * RECORD.size:
+            raise ValueError("Truncated datagram")
+
+        records = []
+        for vehicle_id, seq, dt_ms, lat, lon, heading, speed in RECORD.iter_unpack(
+                data[HEADER.size:HEADER.size + count * RECORD.size]):
+            records.append(VehicleRecord(
+                vehicle_id,
+                lat / COORD_SCALE,
+                lon / COORD_SCALE,
+                base_time + dt_ms / 1000,
+                seq or None,
+                heading / HEADING_SCALE,
+                speed / SPEED_SCALE,
+            ))
+        return records
+
+    try:
+        parsed_data = json.loads(data)
+    except (UnicodeDecodeError, json.JSONDecodeError) as e:
+        raise ValueError(f"Undecodable datagram: {e}")
+    if not isinstance(parsed_data, dict):
+        raise ValueError("Unexpected JSON datagram")
+    return [VehicleRecord(
+        parsed_data.get("id"),
+        parsed_data.get("lat"),
+        parsed_data.get("long"),
+        received_at if received_at is not None else time.time(),
+    )]
@@ -1,7 +1,7 @@
 "use client";
-import { useRef } from "react";
-import { useState, useEffect, useCallback } from "react";
-import { MapContainer, TileLayer, Marker, useMap, useMapEvents } from "react-leaflet";
+import { Fragment, useRef } from "react";
+import { useState, useEffect } from "react";
+import { MapContainer, TileLayer, Marker, Circle as ZoneCircle, useMap, useMapEvents } from "react-leaflet";
 import L from "leaflet";
 import "leaflet/dist/leaflet.css";
 import { Button } from "@/components/ui/button";
@@ -12,20 +12,7 @@ import { Alert, AlertDescription } from "@/components/ui/alert";
 import { X } from "lucide-react";
 // Custom tile layer for scaling local tiles
 
-const doLineSegmentsIntersect = (
-  start1: [number, number],
-  end1: [number, number],
-  start2: [number, number],
-  end2: [number, number]
-) => {
-  const ccw = (A: [number, number], B: [number, number], C: [number, number]) => {
-    return (C[1] - A[1]) * (B[0] - A[0]) > (B[1] - A[1]) * (C[0] - A[0]);
-  };
-
-  return ccw(start1, start2, end2) !== ccw(end1, start2, end2) && ccw(start1, end1, start2) !== ccw(start1, end1, end2);
-};
-
-const AnimatedVehicleMarker = ({ vehicle, icon, onIntersection }) => {
+const AnimatedVehicleMarker = ({ vehicle, icon }) => {
   const [currentPosition, setCurrentPosition] = useState(vehicle.position);
   const animationRef = useRef(null);
   const startTimeRef = useRef(null);
@@ -57,9 +44,6 @@ const AnimatedVehicleMarker = ({ vehicle, icon, onIntersection }) => {
       const newPosition = [newLat, newLng];
       setCurrentPosition(newPosition);
 
-      // Check intersections with other vehicles
-      onIntersection(vehicle.id, startPosition, newPosition);
-
       if (progress < 1) {
         animationRef.current = requestAnimationFrame(animate);
       }
@@ -99,23 +83,50 @@ function MapClickHandler() {
   });
   return null;
 }
+// Only vehicles inside the visible map (plus a margin) are sent by the server
+const viewportMessage = (map: L.Map) => {
+  const bounds = map.getBounds().pad(0.2);
+  return {
+    type: "subscribe_bbox",
+    bbox: [bounds.getSouth(), bounds.getWest(), bounds.getNorth(), bounds.getEast()],
+    zoom: Math.round(map.getZoom()),
+  };
+};
+
+function ViewportSubscriber({ onChange }: { onChange: (message: any) => void }) {
+  const map = useMapEvents({
+    moveend: () => onChange(viewportMessage(map)),
+  });
+
+  useEffect(() => {
+    onChange(viewportMessage(map));
+  }, [map]);
+
+  return null;
+}
+
+// Point at the backend tile server (e.g. "http://localhost:8766/tiles") to load tiles from MBTiles
+const TILE_BASE_URL = process.env.NEXT_PUBLIC_TILE_SERVER_URL ?? "/bangalore_tiles";
+// Set to 22 when tiles were built with extraction/pyramid.py so overzoom tiles are not scaled in the browser
+const MAX_NATIVE_ZOOM = Number(process.env.NEXT_PUBLIC_TILE_MAX_NATIVE_ZOOM ?? 19);
+
 class LocalTileLayer extends L.TileLayer {
   getTileUrl(coords: any) {
-    const maxNativeZoom = 19;
+    const maxNativeZoom = MAX_NATIVE_ZOOM;
     if (coords.z <= maxNativeZoom) {
-      return `/bangalore_tiles/${coords.z}/${coords.x}/${coords.y}.png`;
+      return `${TILE_BASE_URL}/${coords.z}/${coords.x}/${coords.y}.png`;
     }
     const zoomDiff = coords.z - maxNativeZoom;
     const scale = Math.pow(2, zoomDiff);
     const x = Math.floor(coords.x / scale);
     const y = Math.floor(coords.y / scale);
 
-    return `/bangalore_tiles/${maxNativeZoom}/${x}/${y}.png`;
+    return `${TILE_BASE_URL}/${maxNativeZoom}/${x}/${y}.png`;
   }
 
   createTile(coords: any, done: any) {
     const tile = document.createElement("img");
-    const maxNativeZoom = 19;
+    const maxNativeZoom = MAX_NATIVE_ZOOM;
 
     tile.onload = () => {
       if (coords.z > maxNativeZoom) {
@@ -140,6 +151,41 @@ class LocalTileLayer extends L.TileLayer {
   }
 }
 
+// Point at the backend heatmap tiles (e.g. "http://localhost:8767/heatmap") to show vehicle density
+const HEATMAP_URL = process.env.NEXT_PUBLIC_HEATMAP_URL;
+// Must match the backend's DensityHeatmap.max_zoom and heatmap interval
+const HEATMAP_MAX_NATIVE_ZOOM = 18;
+const HEATMAP_REFRESH_MS = 5000;
+// Spawned circles are sent to the server as geofences of this radius
+const GEOFENCE_RADIUS_M = 50;
+
+// Density overlay rendered by the backend, one image per tile instead of a marker per vehicle
+function HeatmapLayer() {
+  const map = useMap();
+
+  useEffect(() => {
+    if (!HEATMAP_URL) return;
+    const heatmapLayer = L.tileLayer(`${HEATMAP_URL}/{z}/{x}/{y}.png`, {
+      minZoom: 10,
+      maxZoom: 22,
+      maxNativeZoom: HEATMAP_MAX_NATIVE_ZOOM,
+      tileSize: 256,
+      opacity: 0.7,
+      zIndex: 10,
+    });
+    heatmapLayer.addTo(map);
+    // Tiles are sent with no-cache, so unchanged ones come back as cheap 304s
+    const refresh = setInterval(() => heatmapLayer.redraw(), HEATMAP_REFRESH_MS);
+
+    return () => {
+      clearInterval(refresh);
+      map.removeLayer(heatmapLayer);
+    };
+  }, [map]);
+
+  return null;
+}
+
 // Helper component to update map view
 function ChangeView({ center }: any) {
   const map = useMap();
@@ -155,7 +201,7 @@ function CustomTileLayer() {
     const localTileLayer = new LocalTileLayer("", {
       minZoom: 19,
       maxZoom: 22,
-      maxNativeZoom: 19,
+      maxNativeZoom: MAX_NATIVE_ZOOM,
       tileSize: 256,
       errorTileUrl: "/path/to/error-tile.png",
       updateWhenZooming: false,
@@ -239,7 +285,12 @@ const MapComponent = () => {
   const [circles, setCircles] = useState<Circle[]>([]);
   const [selectedCircle, setSelectedCircle] = useState<string | null>(null);
   const circleIdCounter = useRef(1);
+  // Prefix of this page's geofence ids, so circles spawned in other tabs do not replace them
+  const fenceSession = useRef(Math.random().toString(36).slice(2, 8));
   const websocket = useRef<WebSocket | null>(null);
+  const viewport = useRef<any>(null);
+  // Server run and last state version received, sent back to resume after a reconnect
+  const stateVersion = useRef<{ epoch: string; version: number } | null>(null);
   const [vehicles, setVehicles] = useState<VehiclePosition[]>([
     { id: "1", position: [17.132742830091999, 77.56889104945668], timestamp: "2021-10-01T12:00:00Z" },
   ]);
@@ -252,29 +303,6 @@ const MapComponent = () => {
   const [proximityAlerts, setProximityAlerts] = useState<ProximityAlert[]>([]);
   const alertIdCounter = useRef(1);
 
-  const currentVehiclePositions = useRef<{ [key: string]: [number, number] }>({});
-
-  const checkPathIntersections = (vehicleId: string | number, start1: [number, number], end1: [number, number]) => {
-    vehicles.forEach((otherVehicle) => {
-      if (vehicleId === otherVehicle.id) return;
-
-      const start2 = otherVehicle.position; // Last known position
-      const end2 = currentVehiclePositions.current[otherVehicle.id]; // Current animated position
-
-      if (start2 && end2 && doLineSegmentsIntersect(start1, end1, start2, end2)) {
-        const alertId = alertIdCounter.current++;
-        setProximityAlerts((prev) => [
-          ...prev,
-          {
-            id: alertId,
-            message: `Path of vehicle ${vehicleId} intersects with vehicle ${otherVehicle.id}`,
-            timestamp: Date.now(),
-          },
-        ]);
-      }
-    });
-  };
-
   const customCircleIcon = new L.DivIcon({
     className: "custom-icon",
     html: '<div class="w-5 h-5 bg-blue-500 rounded-full border border-white shadow-lg"></div>',
@@ -304,11 +332,23 @@ const MapComponent = () => {
     };
     setCircles((prevCircles) => [...prevCircles, newCircle]);
     circleIdCounter.current += 1;
+    // Vehicles entering or leaving the circle are reported by the server
+    websocket.current?.send(
+      JSON.stringify({
+        type: "add_geofence",
+        id: `${fenceSession.current}-${newCircle.id}`,
+        name: newCircle.name,
+        shape: "circle",
+        center: newCircle.position,
+        radius: GEOFENCE_RADIUS_M,
+      })
+    );
   };
 
   const deleteSelectedCircle = () => {
     if (selectedCircle) {
       setCircles((prevCircles) => prevCircles.filter((circle) => circle.id.toString() !== selectedCircle));
+      websocket.current?.send(JSON.stringify({ type: "remove_geofence", id: `${fenceSession.current}-${selectedCircle}` }));
       setSelectedCircle(null);
     }
   };
@@ -322,43 +362,6 @@ const MapComponent = () => {
     }
   };
 
-  const calculateDistance = (pos1: [number, number], pos2: [number, number]) => {
-    const R = 6371e3; // Earth's radius in meters
-    const φ1 = (pos1[0] * Math.PI) / 180;
-    const φ2 = (pos2[0] * Math.PI) / 180;
-    const Δφ = ((pos2[0] - pos1[0]) * Math.PI) / 180;
-    const Δλ = ((pos2[1] - pos1[1]) * Math.PI) / 180;
-
-    const a = Math.sin(Δφ / 2) * Math.sin(Δφ / 2) + Math.cos(φ1) * Math.cos(φ2) * Math.sin(Δλ / 2) * Math.sin(Δλ / 2);
-    const c = 2 * Math.atan2(Math.sqrt(a), Math.sqrt(1 - a));
-
-    return R * c;
-  };
-
-  const checkProximity = useCallback(() => {
-    const proximityThreshold = 50; // 50 meters
-    const newAlerts = [];
-
-    vehicles.forEach((vehicle1, i) => {
-      vehicles.slice(i + 1).forEach((vehicle2) => {
-        const distance = calculateDistance(vehicle1.position, vehicle2.position);
-
-        if (distance < proximityThreshold) {
-          const alertId = alertIdCounter.current++;
-          newAlerts.push({
-            id: alertId,
-            message: `Vehicles ${vehicle1.id} and ${vehicle2.id} are within ${Math.round(distance)}m of each other`,
-            timestamp: Date.now(),
-          });
-        }
-      });
-    });
-
-    if (newAlerts.length > 0) {
-      setProximityAlerts((prev) => [...prev, ...newAlerts]);
-    }
-  }, [vehicles]);
-
   // Dismiss alert
   const dismissAlert = (alertId) => {
     setProximityAlerts((prev) => prev.filter((alert) => alert.id !== alertId));
@@ -373,11 +376,6 @@ const MapComponent = () => {
     return () => clearTimeout(timeout);
   }, [proximityAlerts]);
 
-  // Check proximity whenever vehicles update
-  useEffect(() => {
-    checkProximity();
-  }, [vehicles, checkProximity]);
-
   // Handle position updates with smooth animation
   const handleMove = (direction: string) => {
     const step = 0.0001; // Adjust step size for movement
@@ -426,56 +424,146 @@ const MapComponent = () => {
     });
   };
 
+  const subscribeViewport = (message: any) => {
+    viewport.current = message;
+    if (websocket.current?.readyState === WebSocket.OPEN) {
+      websocket.current.send(JSON.stringify(message));
+    }
+  };
+
   useEffect(() => {
-    websocket.current = new WebSocket("http://localhost:8765");
-
-    websocket.current.onopen = () => {
-      console.log("WebSocket Connected");
-      // Request initial positions
-      websocket.current?.send(
-        JSON.stringify({
-          type: "request_positions",
-        })
-      );
-    };
+    let closed = false;
+    let reconnectTimer: ReturnType<typeof setTimeout> | undefined;
+
+    const connect = () => {
+      websocket.current = new WebSocket("http://localhost:8765");
+
+      websocket.current.onopen = () => {
+        console.log("WebSocket Connected");
+        // After a reconnect only ask for what changed since the last version seen
+        websocket.current?.send(
+          JSON.stringify(
+            stateVersion.current
+              ? { type: "resume", epoch: stateVersion.current.epoch, version: stateVersion.current.version }
+              : { type: "request_positions" }
+          )
+        );
+        if (viewport.current) {
+          websocket.current?.send(JSON.stringify(viewport.current));
+        }
+      };
 
-    websocket.current.onmessage = (event) => {
-      const data = JSON.parse(event.data);
-      console.log("Received WebSocket message:", data.id);
-      if (data.type === "initial_state" || data.type === "position_update" || data.id) {
-        // Update vehicles state with the new positions
-        if (Array.isArray(data.data)) {
-          setVehicles(
-            data.data.map((vehicle: any) => ({
+      websocket.current.onmessage = (event) => {
+        const data = JSON.parse(event.data);
+        console.log("Received WebSocket message:", data.id);
+        if (data.epoch !== undefined) {
+          stateVersion.current = { epoch: data.epoch, version: data.version };
+        } else if (data.version !== undefined && stateVersion.current) {
+          stateVersion.current.version = data.version;
+        }
+        if (data.type === "resumed") {
+          return;
+        }
+        if (data.type === "proximity_alerts") {
+          // Proximity is computed on the server, the client only displays it
+          const newAlerts = data.data.map((alert: any) => {
+            const [vehicle1, vehicle2] = alert.vehicles;
+            return {
+              id: alertIdCounter.current++,
+              message: `Vehicles ${vehicle1} and ${vehicle2} are within ${Math.round(alert.distance)}m of each other`,
+              timestamp: Date.now(),
+            };
+          });
+          setProximityAlerts((prev) => [...prev, ...newAlerts]);
+          return;
+        }
+        if (data.type === "collision_risk") {
+          // Predicted on the server from every vehicle's heading and speed, most urgent first
+          const newAlerts = data.data.map((risk: any) => {
+            const [vehicle1, vehicle2] = risk.vehicles;
+            return {
+              id: alertIdCounter.current++,
+              message: `Collision risk: vehicles ${vehicle1} and ${vehicle2} within ${Math.round(risk.distance)}m in ${risk.time_to_closest.toFixed(1)}s`,
+              timestamp: Date.now(),
+            };
+          });
+          setProximityAlerts((prev) => [...prev, ...newAlerts]);
+          return;
+        }
+        if (data.type === "geofence_enter" || data.type === "geofence_exit") {
+          const verb = data.type === "geofence_enter" ? "entered" : "left";
+          const newAlerts = data.data.map((event: any) => ({
+            id: alertIdCounter.current++,
+            message: `Vehicle ${event.vehicle} ${verb} ${event.name ?? `zone ${event.fence}`}`,
+            timestamp: Date.now(),
+          }));
+          setProximityAlerts((prev) => [...prev, ...newAlerts]);
+          return;
+        }
+        if (data.type === "geofences") {
+          return;
+        }
+        if (data.type === "vehicle_left") {
+          // Vehicles the server stopped hearing from
+          const departed = new Set(data.data.map((id: any) => JSON.stringify(id)));
+          setVehicles((prev) => prev.filter((v) => !departed.has(JSON.stringify(v.id))));
+          return;
+        }
+        if (data.type === "position_batch") {
+          // Batches only carry vehicles that moved since the last tick, so merge them in
+          const updates = new Map(data.data.map((vehicle: any) => [vehicle.id, vehicle]));
+          setVehicles((prev) => [
+            ...prev.filter((v) => !updates.has(v.id)),
+            ...data.data.map((vehicle: any) => ({
               id: vehicle.id,
               position: vehicle.position,
               timestamp: vehicle.timestamp,
-            }))
-          );
-        } else if (data.id && data.position) {
-          console.log("Received WebSocket message:", data);
-          // Single vehicle update
-          setVehicles((prev) => {
-            const newVehicles = prev.filter((v) => v.id !== data.id);
-            console.log("new vehicles:", newVehicles);
-            return [
-              ...newVehicles,
-              {
-                id: data.id,
-                position: data.position,
-                timestamp: "2021-10-01T12:00:00Z",
-              },
-            ];
-          });
+            })),
+          ]);
+          return;
         }
-      }
-    };
+        if (data.type === "initial_state" || data.type === "position_update" || data.id) {
+          // Update vehicles state with the new positions
+          if (Array.isArray(data.data)) {
+            setVehicles(
+              data.data.map((vehicle: any) => ({
+                id: vehicle.id,
+                position: vehicle.position,
+                timestamp: vehicle.timestamp,
+              }))
+            );
+          } else if (data.id && data.position) {
+            console.log("Received WebSocket message:", data);
+            // Single vehicle update
+            setVehicles((prev) => {
+              const newVehicles = prev.filter((v) => v.id !== data.id);
+              console.log("new vehicles:", newVehicles);
+              return [
+                ...newVehicles,
+                {
+                  id: data.id,
+                  position: data.position,
+                  timestamp: "2021-10-01T12:00:00Z",
+                },
+              ];
+            });
+          }
+        }
+      };
 
-    websocket.current.onclose = () => {
-      console.log("WebSocket Disconnected");
+      websocket.current.onclose = () => {
+        console.log("WebSocket Disconnected");
+        if (!closed) {
+          reconnectTimer = setTimeout(connect, 1000);
+        }
+      };
     };
 
+    connect();
+
     return () => {
+      closed = true;
+      clearTimeout(reconnectTimer);
       websocket.current?.close();
     };
   }, []);
@@ -539,8 +627,10 @@ const MapComponent = () => {
         className="w-full h-full z-50"
       >
         <MapClickHandler />
+        <ViewportSubscriber onChange={subscribeViewport} />
         {/* <ChangeView center={position} /> */}
         <CustomTileLayer />
+        <HeatmapLayer />
 
         {/* Main marker */}
         <Marker position={position} icon={customCircleIcon} />
@@ -551,13 +641,15 @@ const MapComponent = () => {
             key={vehicle.id}
             vehicle={vehicle}
             icon={customCircleIcon}
-            onIntersection={checkPathIntersections}
           />
         ))}
 
         {/* Spawned circles */}
         {circles.map((circle) => (
-          <Marker key={circle.id} position={circle.position} icon={CircleIcon} />
+          <Fragment key={circle.id}>
+            <Marker position={circle.position} icon={CircleIcon} />
+            <ZoneCircle center={circle.position} radius={GEOFENCE_RADIUS_M} pathOptions={{ color: "green", weight: 1 }} />
+          </Fragment>
         ))}
       </MapContainer>
 
@@ -0,0 +1,196 @@
+"""Route corridor tile selection.
+
+Finds the tiles within a buffer distance of one or more routes, so an
+offline map can cover the roads vehicles actually drive instead of the
+whole rectangle around them. For a long diagonal route the rectangle grows
+with the square of its length at every zoom level, the corridor only
+linearly.
+
+Routes are polylines of ``[lat, lon]`` points and can be loaded from GPX
+tracks and routes, GeoJSON line geometries, or the routes JSON of the
+backend simulator (``python sim.py --export-routes routes.json``).
+
+Example::
+
+    python corridor.py routes.geojson --buffer 50 --max-zoom 19 --output bangalore_tiles
+"""
+
+import argparse
+import json
+import math
+import xml.etree.ElementTree as ElementTree
+
+# Web Mercator earth radius, metres per tile follow from it
+EARTH_RADIUS_M = 6378137.0
+MAX_LATITUDE = 85.05112878
+# Longest piece of a segment, in tiles, checked against its own candidate tiles
+MAX_PIECE_TILES = 4.0
+
+
+def project(lat, lon, zoom):
+    """Fractional XYZ tile coordinates of a point"""
+    lat_rad = math.radians(max(-MAX_LATITUDE, min(MAX_LATITUDE, lat)))
+    n = 2.0 ** zoom
+    return (lon + 180.0) / 360.0 * n, (1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n
+
+
+def metres_per_tile(lat, zoom):
+    return 2 * math.pi * EARTH_RADIUS_M * math.cos(math.radians(lat)) / 2.0 ** zoom
+
+
+def _point_segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length_squared = dx * dx + dy * dy
+    t = 0.0 if length_squared == 0 else max(0.0, min(1.0, ((px - ax) * dx + (py - ay) * dy) / length_squared))
+    return math.hypot(px - ax - t * dx, py - ay - t * dy)
+
+
+def _point_box_distance(px, py, x, y):
+    return math.hypot(max(x - px, 0.0, px - x - 1), max(y - py, 0.0, py - y - 1))
+
+
+def _segment_crosses_box(ax, ay, bx, by, x, y):
+    """Whether a segment passes through the unit box at (x, y), by Liang-Barsky clipping"""
+    t0, t1 = 0.0, 1.0
+    dx, dy = bx - ax, by - ay
+    for p, q in ((-dx, ax - x), (dx, x + 1 - ax), (-dy, ay - y), (dy, y + 1 - ay)):
+        if p == 0:
+            if q < 0:
+                return False
+            continue
+        t = q / p
+        if p < 0:
+            t0 = max(t0, t)
+        else:
+            t1 = min(t1, t)
+        if t0 > t1:
+            return False
+    return True
+
+
+def segment_box_distance(ax, ay, bx, by, x, y):
+    """Distance between a segment and the unit box at (x, y), in tile units"""
+    if _segment_crosses_box(ax, ay, bx, by, x, y):
+        return 0.0
+    return min(
+        _point_box_distance(ax, ay, x, y),
+        _point_box_distance(bx, by, x, y),
+        *(_point_segment_distance(cx, cy, ax, ay, bx, by) for cx, cy in ((x, y), (x + 1, y), (x, y + 1), (x + 1, y + 1))),
+    )
+
+
+def route_tiles(route, zoom, buffer_m):
+    """Set of (x, y) tiles at one zoom within ``buffer_m`` metres of a polyline"""
+    tiles = set()
+    points = [(lat, project(lat, lon, zoom)) for lat, lon in route]
+    if len(points) == 1:
+        points = points * 2
+    limit = 2 ** zoom - 1
+    for (lat_a, (ax, ay)), (lat_b, (bx, by)) in zip(points, points[1:]):
+        buffer = buffer_m / metres_per_tile((lat_a + lat_b) / 2, zoom)
+        # Long segments are split so the candidate boxes hug the line
+        pieces = max(1, math.ceil(max(abs(bx - ax), abs(by - ay)) / MAX_PIECE_TILES))
+        for i in range(pieces):
+            sx, sy = ax + (bx - ax) * i / pieces, ay + (by - ay) * i / pieces
+            ex, ey = ax + (bx - ax) * (i + 1) / pieces, ay + (by - ay) * (i + 1) / pieces
+            for x in range(max(0, math.floor(min(sx, ex) - buffer)), min(limit, math.floor(max(sx, ex) + buffer)) + 1):
+                for y in range(max(0, math.floor(min(sy, ey) - buffer)),
+                               min(limit, math.floor(max(sy, ey) + buffer)) + 1):
+                    if (x, y) not in tiles and segment_box_distance(sx, sy, ex, ey, x, y) <= buffer:
+                        tiles.add((x, y))
+    return tiles
+
+
+def corridor_tiles(routes, buffer_m, min_zoom, max_zoom):
+    """Every (z, x, y) tile within ``buffer_m`` metres of any route, each listed once"""
+    tiles = []
+    for z in range(min_zoom, max_zoom + 1):
+        level = set()
+        for route in routes:
+            if route:
+                level |= route_tiles(route, z, buffer_m)
+        tiles.extend((z, x, y) for x, y in sorted(level))
+    return tiles
+
+
+def envelope_tile_count(routes, zoom):
+    """Tiles in the rectangle around all routes at one zoom, what a bounding box download fetches"""
+    points = [point for route in routes for point in route]
+    lats = [lat for lat, _ in points]
+    lons = [lon for _, lon in points]
+    x_min, y_max = project(min(lats), min(lons), zoom)
+    x_max, y_min = project(max(lats), max(lons), zoom)
+    return (int(x_max) - int(x_min) + 1) * (int(y_max) - int(y_min) + 1)
+
+
+def _geojson_lines(node):
+    kind = node.get("type")
+    if kind == "FeatureCollection":
+        return [line for feature in node["features"] for line in _geojson_lines(feature)]
+    if kind == "Feature":
+        return _geojson_lines(node["geometry"]) if node.get("geometry") else []
+    if kind == "GeometryCollection":
+        return [line for geometry in node["geometries"] for line in _geojson_lines(geometry)]
+    # GeoJSON positions are [lon, lat]
+    if kind == "LineString":
+        return [[[lat, lon] for lon, lat, *_ in node["coordinates"]]]
+    if kind in ("MultiLineString", "Polygon"):
+        return [[[lat, lon] for lon, lat, *_ in line] for line in node["coordinates"]]
+    if kind == "MultiPolygon":
+        return [[[lat, lon] for lon, lat, *_ in ring] for polygon in node["coordinates"] for ring in polygon]
+    if kind == "Point":
+        lon, lat, *_ = node["coordinates"]
+        return [[[lat, lon]]]
+    if kind == "MultiPoint":
+        return [[[lat, lon]] for lon, lat, *_ in node["coordinates"]]
+    return []
+
+
+def _gpx_lines(path):
+    lines = []
+    for element in ElementTree.parse(path).iter():
+        # Match tags without their namespace, GPX 1.0 and 1.1 use different ones
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag in ("trkseg", "rte"):
+            point_tag = "trkpt" if tag == "trkseg" else "rtept"
+            line = [[float(point.get("lat")), float(point.get("lon"))]
+                    for point in element if point.tag.rsplit("}", 1)[-1] == point_tag]
+            if line:
+                lines.append(line)
+    return lines
+
+
+def load_routes(path):
+    """Polylines of [lat, lon] points from a GPX, GeoJSON or simulator routes JSON file"""
+    if path.lower().endswith(".gpx"):
+        return _gpx_lines(path)
+    with open(path) as file:
+        data = json.load(file)
+    if isinstance(data, dict) and "routes" in data:
+        return data["routes"]
+    return _geojson_lines(data)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download the map tiles along routes")
+    parser.add_argument("routes", nargs="+", help="GPX, GeoJSON or simulator routes JSON files")
+    parser.add_argument("--buffer", type=float, default=50.0, help="metres either side of the route to cover")
+    parser.add_argument("--min-zoom", type=int, default=0)
+    parser.add_argument("--max-zoom", type=int, default=19)
+    parser.add_argument("--output", default="bangalore_tiles", help="tile directory to download into")
+    parser.add_argument("--mbtiles", help="download into this MBTiles archive instead")
+    parser.add_argument("--dry-run", action="store_true", help="only compare tile counts with the bounding box")
+    args = parser.parse_args()
+
+    routes = [route for path in args.routes for route in load_routes(path)]
+    tiles = corridor_tiles(routes, args.buffer, args.min_zoom, args.max_zoom)
+    for z in range(args.min_zoom, args.max_zoom + 1):
+        count = sum(1 for tile in tiles if tile[0] == z)
+        print(f"zoom {z:>2}: {count:>8} corridor tiles, {envelope_tile_count(routes, z):>10} in the bounding box")
+    print(f"{len(tiles)} tiles along {len(routes)} routes")
+
+    if not args.dry_run:
+        from main import OSMTileDownloader
+
+        failed = OSMTileDownloader().download_tiles(tiles, args.output, args.mbtiles)
+        print(f"Downloaded corridor, {len(failed)} tiles failed")
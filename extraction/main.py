@@ -1,20 +1,126 @@
 import os
+import math
+import random
 import requests
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
 import logging
 
+from corridor import corridor_tiles
+from mbtiles import MBTilesWriter
+
+
+class TokenBucket:
+    """Thread-safe token bucket shared by all download workers.
+
+    The refill rate backs off multiplicatively whenever the server answers
+    with a rate limit status and recovers additively on success, so the
+    downloader settles just under whatever the tile server tolerates.
+    """
+
+    def __init__(self, rate=2.0, capacity=4, min_rate=0.1):
+        self.max_rate = rate
+        self.rate = rate
+        self.min_rate = min_rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def throttle(self):
+        """Halve the request rate after the server rate limited us"""
+        with self.lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+
+    def recover(self):
+        """Slowly raise the request rate again after a success"""
+        with self.lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + 0.05 * self.max_rate)
+
+
+class TileManifest:
+    """Append-only record of tiles that finished downloading.
+
+    Each line is ``z/x/y``. Tiles are only recorded after they were written
+    to disk, so an interrupted run resumes from the manifest instead of
+    checking every tile path again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done = set()
+        if os.path.exists(path):
+            with open(path) as file:
+                self.done = {line.strip() for line in file if line.strip()}
+
+    @staticmethod
+    def key(z, x, y):
+        return f"{z}/{x}/{y}"
+
+    def seed_from_tree(self, output_dir):
+        """One-time import of tiles downloaded before the manifest existed"""
+        found = []
+        for root, _, files in os.walk(output_dir):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                rel = os.path.relpath(os.path.join(root, name[:-4]), output_dir)
+                parts = rel.split(os.sep)
+                if len(parts) == 3 and all(part.isdigit() for part in parts):
+                    found.append("/".join(parts))
+        with self.lock:
+            new = [key for key in found if key not in self.done]
+            self.done.update(new)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a") as file:
+                file.writelines(f"{key}\n" for key in new)
+
+    def __contains__(self, key):
+        return key in self.done
+
+    def add(self, key):
+        with self.lock:
+            self.done.add(key)
+            with open(self.path, "a") as file:
+                file.write(f"{key}\n")
+
+
 class OSMTileDownloader:
-    def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
+    def __init__(self, tile_url="https://tile.openstreetmap.org/{z}/{x}/{y}.png", max_workers=4,
+                 requests_per_second=2.0, max_retries=5):
+        self.tile_url = tile_url
+        self.headers = {
             'User-Agent': 'TileDownloader/1.0 (rayyaanf235@gmail.com)',  # Replace with your email
             'Accept': 'image/png',
             'Accept-Language': 'en-US,en;q=0.9',
             'Accept-Encoding': 'gzip, deflate',
             'Connection': 'keep-alive'
-        })
-        
+        }
+        # requests.Session is not thread-safe, so every worker gets its own
+        self._local = threading.local()
+
         # Setup logging
         logging.basicConfig(
             level=logging.INFO,
@@ -22,41 +128,74 @@ class OSMTileDownloader:
             filename='tile_download.log'
         )
         self.logger = logging.getLogger('OSMTileDownloader')
-        
+
         # Rate limiting parameters
-        self.min_delay = 0.5  # Minimum delay between requests
-        self.last_request_time = 0
-        
-    def _wait_for_rate_limit(self):
-        """Ensure we don't exceed rate limits"""
-        current_time = time.time()
-        time_since_last_request = current_time - self.last_request_time
-        if time_since_last_request < self.min_delay:
-            time.sleep(self.min_delay - time_since_last_request)
-        self.last_request_time = time.time()
+        self.max_workers = max_workers
+        self.max_retries = max_retries
+        self.backoff_base = 1.0  # First retry delay, doubled on every attempt
+        self.backoff_max = 60.0
+        self.rate_limiter = TokenBucket(rate=requests_per_second)
+
+    @property
+    def session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+            self._local.session.headers.update(self.headers)
+        return self._local.session
+
+    def _backoff_delay(self, attempt, retry_after=None):
+        """Exponential backoff with jitter, honouring Retry-After when given"""
+        if retry_after:
+            try:
+                return min(float(retry_after), self.backoff_max)
+            except ValueError:
+                pass
+        delay = min(self.backoff_base * 2 ** attempt, self.backoff_max)
+        return delay * random.uniform(0.5, 1.0)
+
+    def fetch_tile(self, z, x, y):
+        """Fetch a single tile with proper rate limiting, returning its bytes or None"""
+        url = self.tile_url.format(z=z, x=x, y=y)
+        for attempt in range(self.max_retries + 1):
+            self.rate_limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=30)
+            except Exception as e:
+                self.logger.error(f"Error downloading tile z={z}, x={x}, y={y}: {str(e)}")
+                time.sleep(self._backoff_delay(attempt))
+                continue
 
-    def download_tile(self, z, x, y, save_path):
-        """Download a single tile with proper rate limiting"""
-        self._wait_for_rate_limit()
-        
-        url = f"https://tile.openstreetmap.org/{z}/{x}/{y}.png"
-        try:
-            response = self.session.get(url, timeout=30)
             if response.status_code == 200:
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-                with open(save_path, 'wb') as file:
-                    file.write(response.content)
+                self.rate_limiter.recover()
                 self.logger.info(f"Successfully downloaded tile: z={z}, x={x}, y={y}")
-                return True
+                return response.content
+
+            self.logger.warning(f"Failed to download tile (status {response.status_code}): z={z}, x={x}, y={y}")
+            if response.status_code in [429, 418]:
+                self.rate_limiter.throttle()
+                delay = self._backoff_delay(attempt, response.headers.get("Retry-After"))
+                self.logger.info(f"Rate limit hit, backing off {delay:.1f}s "
+                                 f"and lowering rate to {self.rate_limiter.rate:.2f} req/s")
+                time.sleep(delay)
+            elif response.status_code >= 500:
+                time.sleep(self._backoff_delay(attempt))
             else:
-                self.logger.warning(f"Failed to download tile (status {response.status_code}): z={z}, x={x}, y={y}")
-                if response.status_code in [429, 418]:
-                    self.logger.info("Rate limit hit, increasing delay...")
-                    time.sleep(5)  # Additional delay when rate limited
-                return False
-        except Exception as e:
-            self.logger.error(f"Error downloading tile z={z}, x={x}, y={y}: {str(e)}")
+                # Client errors such as 404 will not succeed on retry
+                return None
+        return None
+
+    def download_tile(self, z, x, y, save_path):
+        """Download a single tile to disk"""
+        content = self.fetch_tile(z, x, y)
+        if content is None:
             return False
+        os.makedirs(os.path.dirname(save_path), exist_ok=True)
+        # Write to a temporary file first so an interrupted run never leaves a partial tile
+        tmp_path = f"{save_path}.part"
+        with open(tmp_path, 'wb') as file:
+            file.write(content)
+        os.replace(tmp_path, save_path)
+        return True
 
     def lat_lon_to_tile(self, lat, lon, zoom):
         """Convert latitude/longitude to tile coordinates"""
@@ -66,49 +205,100 @@ class OSMTileDownloader:
         y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
         return x, y
 
-    def download_area(self, min_zoom, max_zoom, min_lat, max_lat, min_lon, max_lon, output_dir="tiles"):
-        """Download all tiles for a given area"""
-        total_tiles = 0
-        downloaded_tiles = 0
-        
+    def area_tiles(self, min_zoom, max_zoom, min_lat, max_lat, min_lon, max_lon):
+        """List every (z, x, y) tile covering a bounding box"""
+        tiles = []
         for z in range(min_zoom, max_zoom + 1):
             # Calculate tile coordinates for the bounding box
             x_min, y_max = self.lat_lon_to_tile(min_lat, min_lon, z)
             x_max, y_min = self.lat_lon_to_tile(max_lat, max_lon, z)
-            
+
             # Ensure correct order
             x_min, x_max = min(x_min, x_max), max(x_min, x_max)
             y_min, y_max = min(y_min, y_max), max(y_min, y_max)
-            
-            level_tiles = (x_max - x_min + 1) * (y_max - y_min + 1)
-            total_tiles += level_tiles
-            
-            self.logger.info(f"Starting zoom level {z} - {level_tiles} tiles to download")
-            
-            for x in range(x_min, x_max + 1):
-                for y in range(y_min, y_max + 1):
-                    save_path = os.path.join(output_dir, str(z), str(x), f"{y}.png")
-                    
-                    # Skip if tile already exists
-                    if os.path.exists(save_path):
-                        downloaded_tiles += 1
-                        continue
-                        
-                    if self.download_tile(z, x, y, save_path):
+
+            tiles.extend((z, x, y) for x in range(x_min, x_max + 1) for y in range(y_min, y_max + 1))
+        return tiles
+
+    def download_tiles(self, tiles, output_dir="tiles", mbtiles_path=None):
+        """Download a list of (z, x, y) tiles concurrently, skipping ones already downloaded
+
+        Tiles are written as ``output_dir/{z}/{x}/{y}.png`` or, when
+        ``mbtiles_path`` is given, into that MBTiles archive.
+        """
+        if mbtiles_path:
+            archive = MBTilesWriter(mbtiles_path)
+            done = archive.tile_keys()
+            manifest = None
+        else:
+            archive = None
+            manifest_path = os.path.join(output_dir, ".manifest")
+            fresh_manifest = not os.path.exists(manifest_path)
+            manifest = TileManifest(manifest_path)
+            if fresh_manifest and os.path.isdir(output_dir):
+                manifest.seed_from_tree(output_dir)
+            done = manifest
+
+        total_tiles = len(tiles)
+        pending = [tile for tile in tiles if TileManifest.key(*tile) not in done]
+        downloaded_tiles = total_tiles - len(pending)
+        failed_tiles = []
+        self.logger.info(f"{total_tiles} tiles in area, {downloaded_tiles} already downloaded, "
+                         f"{len(pending)} to fetch with {self.max_workers} workers")
+
+        def fetch(tile):
+            z, x, y = tile
+            if archive:
+                content = self.fetch_tile(z, x, y)
+                if content is None:
+                    return False
+                archive.write_tile(z, x, y, content)
+                return True
+
+            save_path = os.path.join(output_dir, str(z), str(x), f"{y}.png")
+            if self.download_tile(z, x, y, save_path):
+                manifest.add(TileManifest.key(z, x, y))
+                return True
+            return False
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                futures = {executor.submit(fetch, tile): tile for tile in pending}
+                for future in as_completed(futures):
+                    if future.result():
                         downloaded_tiles += 1
-                    
+                    else:
+                        failed_tiles.append(futures[future])
+
                     # Progress update
                     progress = (downloaded_tiles / total_tiles) * 100
                     self.logger.info(f"Progress: {progress:.1f}% ({downloaded_tiles}/{total_tiles} tiles)")
+        finally:
+            if archive:
+                archive.close()
+
+        if failed_tiles:
+            self.logger.warning(f"{len(failed_tiles)} tiles failed, rerun to retry them")
+        return failed_tiles
+
+    def download_area(self, min_zoom, max_zoom, min_lat, max_lat, min_lon, max_lon, output_dir="tiles",
+                      mbtiles_path=None):
+        """Download all tiles for a given area"""
+        tiles = self.area_tiles(min_zoom, max_zoom, min_lat, max_lat, min_lon, max_lon)
+        return self.download_tiles(tiles, output_dir, mbtiles_path)
+
+    def download_corridor(self, routes, buffer_m, min_zoom, max_zoom, output_dir="tiles", mbtiles_path=None):
+        """Download only the tiles within ``buffer_m`` metres of routes given as lists of [lat, lon]"""
+        tiles = corridor_tiles(routes, buffer_m, min_zoom, max_zoom)
+        self.logger.info(f"{len(tiles)} tiles within {buffer_m}m of {len(routes)} routes")
+        return self.download_tiles(tiles, output_dir, mbtiles_path)
 
 # Example usage
 if __name__ == "__main__":
-    import math  # Required for lat/lon conversion
-    
     # Bangalore coordinates (approximately)
     min_lat, max_lat = 13.120240973282115, 13.147281011514035
-    min_lon, max_lon = 77.5729400408967, 77.56802403246218
-    
+    min_lon, max_lon = 77.56802403246218, 77.5729400408967
+
     downloader = OSMTileDownloader()
     downloader.download_area(
         min_zoom=0,
@@ -118,4 +308,4 @@ if __name__ == "__main__":
         min_lon=min_lon,
         max_lon=max_lon,
         output_dir="bangalore_tiles"
-    )
\ No newline at end of file
+    )
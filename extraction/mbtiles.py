@@ -0,0 +1,123 @@
+"""MBTiles archive writer.
+
+Stores tiles in a single SQLite file using the deduplicating MBTiles layout:
+tile blobs live once in ``images`` keyed by their content hash, and ``map``
+points every z/x/y at a blob. Empty sea or park tiles that OSM serves many
+times over are therefore only stored once.
+
+Rows follow the MBTiles spec and use the TMS scheme, so ``tile_row`` is
+flipped relative to the XYZ ``y`` used by the downloader and Leaflet.
+"""
+
+import hashlib
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT, UNIQUE (name));
+CREATE TABLE IF NOT EXISTS images (tile_id TEXT PRIMARY KEY, tile_data BLOB);
+CREATE TABLE IF NOT EXISTS map (
+    zoom_level INTEGER,
+    tile_column INTEGER,
+    tile_row INTEGER,
+    tile_id TEXT,
+    UNIQUE (zoom_level, tile_column, tile_row)
+);
+CREATE VIEW IF NOT EXISTS tiles AS
+    SELECT map.zoom_level AS zoom_level,
+           map.tile_column AS tile_column,
+           map.tile_row AS tile_row,
+           images.tile_data AS tile_data
+    FROM map JOIN images ON images.tile_id = map.tile_id;
+"""
+
+
+def xyz_to_tms_row(z, y):
+    """Flip an XYZ row into the TMS row MBTiles stores"""
+    return (1 << z) - 1 - y
+
+
+class MBTilesWriter:
+    """Thread-safe writer for a deduplicating MBTiles archive.
+
+    Writes are committed in batches of ``commit_every`` tiles and on close,
+    so an interrupted download loses at most one batch.
+    """
+
+    def __init__(self, path, name="bangalore", tile_format="png", commit_every=100):
+        self.path = path
+        self.commit_every = commit_every
+        self.lock = threading.Lock()
+        self.uncommitted = 0
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO metadata (name, value) VALUES (?, ?)",
+            [("name", name), ("format", tile_format), ("type", "baselayer"), ("version", "1.3")],
+        )
+        self.conn.commit()
+
+    def tile_keys(self):
+        """Set of ``z/x/y`` keys already stored, in XYZ addressing"""
+        with self.lock:
+            rows = self.conn.execute("SELECT zoom_level, tile_column, tile_row FROM map").fetchall()
+        return {f"{z}/{x}/{xyz_to_tms_row(z, row)}" for z, x, row in rows}
+
+    def write_tile(self, z, x, y, data):
+        """Store a tile, reusing the existing blob when the content is identical"""
+        tile_id = hashlib.md5(data).hexdigest()
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO images (tile_id, tile_data) VALUES (?, ?)", (tile_id, data))
+            self.conn.execute(
+                "INSERT OR REPLACE INTO map (zoom_level, tile_column, tile_row, tile_id) VALUES (?, ?, ?, ?)",
+                (z, x, xyz_to_tms_row(z, y), tile_id),
+            )
+            self.uncommitted += 1
+            if self.uncommitted >= self.commit_every:
+                self.conn.commit()
+                self.uncommitted = 0
+
+    def update_bounds(self):
+        """Record the zoom range of the stored tiles in the metadata table"""
+        with self.lock:
+            min_zoom, max_zoom = self.conn.execute("SELECT MIN(zoom_level), MAX(zoom_level) FROM map").fetchone()
+            if min_zoom is not None:
+                self.conn.executemany(
+                    "INSERT OR REPLACE INTO metadata (name, value) VALUES (?, ?)",
+                    [("minzoom", str(min_zoom)), ("maxzoom", str(max_zoom))],
+                )
+
+    def import_tree(self, tile_dir, extension=".png"):
+        """Pack an existing ``{z}/{x}/{y}.png`` directory into the archive"""
+        count = 0
+        for root, _, files in os.walk(tile_dir):
+            for name in files:
+                if not name.endswith(extension):
+                    continue
+                parts = os.path.relpath(os.path.join(root, name[:-len(extension)]), tile_dir).split(os.sep)
+                if len(parts) != 3 or not all(part.isdigit() for part in parts):
+                    continue
+                with open(os.path.join(root, name), "rb") as file:
+                    self.write_tile(*map(int, parts), file.read())
+                count += 1
+        return count
+
+    def close(self):
+        self.update_bounds()
+        with self.lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+# Example usage: python mbtiles.py bangalore_tiles bangalore_tiles.mbtiles
+if __name__ == "__main__":
+    tile_dir = sys.argv[1] if len(sys.argv) > 1 else "bangalore_tiles"
+    archive = sys.argv[2] if len(sys.argv) > 2 else f"{tile_dir}.mbtiles"
+
+    writer = MBTilesWriter(archive)
+    packed = writer.import_tree(tile_dir)
+    writer.close()
+    print(f"Packed {packed} tiles from {tile_dir} into {archive}")
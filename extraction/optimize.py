@@ -0,0 +1,191 @@
+"""Tile recompression.
+
+Shrinks a downloaded ``{z}/{x}/{y}.png`` tree in place so the offline map
+bundle that is synced to every vehicle over the mesh is as small as
+possible. Tiles are re-encoded on a process pool as one of:
+
+``png8``
+    palette PNG quantized to 256 colours, close to lossless for map tiles
+``png``
+    lossless PNG with maximum zlib effort
+
+A re-encoded tile is only kept when it is smaller than the original.
+Tiles stay PNG because everything downstream assumes it: the ``.png`` paths
+and URL templates of the frontend, the ``format`` of MBTiles archives
+packed from the tree, and the content type the tile servers send.
+
+Identical tiles (sea, parks, empty low zoom tiles) are encoded once per run.
+An index of content hashes in ``.optimized`` records every tile's hash
+before and after, so running again after a download only touches tiles
+that are new or were replaced.
+"""
+
+import hashlib
+import io
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+VARIANTS = ("png8", "png")
+
+
+def encode_tile(data, variant="png8"):
+    """Re-encode one tile image and return the new bytes"""
+    with Image.open(io.BytesIO(data)) as image:
+        image.load()
+        output = io.BytesIO()
+        if variant == "png8":
+            if image.mode != "P":
+                # Fast octree handles the alpha channel; dithering only adds noise to flat map colours
+                image = image.convert("RGBA").quantize(256, method=Image.Quantize.FASTOCTREE,
+                                                       dither=Image.Dither.NONE)
+            image.save(output, format="PNG", optimize=True)
+        elif variant == "png":
+            image.save(output, format="PNG", optimize=True)
+        else:
+            raise ValueError(f"Unknown tile variant {variant}, expected one of {', '.join(VARIANTS)}")
+        return output.getvalue()
+
+
+def _run_encode_tile(args):
+    return encode_tile(*args)
+
+
+class TileIndex:
+    """Append-only record of optimized tiles.
+
+    Each line is ``z/x/y source_hash output_hash variant``; a later line for
+    the same tile replaces an earlier one. A tile whose current content
+    matches either hash of its line has already been through the optimizer
+    with that variant.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as file:
+                for line in file:
+                    parts = line.split()
+                    if len(parts) == 4:
+                        self.entries[parts[0]] = tuple(parts[1:])
+
+    def is_current(self, key, content_hash, variant):
+        entry = self.entries.get(key)
+        return entry is not None and content_hash in entry[:2] and entry[2] == variant
+
+    def add_many(self, records):
+        """Record (key, source_hash, output_hash, variant) tuples"""
+        with self.lock:
+            with open(self.path, "a") as file:
+                for key, *entry in records:
+                    self.entries[key] = tuple(entry)
+                    file.write(f"{key} {' '.join(entry)}\n")
+
+    def compact(self):
+        """Rewrite the index with one line per tile"""
+        with self.lock:
+            tmp_path = f"{self.path}.part"
+            with open(tmp_path, "w") as file:
+                file.writelines(f"{key} {' '.join(entry)}\n" for key, entry in sorted(self.entries.items()))
+            os.replace(tmp_path, self.path)
+
+
+class TileOptimizer:
+    """Recompresses a tile tree in place, incrementally.
+
+    Attributes
+    ----------
+    variant : str
+        target encoding, one of ``VARIANTS``
+    workers : int
+        processes used for encoding, defaults to the CPU count
+    """
+
+    def __init__(self, variant="png8", workers=None):
+        if variant not in VARIANTS:
+            raise ValueError(f"Unknown tile variant {variant}, expected one of {', '.join(VARIANTS)}")
+        self.variant = variant
+        self.workers = workers
+        self.logger = logging.getLogger('TileOptimizer')
+
+    @staticmethod
+    def tile_files(tile_dir):
+        """(key, path) of every ``{z}/{x}/{y}.png`` tile in a tree"""
+        for root, _, files in os.walk(tile_dir):
+            for name in files:
+                if not name.endswith(".png"):
+                    continue
+                parts = os.path.relpath(os.path.join(root, name[:-4]), tile_dir).split(os.sep)
+                if len(parts) == 3 and all(part.isdigit() for part in parts):
+                    yield "/".join(parts), os.path.join(root, name)
+
+    def optimize_tree(self, tile_dir):
+        """Re-encode every new or changed tile under ``tile_dir`` and return a summary"""
+        index = TileIndex(os.path.join(tile_dir, ".optimized"))
+        stats = {"tiles": 0, "unchanged": 0, "encoded": 0, "kept_original": 0, "bytes_before": 0, "bytes_after": 0}
+
+        # Tiles to process grouped by content, so duplicates are encoded once
+        pending = {}
+        for key, path in self.tile_files(tile_dir):
+            stats["tiles"] += 1
+            with open(path, "rb") as file:
+                data = file.read()
+            content_hash = hashlib.md5(data).hexdigest()
+            if index.is_current(key, content_hash, self.variant):
+                stats["unchanged"] += 1
+                continue
+            pending.setdefault(content_hash, (data, []))[1].append((key, path))
+
+        self.logger.info(f"{stats['tiles']} tiles, {stats['unchanged']} already optimized, "
+                         f"{sum(len(paths) for _, paths in pending.values())} to encode "
+                         f"as {len(pending)} distinct images")
+        if not pending:
+            return stats
+
+        hashes = list(pending)
+        jobs = [(pending[content_hash][0], self.variant) for content_hash in hashes]
+        records = []
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            for content_hash, encoded in zip(hashes, executor.map(_run_encode_tile, jobs, chunksize=16)):
+                data, tiles = pending[content_hash]
+                if len(encoded) < len(data):
+                    output, output_hash = encoded, hashlib.md5(encoded).hexdigest()
+                    stats["encoded"] += len(tiles)
+                    for _, path in tiles:
+                        tmp_path = f"{path}.part"
+                        with open(tmp_path, "wb") as file:
+                            file.write(output)
+                        os.replace(tmp_path, path)
+                else:
+                    output, output_hash = data, content_hash
+                    stats["kept_original"] += len(tiles)
+                stats["bytes_before"] += len(data) * len(tiles)
+                stats["bytes_after"] += len(output) * len(tiles)
+                records.extend((key, content_hash, output_hash, self.variant) for key, _ in tiles)
+        index.add_many(records)
+        index.compact()
+
+        saved = stats["bytes_before"] - stats["bytes_after"]
+        self.logger.info(f"Encoded {stats['encoded']} tiles as {self.variant}, kept {stats['kept_original']} "
+                         f"originals, saved {saved / 1024:.1f} KiB of {stats['bytes_before'] / 1024:.1f} KiB")
+        return stats
+
+
+# Example usage: python optimize.py bangalore_tiles png8
+if __name__ == "__main__":
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(message)s'
+    )
+    tile_dir = sys.argv[1] if len(sys.argv) > 1 else "bangalore_tiles"
+    variant = sys.argv[2] if len(sys.argv) > 2 else "png8"
+
+    summary = TileOptimizer(variant).optimize_tree(tile_dir)
+    for name, value in summary.items():
+        print(f"{name:>14}: {value}")
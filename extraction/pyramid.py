@@ -0,0 +1,136 @@
+"""Local tile pyramid builder.
+
+Only the highest zoom level of an area is downloaded. Every lower zoom is
+derived locally by mosaicking each 2x2 block of child tiles and downsampling
+the result to one tile, and overzoom levels above the native zoom are
+pre-rendered once by upscaling quadrants of the native tiles. The browser can
+then load real tiles at every zoom instead of scaling them with CSS.
+
+Tiles outside the downloaded area are left transparent, so derived low zoom
+tiles only show the area itself. Levels at or below ``network_max_zoom`` are
+fetched from the network instead, which is cheap because a small area covers
+just one or two tiles there.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from PIL import Image
+
+from main import OSMTileDownloader
+
+TILE_SIZE = 256
+
+
+def tile_path(tile_dir, z, x, y):
+    return os.path.join(tile_dir, str(z), str(x), f"{y}.png")
+
+
+def _save(image, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.part"
+    image.save(tmp_path, format="PNG", optimize=True)
+    os.replace(tmp_path, path)
+
+
+def build_parent(tile_dir, z, x, y):
+    """Build tile z/x/y from its four children at z + 1. Returns False if none exist."""
+    mosaic = Image.new("RGBA", (TILE_SIZE * 2, TILE_SIZE * 2), (0, 0, 0, 0))
+    found = False
+    for dx in (0, 1):
+        for dy in (0, 1):
+            child = tile_path(tile_dir, z + 1, 2 * x + dx, 2 * y + dy)
+            if os.path.exists(child):
+                with Image.open(child) as image:
+                    mosaic.paste(image.convert("RGBA"), (dx * TILE_SIZE, dy * TILE_SIZE))
+                found = True
+    if not found:
+        return False
+    _save(mosaic.resize((TILE_SIZE, TILE_SIZE), Image.LANCZOS), tile_path(tile_dir, z, x, y))
+    return True
+
+
+def build_overzoom(tile_dir, z, x, y, max_zoom):
+    """Render every tile above z/x/y up to max_zoom by upscaling parts of it"""
+    with Image.open(tile_path(tile_dir, z, x, y)) as image:
+        source = image.convert("RGBA")
+    count = 0
+    for target_zoom in range(z + 1, max_zoom + 1):
+        scale = 1 << (target_zoom - z)
+        part = TILE_SIZE // scale
+        for dx in range(scale):
+            for dy in range(scale):
+                crop = source.crop((dx * part, dy * part, (dx + 1) * part, (dy + 1) * part))
+                _save(crop.resize((TILE_SIZE, TILE_SIZE), Image.BICUBIC),
+                      tile_path(tile_dir, target_zoom, x * scale + dx, y * scale + dy))
+                count += 1
+    return count
+
+
+def _run_build_parent(args):
+    return build_parent(*args)
+
+
+def _run_build_overzoom(args):
+    return build_overzoom(*args)
+
+
+class TilePyramidBuilder:
+    """Builds a full zoom range for an area from a single downloaded zoom.
+
+    Attributes
+    ----------
+    downloader : OSMTileDownloader
+        used to fetch the native zoom (and any network zoom levels)
+    workers : int
+        processes used for resampling, defaults to the CPU count
+    """
+
+    def __init__(self, downloader=None, workers=None):
+        self.downloader = downloader or OSMTileDownloader()
+        self.logger = self.downloader.logger
+        self.workers = workers
+
+    def build(self, min_zoom, native_zoom, max_zoom, min_lat, max_lat, min_lon, max_lon,
+              output_dir="tiles", network_max_zoom=None):
+        """Download ``native_zoom`` for the area and derive min_zoom..max_zoom from it"""
+        self.downloader.download_area(native_zoom, native_zoom, min_lat, max_lat, min_lon, max_lon, output_dir)
+        if network_max_zoom is not None and network_max_zoom >= min_zoom:
+            self.downloader.download_area(min_zoom, min(network_max_zoom, native_zoom - 1),
+                                          min_lat, max_lat, min_lon, max_lon, output_dir)
+
+        native_tiles = self.downloader.area_tiles(native_zoom, native_zoom, min_lat, max_lat, min_lon, max_lon)
+        native_tiles = [tile for tile in native_tiles if os.path.exists(tile_path(output_dir, *tile))]
+
+        with ProcessPoolExecutor(max_workers=self.workers) as executor:
+            level = {(x, y) for _, x, y in native_tiles}
+            lowest_derived = min_zoom if network_max_zoom is None else max(min_zoom, network_max_zoom + 1)
+            for z in range(native_zoom - 1, lowest_derived - 1, -1):
+                level = {(x // 2, y // 2) for x, y in level}
+                built = sum(executor.map(_run_build_parent, [(output_dir, z, x, y) for x, y in sorted(level)],
+                                         chunksize=16))
+                self.logger.info(f"Built {built} tiles for zoom level {z} from zoom level {z + 1}")
+
+            if max_zoom > native_zoom:
+                jobs = [(output_dir, z, x, y, max_zoom) for z, x, y in native_tiles]
+                rendered = sum(executor.map(_run_build_overzoom, jobs, chunksize=4))
+                self.logger.info(f"Rendered {rendered} overzoom tiles for zoom levels {native_zoom + 1}-{max_zoom}")
+
+
+# Example usage
+if __name__ == "__main__":
+    # Bangalore coordinates (approximately)
+    min_lat, max_lat = 13.120240973282115, 13.147281011514035
+    min_lon, max_lon = 77.56802403246218, 77.5729400408967
+
+    TilePyramidBuilder().build(
+        min_zoom=0,
+        native_zoom=19,
+        max_zoom=22,
+        min_lat=min_lat,
+        max_lat=max_lat,
+        min_lon=min_lon,
+        max_lon=max_lon,
+        output_dir="bangalore_tiles",
+        network_max_zoom=12
+    )